@@ -0,0 +1,616 @@
+################
+## Packages to be used
+####
+
+import kepler_data_processing as kdp
+import numpy as np
+import contextlib
+import subprocess
+import tracemalloc
+import platform
+import json
+import time
+import sys
+import os
+
+################
+## Benchmarks for the data processing methods
+####
+
+## Import time budgets in seconds (cold interpreter, see 
+## benchmark_import_time); none of these should import tensorflow, 
+## lightkurve or matplotlib
+IMPORT_TIME_BUDGETS = {
+    'cli': 0.2,
+    'kepler_data_processing': 2.0,
+    'tfrecords_creation': 0.5,
+    'cnn_model': 0.5,
+    'score_tces': 2.0,
+    'model_export': 2.0,
+}
+
+def benchmark_metadata_lookup(tce_data, n_lookups=None):
+    '''
+    The benchmark_metadata_lookup function compares the indexed
+        get_metadata against the original scan of tce_data.
+
+    Args:
+        tce_data: DataFrame containing needed parameter values.
+            Should have been generated using open_files.
+        n_lookups: int; number of kepids to look up.
+            Default = None (every TCE in tce_data).
+
+    Returns:
+        results: dict with the lookups per second of both methods and
+            the time spent building the index.
+    '''
+
+    kepids = tce_data['kepid'].tolist()
+    if n_lookups is not None:
+        kepids = kepids[:n_lookups]
+
+    ## Time spent building the index (done once by open_files)
+    start = time.perf_counter()
+    index = kdp.build_metadata_index(tce_data)
+    build_time = time.perf_counter() - start
+
+    ## Indexed lookups
+    start = time.perf_counter()
+    for kepid in kepids:
+        kdp.get_metadata(kepid, index)
+    indexed_time = time.perf_counter() - start
+
+    ## Original lookups, scanning tce_data every time
+    start = time.perf_counter()
+    for kepid in kepids:
+        kdp._get_metadata_scan(kepid, tce_data)
+    scan_time = time.perf_counter() - start
+
+    results = {
+        'lookups': len(kepids),
+        'index_build_seconds': build_time,
+        'indexed_lookups_per_second': len(kepids) / max(indexed_time, 1e-9),
+        'scan_lookups_per_second': len(kepids) / max(scan_time, 1e-9),
+    }
+
+    print('Metadata lookups ({} kepids)'.format(len(kepids)))
+    print('  Index build: {:.4f} s'.format(build_time))
+    print('  Indexed    : {:.1f} lookups/s'.format(
+        results['indexed_lookups_per_second']))
+    print('  Scan       : {:.1f} lookups/s'.format(
+        results['scan_lookups_per_second']))
+
+    return results
+
+
+def _time_and_peak(function, repeats):
+    '''
+    Runs function repeats times and returns the best wall time in
+        seconds, the peak traced memory in bytes and the last result.
+    tracemalloc slows down allocations a lot, so the timed runs are not
+        traced; the peak comes from one more, traced, run.
+    '''
+
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak, result
+
+
+def check_fold_equivalence(kepid, tce_data, window_length=101, rtol=1e-6):
+    '''
+    The check_fold_equivalence function checks that the NumPy fold/bin/
+        normalize kernel gives the same flux as the lightkurve methods.
+
+    Args:
+        kepid: Object of interest.
+        tce_data: DataFrame containing needed parameter values.
+        window_length: Used when flattening. Default = 101.
+        rtol: Relative tolerance of the comparison. Default = 1e-6.
+
+    Returns:
+        max_diff: float; largest absolute difference between the two.
+    '''
+
+    paths = kdp.get_kepid_files(kepid)
+    lk_flux = np.asarray(kdp.get_total_flux(
+        kepid, tce_data, window_length, paths=paths).flux)
+    np_flux = np.asarray(kdp.get_total_flux(
+        kepid, tce_data, window_length, paths=paths,
+        fold_backend='numpy').flux)
+
+    assert lk_flux.shape == np_flux.shape, (lk_flux.shape, np_flux.shape)
+    assert np.allclose(lk_flux, np_flux, rtol=rtol, equal_nan=True)
+
+    return float(np.nanmax(np.abs(lk_flux - np_flux)))
+
+
+def benchmark_fold(kepid, tce_data, window_length=101, repeats=5):
+    '''
+    The benchmark_fold function times the fold/bin/normalize step of
+        get_total_flux for the lightkurve and NumPy backends.
+    The light curve is stitched once beforehand, so only the last step
+        is measured.
+
+    Args:
+        kepid: Object of interest.
+        tce_data: DataFrame containing needed parameter values.
+        window_length: Used when flattening. Default = 101.
+        repeats: int; the best of repeats runs is reported. Default = 5.
+
+    Returns:
+        results: dict with the seconds and peak bytes of every backend.
+    '''
+
+    main_lc = kdp.stitch_kepid(kdp.get_kepid_files(kepid), window_length)
+    period, tranmid = kdp.get_metadata(kepid, tce_data)
+    binsize = kdp.calculate_binsize(len(main_lc.flux))
+
+    backends = {
+        'lightkurve': lambda: main_lc.fold(
+            period=period, t0=tranmid).bin(binsize=binsize).normalize(),
+        'numpy': lambda: kdp.fold_bin_normalize(
+            main_lc.time, main_lc.flux, period, tranmid, binsize),
+        'numpy_float32': lambda: kdp.fold_bin_normalize(
+            main_lc.time, main_lc.flux, period, tranmid, binsize,
+            'float32'),
+    }
+
+    results = {}
+    print('Fold/bin/normalize (kepid-{}, {} points)'.format(
+        str(kepid).zfill(9), len(main_lc.flux)))
+    for name, function in backends.items():
+        seconds, peak, _ = _time_and_peak(function, repeats)
+        results[name] = {'seconds': seconds, 'peak_bytes': peak}
+        print('  {:<14}: {:.4f} s, peak {:.1f} MB'.format(
+            name, seconds, peak / 1e6))
+
+    return results
+
+
+def benchmark_stitching(kepid, window_length=101, repeats=3):
+    '''
+    The benchmark_stitching function compares the peak memory and wall
+        time of stitch_kepid against the original append loop.
+
+    Args:
+        kepid: Object of interest.
+        window_length: Used when flattening. Default = 101.
+        repeats: int; the best of repeats runs is reported. Default = 3.
+
+    Returns:
+        results: dict with the seconds and peak bytes of both methods.
+    '''
+
+    paths = kdp.get_kepid_files(kepid)
+
+    methods = {
+        'append': lambda: kdp._stitch_kepid_append(paths, window_length),
+        'single_pass': lambda: kdp.stitch_kepid(paths, window_length),
+    }
+
+    results = {}
+    print('Stitching (kepid-{}, {} fits files)'.format(
+        str(kepid).zfill(9), len(paths)))
+    for name, function in methods.items():
+        seconds, peak, main_lc = _time_and_peak(function, repeats)
+        results[name] = {'seconds': seconds, 'peak_bytes': peak,
+                         'points': len(main_lc.flux)}
+        print('  {:<11}: {:.4f} s, peak {:.1f} MB'.format(
+            name, seconds, peak / 1e6))
+
+    return results
+
+
+def check_flatten_equivalence(kepids, window_length=101, rtol=1e-4):
+    '''
+    The check_flatten_equivalence function checks that the vectorized
+        flattening engine gives the same flux as LightCurve.flatten run
+        on every quarter: per kepid through stitch_kepid, and for all
+        quarters of all kepids in one flatten_light_curves call.
+
+    Args:
+        kepids: list of kepids whose fits files are downloaded.
+        window_length: Used when flattening. Default = 101.
+        rtol: Relative tolerance of the comparison. Default = 1e-4.
+            The trends agree to float32 rounding, but a point lying on
+            the 3 sigma clipping threshold can then be clipped by one
+            and kept by the other, which moves the nearby trend by a
+            small fraction of the noise.
+
+    Returns:
+        max_diff: float; largest absolute difference between the two.
+    '''
+
+    from flatten_engine import flatten_light_curves
+
+    max_diff = 0.
+    quarters = []
+    expected = []
+    for kepid in kepids:
+        paths = kdp.get_kepid_files(kepid)
+        lk_lc = kdp.stitch_kepid(paths, window_length)
+        np_lc = kdp.stitch_kepid(paths, window_length,
+                                 flatten_backend='numpy')
+
+        assert np.array_equal(lk_lc.time, np_lc.time)
+        for lk_column, np_column in [(lk_lc.flux, np_lc.flux),
+                                     (lk_lc.flux_err, np_lc.flux_err)]:
+            assert np.allclose(lk_column, np_column, rtol=rtol,
+                               equal_nan=True), kepid
+            max_diff = max(max_diff, float(np.nanmax(np.abs(
+                np.asarray(lk_column) - np.asarray(np_column)))))
+
+        for path in paths:
+            lc = kdp.read_quarter(path)
+            quarters.append((lc.time, lc.flux, lc.flux_err))
+            expected.append(lc.flatten(window_length=window_length).flux)
+
+    ## All quarters of all kepids at once
+    for (_, flux, _), lk_flux in zip(
+            flatten_light_curves(quarters, window_length), expected):
+        assert np.allclose(lk_flux, flux, rtol=rtol, equal_nan=True)
+        max_diff = max(max_diff, float(np.nanmax(np.abs(lk_flux - flux))))
+
+    return max_diff
+
+
+def benchmark_flatten(kepids, window_length=101, repeats=3):
+    '''
+    The benchmark_flatten function times the flattening of all quarters
+        of the given kepids with LightCurve.flatten (one quarter at a
+        time) and with the vectorized engine (one kepid at a time, and
+        all kepids in one call).
+    The fits files are read once beforehand, so only flattening is
+        measured.
+
+    Args:
+        kepids: list of kepids whose fits files are downloaded.
+        window_length: Used when flattening. Default = 101.
+        repeats: int; the best of repeats runs is reported. Default = 3.
+
+    Returns:
+        results: dict with the seconds and peak bytes of every method.
+    '''
+
+    from flatten_engine import flatten_light_curves
+
+    light_curves = [[kdp.read_quarter(path)
+                     for path in kdp.get_kepid_files(kepid)]
+                    for kepid in kepids]
+    quarters = [[(lc.time, lc.flux, lc.flux_err) for lc in kepid_lcs]
+                for kepid_lcs in light_curves]
+    all_quarters = [quarter for kepid_quarters in quarters
+                    for quarter in kepid_quarters]
+
+    methods = {
+        'lightkurve': lambda: [lc.flatten(window_length=window_length)
+                               for kepid_lcs in light_curves
+                               for lc in kepid_lcs],
+        'numpy_per_kepid': lambda: [
+            flatten_light_curves(kepid_quarters, window_length)
+            for kepid_quarters in quarters],
+        'numpy_all_kepids': lambda: flatten_light_curves(all_quarters,
+                                                         window_length),
+    }
+
+    results = {}
+    print('Flattening ({} kepids, {} quarters, {} points)'.format(
+        len(kepids), len(all_quarters),
+        sum(len(time) for time, _, _ in all_quarters)))
+    for name, function in methods.items():
+        seconds, peak, _ = _time_and_peak(function, repeats)
+        results[name] = {'seconds': seconds, 'peak_bytes': peak}
+        print('  {:<16}: {:.4f} s, peak {:.1f} MB'.format(
+            name, seconds, peak / 1e6))
+
+    return results
+
+
+def benchmark_split(data, labels, kepid_labels, repeats=3):
+    '''
+    The benchmark_split function compares the peak memory and wall time
+        of shuffle_data + split_data (which copy the whole data set) 
+        against split_indices (which only returns row indices).
+
+    Args:
+        data: np.array or np.memmap; all flux data (e.g. flux_data.npy)
+        labels: np.array; all labels
+        kepid_labels: np.array; all kepids and labels
+        repeats: int; the best of repeats runs is reported. Default = 3.
+
+    Returns:
+        results: dict with the seconds and peak bytes of both methods.
+    '''
+
+    import tfrecords_creation as tfc
+
+    kepids = kepid_labels[:, 0].astype(np.int64)
+    methods = {
+        'shuffle_copy': lambda: tfc.split_data(
+            *tfc.shuffle_data(data, labels, kepid_labels)[:2]),
+        'split_indices': lambda: tfc.split_indices(kepids, labels),
+    }
+
+    results = {}
+    print('Train/val/test split ({} TCEs)'.format(len(labels)))
+    for name, function in methods.items():
+        seconds, peak, _ = _time_and_peak(function, repeats)
+        results[name] = {'seconds': seconds, 'peak_bytes': peak}
+        print('  {:<13}: {:.4f} s, peak {:.1f} MB'.format(
+            name, seconds, peak / 1e6))
+
+    return results
+
+
+def benchmark_import_time(modules=None, repeats=3, check_budget=False):
+    '''
+    The benchmark_import_time function measures how long importing each
+        module takes in a fresh interpreter.
+
+    Args:
+        modules: list of module names. Default = None (the modules in
+            IMPORT_TIME_BUDGETS).
+        repeats: int; the best of repeats runs is reported. Default = 3.
+        check_budget: bool; raise an AssertionError if a module takes
+            longer than its budget in IMPORT_TIME_BUDGETS.
+            Default = False.
+
+    Returns:
+        results: dict; module name -> best import time in seconds.
+    '''
+
+    if modules is None:
+        modules = sorted(IMPORT_TIME_BUDGETS)
+
+    code = ('import time; start = time.perf_counter(); import {}; '
+            'print(time.perf_counter() - start)')
+
+    results = {}
+    print('Import times (best of {})'.format(repeats))
+    for module in modules:
+        results[module] = min(
+            float(subprocess.check_output(
+                [sys.executable, '-c', code.format(module)]))
+            for _ in range(repeats))
+
+        budget = IMPORT_TIME_BUDGETS.get(module)
+        print('  {:<24}: {:.3f} s (budget {})'.format(
+            module, results[module], budget))
+
+    if check_budget:
+        over = [module for module in modules
+                if module in IMPORT_TIME_BUDGETS and
+                results[module] > IMPORT_TIME_BUDGETS[module]]
+        assert not over, 'Import time over budget: {}'.format(over)
+
+    return results
+
+
+
+################
+## Benchmark suite on synthetic light curves
+####
+
+@contextlib.contextmanager
+def _working_directory(path):
+    ## The pipeline looks for the fits files in data/ of the working
+    ## directory, so the suite runs inside the synthetic data set
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_stage(results, name, function):
+    '''
+    Runs one stage of the suite, storing its wall time (and whatever
+        extra numbers function returns) in results[name].
+    Stages needing a package that is not installed (e.g. tensorflow)
+        are recorded as skipped, and stages that fail with their error,
+        so that the other stages still run and the results can still
+        be compared.
+    '''
+
+    start = time.perf_counter()
+    try:
+        extra = function() or {}
+    except ImportError as e:
+        results[name] = {'skipped': str(e)}
+        print('  {:<22}: skipped ({})'.format(name, e))
+        return
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        results[name] = {'error': error}
+        print('  {:<22}: failed ({})'.format(name, error))
+        return
+    seconds = time.perf_counter() - start
+
+    results[name] = dict(extra, seconds=seconds)
+    print('  {:<22}: {:.3f} s'.format(name, seconds))
+
+
+def run_benchmark_suite(work_dir='synthetic', n_kepids=50, n_flux=10,
+                        n_workers=1, train_steps=20, batch_size=8,
+                        seed=0, results_file='benchmark_results.json',
+                        **flux_kwargs):
+    '''
+    The run_benchmark_suite function times every stage of the pipeline
+        on a synthetic data set (see synthetic_data), so performance
+        can be measured without the MAST download.
+    The data set is generated in work_dir the first time and reused
+        after that.
+
+    Args:
+        work_dir: str; directory of the synthetic data set.
+            Default = 'synthetic'
+        n_kepids: int; number of synthetic kepids. Default = 50.
+        n_flux: int; number of kepids timed with get_total_flux.
+            Default = 10.
+        n_workers: int; number of workers of main_data_processing and
+            create_data_record. Default = 1.
+        train_steps: int; number of timed training steps. Default = 20.
+        batch_size: int; batch size of the training steps. Default = 8.
+        seed: int; seed of the synthetic data set. Default = 0.
+        results_file: str; json the results are written to.
+            Default = 'benchmark_results.json'
+        **flux_kwargs: passed on to get_total_flux and
+            main_data_processing (e.g. fold_backend, reader).
+
+    Writes Out:
+        results_file with the commit, the parameters and the seconds
+            of every stage. Compare two of them with compare_benchmarks.
+
+    Returns:
+        report: dict; the content of results_file.
+    '''
+
+    from synthetic_data import generate_synthetic_dataset
+
+    csv_file = os.path.join(work_dir, 'synthetic_tces.csv')
+    if os.path.isfile(csv_file) == False:
+        generate_synthetic_dataset(work_dir, n_kepids, seed=seed)
+    csv_name = os.path.basename(csv_file)
+
+    results = {}
+    print('Benchmark suite ({})'.format(work_dir))
+
+    with _working_directory(work_dir):
+        tce_data = kdp.open_files(csv_name)
+        kepids = tce_data['kepid'].tolist()
+
+        def kepid_files():
+            n_files = sum(len(kdp.get_kepid_files(kepid)) for kepid in kepids)
+            return {'kepids': len(kepids), 'files': n_files}
+
+        def total_flux():
+            for kepid in kepids[:n_flux]:
+                kdp.get_total_flux(kepid, tce_data, **flux_kwargs)
+            return {'kepids': min(n_flux, len(kepids))}
+
+        def data_processing():
+            flux_data, flux_labels, _ = kdp.main_data_processing(
+                csv_name, n_workers=n_workers, out_dir='benchmark_run',
+                **flux_kwargs)
+            return {'tces': len(flux_data),
+                    'processed': int(np.sum(np.asarray(flux_labels) >= 0))}
+
+        def data_record():
+            from tfrecords_creation import create_data_record
+            flux_data = np.load(os.path.join('benchmark_run', 'flux_data.npy'),
+                                mmap_mode='r')
+            flux_labels = np.load(os.path.join('benchmark_run',
+                                               'flux_labels.npy'))
+            split_info = create_data_record(
+                os.path.join('benchmark_run', 'tfrecords', 'bench.tfrecords'),
+                flux_data, flux_labels, 'Benchmark', n_workers=n_workers,
+                num_shards=max(n_workers, 1))
+            return {'records': split_info['total_records']}
+
+        def training_steps():
+            import cnn_model
+            model = cnn_model.compile_model(cnn_model.build_model())
+            data = np.nan_to_num(np.load(
+                os.path.join('benchmark_run', 'flux_data.npy'))[:batch_size])
+            data = data.reshape(len(data), kdp.FLUX_LEN, 1)
+            labels = np.zeros(len(data))
+
+            ## First step builds the graph, so it is not timed
+            model.train_on_batch(data, labels)
+            start = time.perf_counter()
+            for _ in range(train_steps):
+                model.train_on_batch(data, labels)
+            step_seconds = (time.perf_counter() - start) / train_steps
+            return {'steps': train_steps, 'batch_size': len(data),
+                    'seconds_per_step': step_seconds}
+
+        _run_stage(results, 'get_kepid_files', kepid_files)
+        _run_stage(results, 'get_total_flux', total_flux)
+        _run_stage(results, 'main_data_processing', data_processing)
+        _run_stage(results, 'create_data_record', data_record)
+        _run_stage(results, 'training_steps', training_steps)
+
+    report = {
+        'commit': _git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'params': dict({'n_kepids': len(kepids), 'n_flux': n_flux,
+                        'n_workers': n_workers, 'train_steps': train_steps,
+                        'batch_size': batch_size, 'seed': seed},
+                       **{key: str(value)
+                          for key, value in flux_kwargs.items()}),
+        'results': results,
+    }
+
+    with open(results_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to {}'.format(results_file))
+
+    return report
+
+
+def compare_benchmarks(baseline_file, results_file, tolerance=0.1):
+    '''
+    The compare_benchmarks function compares the stage times of two
+        run_benchmark_suite results (e.g. of two commits).
+
+    Args:
+        baseline_file: str; json of the reference run.
+        results_file: str; json of the new run.
+        tolerance: float; relative slowdown above which a stage counts
+            as a regression. Default = 0.1 (10%).
+
+    Returns:
+        regressions: list of the names of the stages that got slower.
+    '''
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    with open(results_file) as f:
+        results = json.load(f)
+
+    print('Comparing {} ({}) to {} ({})'.format(
+        results_file, (results['commit'] or '?')[:8],
+        baseline_file, (baseline['commit'] or '?')[:8]))
+    if baseline['params'] != results['params']:
+        print('  Warning: the runs used different parameters')
+
+    regressions = []
+    for name, new in results['results'].items():
+        old = baseline['results'].get(name, {})
+        if 'seconds' not in new or 'seconds' not in old:
+            print('  {:<22}: not comparable'.format(name))
+            continue
+
+        ratio = new['seconds'] / max(old['seconds'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print('  {:<22}: {:.3f} s -> {:.3f} s ({:+.1f}%){}'.format(
+            name, old['seconds'], new['seconds'], (ratio - 1) * 100, flag))
+
+    return regressions
@@ -0,0 +1,535 @@
+################
+## Packages to be used
+####
+
+## Only the standard library is imported here; every command imports
+## the pipeline modules it needs when it runs
+import argparse
+import sys
+import os
+
+################
+## Commands
+####
+
+def run_process(args):
+    '''
+    Processes the light curves of the TCEs in a csv (main_data_processing).
+    '''
+
+    import kepler_data_processing as kdp
+
+    cache = None
+    if args.cache_dir:
+        from flux_cache import FluxCache
+        cache = FluxCache(args.cache_dir,
+                          max_bytes=int(args.cache_max_gb * 1024**3))
+
+    ## Fits files fetched from a mirror into --data-dir
+    prefetcher = None
+    if args.mirror:
+        from prefetch import Prefetcher
+        prefetcher = Prefetcher(args.mirror, args.data_dir,
+                                max_concurrency=args.fetch_concurrency,
+                                retries=args.fetch_retries,
+                                lookahead=args.fetch_lookahead)
+        if args.manifest:
+            if not args.incremental:
+                sys.exit('--manifest with --mirror needs --incremental '
+                         '(the files are staged before the manifest is built)')
+            prefetcher.fetch_kepids(kdp.open_files(args.csv_file)['kepid'])
+
+    manifest = None
+    if args.manifest:
+        from fits_manifest import build_manifest
+        manifest = build_manifest(args.data_dir, args.manifest)
+
+    processing_kwargs = {'n_workers': args.workers,
+                         'max_in_flight': args.max_in_flight,
+                         'cache': cache,
+                         'fold_backend': args.fold_backend,
+                         'reader': args.reader,
+                         'flatten_backend': args.flatten_backend,
+                         'views': kdp.VIEWS if args.views else None,
+                         'retry_failed': args.retry_failed,
+                         'profile': args.profile,
+                         'progress_interval': args.progress_interval,
+                         'log_format': args.log_format,
+                         'store_file': args.store,
+                         'window_length': args.window_length,
+                         'prefetcher': prefetcher}
+
+    try:
+        if args.incremental:
+            from incremental import update_flux_store
+            update_flux_store(args.csv_file, out_dir=args.out_dir,
+                              manifest=manifest, data_dir=args.data_dir,
+                              **processing_kwargs)
+        else:
+            kdp.main_data_processing(args.csv_file,
+                                     manifest=manifest,
+                                     out_dir=args.out_dir,
+                                     resume=args.resume,
+                                     data_dir=args.data_dir,
+                                     **processing_kwargs)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+
+def run_tfrecords(args):
+    '''
+    Converts the flux store written by process into tfrecords
+        (main_tfrecords_creation).
+    '''
+
+    import tfrecords_creation as tfc
+    from kepler_data_processing import load_view_arrays
+    import numpy as np
+
+    if args.incremental:
+        tfc.update_tfrecords(args.data_dir, args.tf_dir,
+                             num_shards=args.shards,
+                             compression=args.compression,
+                             flux_dtype=args.flux_dtype,
+                             n_workers=args.workers,
+                             seed=args.seed,
+                             log_format=args.log_format)
+        return
+
+    ## Rows are read from the HDF5 store as they are written
+    store = None
+    if args.store:
+        from flux_store import FluxStore
+        store = FluxStore(args.store)
+        data = store.flux
+        labels = store.labels[:]
+        kepid_labels = store.kepid_labels()
+        views = store.views
+    else:
+        data = np.load(os.path.join(args.data_dir, 'flux_data.npy'),
+                       mmap_mode='r')
+        labels = np.load(os.path.join(args.data_dir, 'flux_labels.npy'))
+        kepid_labels = np.load(os.path.join(args.data_dir,
+                                            'flux_kepid_labels.npy'))
+        views = load_view_arrays(args.data_dir)
+
+    try:
+        tfc.main_tfrecords_creation(data, labels, kepid_labels,
+                                    tf_dir=args.tf_dir,
+                                    num_shards=args.shards,
+                                    compression=args.compression,
+                                    flux_dtype=args.flux_dtype,
+                                    n_workers=args.workers,
+                                    log_format=args.log_format,
+                                    seed=args.seed,
+                                    stratify=args.stratify,
+                                    views=views)
+    finally:
+        if store is not None:
+            store.close()
+
+
+def run_train(args):
+    '''
+    Trains cnn_model, either from tfrecords or from npy arrays.
+    '''
+
+    import cnn_model
+
+    if args.cpu:
+        if not args.tf_dir:
+            sys.exit('train --cpu needs --tf-dir')
+        cnn_model.train_cpu_workers(num_workers=args.workers,
+                                    tf_dir=args.tf_dir,
+                                    batch_size=args.batch_size or 64,
+                                    epochs=args.epochs,
+                                    intra_op_threads=args.intra_op_threads,
+                                    inter_op_threads=args.inter_op_threads,
+                                    warmup_epochs=args.warmup_epochs,
+                                    cache=args.cache)
+    elif args.store:
+        cnn_model.fit_model_from_store(args.store,
+                                       batch_size=args.batch_size or 8,
+                                       epochs=args.epochs)
+    elif args.tf_dir:
+        cnn_model.fit_model_from_tfrecords(args.tf_dir,
+                                           batch_size=args.batch_size or 8,
+                                           epochs=args.epochs,
+                                           cache=args.cache)
+    else:
+        data, labels = cnn_model.load_split('train', args.npy_dir)
+        val_data, val_labels = cnn_model.load_split('val', args.npy_dir)
+        cnn_model.fit_model(data, labels,
+                            batch_size=args.batch_size or 8,
+                            epochs=args.epochs,
+                            val_data=val_data,
+                            val_labels=val_labels)
+
+
+def run_score(args):
+    '''
+    Scores new TCEs with a trained model (main_scoring).
+    '''
+
+    import score_tces
+
+    flux_kwargs = {'fold_backend': args.fold_backend, 'reader': args.reader,
+                   'flatten_backend': args.flatten_backend}
+    if args.cache_dir:
+        from flux_cache import FluxCache
+        flux_kwargs['cache'] = FluxCache(args.cache_dir)
+
+    score_tces.main_scoring(args.source,
+                            model_file=args.model,
+                            out_file=args.out,
+                            batch_size=args.batch_size,
+                            n_workers=args.workers,
+                            kepids_file=args.kepids_file,
+                            labels_file=args.labels_file,
+                            **flux_kwargs)
+
+
+def run_export(args):
+    '''
+    Exports the trained model for CPU inference and compares accuracy
+        and latency of the exported models (main_export).
+    '''
+
+    import model_export
+
+    model_export.main_export(model_file=args.model,
+                             out_dir=args.out_dir,
+                             quantizations=args.quantize,
+                             saved_model=not args.no_saved_model,
+                             tf_dir=args.tf_dir,
+                             store_file=args.store,
+                             npy_dir=args.npy_dir,
+                             calibration_samples=args.calibration_samples,
+                             eval_split=args.eval_split,
+                             eval_samples=args.eval_samples,
+                             batch_size=args.batch_size,
+                             num_threads=args.threads,
+                             seed=args.seed)
+
+
+def run_render(args):
+    '''
+    Draws the processed light curves into PNG pages (render_pages).
+    '''
+
+    import render
+    import numpy as np
+    import pandas as pd
+
+    store = None
+    if args.store:
+        from flux_store import FluxStore
+        store = FluxStore(args.store)
+        data = store.flux
+        labels = store.labels[:]
+        kepid_labels = store.kepid_labels()
+        tce_data = store.tce_data()
+    else:
+        data = np.load(os.path.join(args.data_dir, 'flux_data.npy'),
+                       mmap_mode='r')
+        labels = np.load(os.path.join(args.data_dir, 'flux_labels.npy'))
+        kepid_labels = np.load(os.path.join(args.data_dir,
+                                            'flux_kepid_labels.npy'))
+        tce_data = pd.read_csv(os.path.join(args.data_dir,
+                                            'flux_tce_order.csv'))
+
+    ## Processed rows only, optionally of one split
+    rows = np.flatnonzero(labels >= 0)
+    if args.split:
+        from tfrecords_creation import split_indices
+        rows = split_indices(kepid_labels[:, 0].astype(np.int64), labels,
+                             seed=args.seed)[args.split]
+
+    scores = None
+    if args.scores:
+        scores = render.read_scores(args.scores, tce_data)
+
+    rows = render.select_rows(kepid_labels, label=args.label, scores=scores,
+                              min_score=args.min_score,
+                              max_score=args.max_score, rows=rows,
+                              sort_by_score=args.sort_by_score)
+    try:
+        files = render.render_pages(
+            data, kepid_labels, out_dir=args.out_dir, rows=rows,
+            scores=scores, plnt_nums=tce_data['tce_plnt_num'].values,
+            nrows=args.rows, ncols=args.columns, n_workers=args.workers,
+            dpi=args.dpi, log_format=args.log_format)
+    finally:
+        if store is not None:
+            store.close()
+    print('Rendered {} light curves on {} pages in {}'.format(
+        len(rows), len(files), args.out_dir))
+
+
+def run_bench_imports(args):
+    '''
+    Measures the import time of the pipeline modules.
+    '''
+
+    import benchmarks
+
+    benchmarks.benchmark_import_time(repeats=args.repeats,
+                                     check_budget=args.check)
+
+
+def run_bench(args):
+    '''
+    Times every stage of the pipeline on synthetic light curves
+        (run_benchmark_suite), optionally comparing to an earlier run.
+    '''
+
+    import benchmarks
+
+    benchmarks.run_benchmark_suite(work_dir=args.work_dir,
+                                   n_kepids=args.kepids,
+                                   n_workers=args.workers,
+                                   train_steps=args.train_steps,
+                                   results_file=args.out,
+                                   fold_backend=args.fold_backend,
+                                   reader=args.reader,
+                                   flatten_backend=args.flatten_backend)
+    if args.compare:
+        regressions = benchmarks.compare_benchmarks(args.compare, args.out)
+        if regressions:
+            sys.exit(1)
+
+
+################
+## Argument parsing
+####
+
+def _add_flux_arguments(parser):
+    parser.add_argument('--fold-backend', default='lightkurve',
+                        choices=['lightkurve', 'numpy'])
+    parser.add_argument('--reader', default='lightkurve',
+                        choices=['lightkurve', 'fits'])
+    parser.add_argument('--flatten-backend', default='lightkurve',
+                        choices=['lightkurve', 'numpy'],
+                        help='numpy flattens all quarters of a kepid at once')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of the processed light curve cache')
+
+
+def _add_log_arguments(parser):
+    parser.add_argument('--log-format', default='text',
+                        choices=['text', 'json'],
+                        help='json writes one progress object per line')
+
+
+def build_parser():
+    '''
+    Returns the argparse parser of the command line interface.
+    '''
+
+    parser = argparse.ArgumentParser(
+        prog='cli.py',
+        description='Kepler TCE processing, training and scoring pipeline.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    ## process
+    process = commands.add_parser(
+        'process', help='clean and fold the light curves of a TCE csv')
+    process.add_argument('csv_file')
+    process.add_argument('--workers', type=int, default=1)
+    process.add_argument('--max-in-flight', type=int, default=None)
+    process.add_argument('--out-dir', default='.')
+    process.add_argument('--resume', action='store_true')
+    process.add_argument('--retry-failed', action='store_true')
+    process.add_argument('--incremental', action='store_true',
+                         help='only process TCEs that are new or changed '
+                              'since the last run in --out-dir')
+    process.add_argument('--cache-max-gb', type=float, default=2.)
+    process.add_argument('--data-dir', default='data')
+    process.add_argument('--manifest', default=None,
+                         help='SQLite manifest of the fits files to use')
+    process.add_argument('--mirror', default=None,
+                         help='URL or directory of a MAST mirror to fetch '
+                              'the fits files from into --data-dir')
+    process.add_argument('--fetch-concurrency', type=int, default=8,
+                         help='fits files fetched at once from --mirror')
+    process.add_argument('--fetch-retries', type=int, default=3)
+    process.add_argument('--fetch-lookahead', type=int, default=32,
+                         help='kepids fetched ahead of the one processed')
+    process.add_argument('--views', action='store_true',
+                         help='fold every TCE once into a global and a '
+                              'local view (flux_data.npy, flux_local.npy)')
+    process.add_argument('--store', default=None,
+                         help='also pack the flux store into this HDF5 file')
+    process.add_argument('--window-length', type=int, default=101,
+                         help='window of the flattening filter')
+    process.add_argument('--profile', default=None,
+                         choices=['cprofile', 'tracemalloc'],
+                         help='profile the run (use with --workers 1)')
+    _add_flux_arguments(process)
+    _add_log_arguments(process)
+    process.add_argument('--progress-interval', type=float, default=10.,
+                         help='seconds between two progress reports')
+    process.set_defaults(function=run_process)
+
+    ## tfrecords
+    tfrecords = commands.add_parser(
+        'tfrecords', help='write the processed flux as tfrecords')
+    tfrecords.add_argument('--data-dir', default='.',
+                           help='directory holding flux_data.npy etc.')
+    tfrecords.add_argument('--store', default=None,
+                           help='read the flux from this HDF5 store '
+                                'instead of --data-dir')
+    tfrecords.add_argument('--tf-dir', default='tfrecords')
+    tfrecords.add_argument('--shards', type=int, default=1)
+    tfrecords.add_argument('--compression', default=None,
+                           choices=['GZIP', 'ZLIB'])
+    tfrecords.add_argument('--flux-dtype', default=None,
+                           choices=['float64', 'float32', 'float16'])
+    tfrecords.add_argument('--workers', type=int, default=1)
+    tfrecords.add_argument('--seed', type=int, default=0,
+                           help='seed of the hash assigning kepids to splits')
+    tfrecords.add_argument('--stratify', action='store_true',
+                           help='split every label in the same proportions')
+    tfrecords.add_argument('--incremental', action='store_true',
+                           help='hash-based splits; only rewrite the '
+                                'shards whose TCEs changed')
+    _add_log_arguments(tfrecords)
+    tfrecords.set_defaults(function=run_tfrecords)
+
+    ## train
+    train = commands.add_parser('train', help='train cnn_model')
+    train.add_argument('--tf-dir', default=None,
+                       help='train from these tfrecords instead of npy arrays')
+    train.add_argument('--store', default=None,
+                       help='train from this HDF5 flux store')
+    train.add_argument('--npy-dir', default='npy_arrays')
+    train.add_argument('--batch-size', type=int, default=None,
+                       help='default 8, or 64 (per worker) with --cpu')
+    train.add_argument('--epochs', type=int, default=5)
+    train.add_argument('--cache', action='store_true',
+                       help='cache the tfrecords in memory after one epoch')
+    train.add_argument('--cpu', action='store_true',
+                       help='CPU training mode: thread pools, large batches '
+                            'with a learning rate warmup, throughput stats')
+    train.add_argument('--workers', type=int, default=1,
+                       help='data-parallel worker processes (with --cpu)')
+    train.add_argument('--intra-op-threads', type=int, default=None)
+    train.add_argument('--inter-op-threads', type=int, default=None)
+    train.add_argument('--warmup-epochs', type=int, default=1)
+    train.set_defaults(function=run_train)
+
+    ## score
+    score = commands.add_parser(
+        'score', help='score new TCEs with a trained model')
+    score.add_argument('source', help='TCE csv or processed .npy flux array')
+    score.add_argument('--model', default='model.h5',
+                       help='HDF5 or .tflite model (see export)')
+    score.add_argument('--out', default='scores.csv')
+    score.add_argument('--batch-size', type=int, default=256)
+    score.add_argument('--workers', type=int, default=1)
+    score.add_argument('--kepids-file', default='flux_kepids.npy')
+    score.add_argument('--labels-file', default=None,
+                       help='labels of a .npy source (default: '
+                            'flux_labels.npy next to it); unprocessed '
+                            'rows are not scored')
+    _add_flux_arguments(score)
+    score.set_defaults(function=run_score)
+
+    ## export
+    export = commands.add_parser(
+        'export', help='export the model to SavedModel and TFLite, '
+                       'optionally quantized, with an accuracy and '
+                       'latency report')
+    export.add_argument('--model', default='model.h5')
+    export.add_argument('--out-dir', default='export')
+    export.add_argument('--quantize', nargs='+', default=['float32', 'dynamic',
+                                                          'int8'],
+                        choices=['float32', 'dynamic', 'int8'],
+                        help='TFLite models to write; int8 is calibrated '
+                             'on the validation split')
+    export.add_argument('--no-saved-model', action='store_true')
+    export.add_argument('--tf-dir', default=None,
+                        help='read the splits from these tfrecords')
+    export.add_argument('--store', default=None,
+                        help='read the splits from this HDF5 flux store')
+    export.add_argument('--npy-dir', default=None,
+                        help='read the splits from these npy arrays')
+    export.add_argument('--calibration-samples', type=int, default=256)
+    export.add_argument('--eval-split', default='test',
+                        choices=['train', 'val', 'test'])
+    export.add_argument('--eval-samples', type=int, default=None)
+    export.add_argument('--batch-size', type=int, default=256)
+    export.add_argument('--threads', type=int, default=None,
+                        help='threads of the TFLite interpreter')
+    export.add_argument('--seed', type=int, default=0,
+                        help='seed of the store splits and the sampling')
+    export.set_defaults(function=run_export)
+
+    ## render
+    render = commands.add_parser(
+        'render', help='draw the processed light curves into PNG pages')
+    render.add_argument('--data-dir', default='.',
+                        help='directory holding flux_data.npy etc.')
+    render.add_argument('--store', default=None,
+                        help='read the flux from this HDF5 store instead')
+    render.add_argument('--out-dir', default='pages')
+    render.add_argument('--split', default=None,
+                        choices=['train', 'val', 'test'],
+                        help='only render this split (kepid hash splits)')
+    render.add_argument('--seed', type=int, default=0,
+                        help='seed of the splits, see tfrecords --seed')
+    render.add_argument('--label', default=None, nargs='+',
+                        help='only render these labels, e.g. PC AFP')
+    render.add_argument('--scores', default=None,
+                        help='scores csv written by score')
+    render.add_argument('--min-score', type=float, default=None)
+    render.add_argument('--max-score', type=float, default=None)
+    render.add_argument('--sort-by-score', action='store_true')
+    render.add_argument('--rows', type=int, default=4,
+                        help='rows of panels per page')
+    render.add_argument('--columns', type=int, default=5,
+                        help='columns of panels per page')
+    render.add_argument('--dpi', type=int, default=100)
+    render.add_argument('--workers', type=int, default=1)
+    _add_log_arguments(render)
+    render.set_defaults(function=run_render)
+
+    ## bench-imports
+    bench = commands.add_parser(
+        'bench-imports', help='measure the import time of every module')
+    bench.add_argument('--repeats', type=int, default=3)
+    bench.add_argument('--check', action='store_true',
+                       help='fail if a module exceeds its time budget')
+    bench.set_defaults(function=run_bench_imports)
+
+    ## bench
+    suite = commands.add_parser(
+        'bench', help='time the pipeline on synthetic light curves')
+    suite.add_argument('--work-dir', default='synthetic')
+    suite.add_argument('--kepids', type=int, default=50)
+    suite.add_argument('--workers', type=int, default=1)
+    suite.add_argument('--train-steps', type=int, default=20)
+    suite.add_argument('--out', default='benchmark_results.json')
+    suite.add_argument('--compare', default=None,
+                       help='earlier results json; exit 1 on a regression')
+    suite.add_argument('--fold-backend', default='lightkurve',
+                       choices=['lightkurve', 'numpy'])
+    suite.add_argument('--reader', default='lightkurve',
+                       choices=['lightkurve', 'fits'])
+    suite.add_argument('--flatten-backend', default='lightkurve',
+                       choices=['lightkurve', 'numpy'])
+    suite.set_defaults(function=run_bench)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.function(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,91 +2,151 @@
 ## Packages to be used
 ####
 
-from keras.models import load_model
-from keras.optimizers import Adam
-import matplotlib.pyplot as plt
-import tensorflow as tf
+## tensorflow is slow to import, so it is only imported inside the
+## methods that use it. The arrays and the model are also only loaded
+## and built when first used (see __getattr__ at the bottom).
+import multiprocessing
 import numpy as np
+import json
+import time
+import os
 
 ################
 ## Loading array data
 ####
 
-## Function to print 
+## Function to print
 def print_shapes(train, val, test):
     print('Train shape: {}'.format(train.shape))
     print('Val shape  : {}'.format(val.shape))
     print('Test shape : {}'.format(test.shape))
 
-## Load the flux data and labels 
-train_flux_data = np.load("npy_arrays/train_data.npy")
-train_label = np.load("npy_arrays/train_labels.npy")
-val_flux_data = np.load("npy_arrays/val_data.npy")
-val_label = np.load("npy_arrays/val_labels.npy")
-test_flux_data = np.load("npy_arrays/test_data.npy")
-test_label = np.load("npy_arrays/test_labels.npy")
-print('Original Arrays')
-print_shapes(train_flux_data, val_flux_data, test_flux_data)
-
-## Reshaping for the model
-print('\nReshaped Arrays')
-train_flux_data = train_flux_data.reshape(train_flux_data.shape[0], train_flux_data.shape[1], 1)
-val_flux_data = val_flux_data.reshape(val_flux_data.shape[0], val_flux_data.shape[1], 1)
-test_flux_data = test_flux_data.reshape(test_flux_data.shape[0], test_flux_data.shape[1], 1)
-print_shapes(train_flux_data, test_flux_data, val_flux_data)
+## Load the flux data and labels of one split, reshaped for the model
+def load_split(split, npy_dir='npy_arrays', mmap_mode=None):
+    flux_data = np.load(npy_dir+'/'+split+'_data.npy', mmap_mode=mmap_mode)
+    labels = np.load(npy_dir+'/'+split+'_labels.npy', mmap_mode=mmap_mode)
+    flux_data = flux_data.reshape(flux_data.shape[0], flux_data.shape[1], 1)
+    return flux_data, labels
+
+## Load the flux data and labels of all splits
+def load_arrays(npy_dir='npy_arrays'):
+    train_flux_data, train_label = load_split('train', npy_dir)
+    val_flux_data, val_label = load_split('val', npy_dir)
+    test_flux_data, test_label = load_split('test', npy_dir)
+    print('Reshaped Arrays')
+    print_shapes(train_flux_data, val_flux_data, test_flux_data)
+    return (train_flux_data, train_label, val_flux_data, val_label,
+            test_flux_data, test_label)
 
 ################
 ## Defining the model
 ####
 
-#activation=tf.nn.relu
-model = tf.keras.Sequential([
-    tf.keras.layers.InputLayer(input_shape=(2001, 1)),
-    tf.keras.layers.Conv1D(filters=16, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.Conv1D(filters=16, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
-    tf.keras.layers.Dropout(rate=0.2),
-    tf.keras.layers.Conv1D(filters=32, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.Conv1D(filters=32, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
-    tf.keras.layers.Dropout(rate=0.2),
-    tf.keras.layers.Conv1D(filters=64, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.Conv1D(filters=64, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
-    tf.keras.layers.Dropout(rate=0.2),
-    tf.keras.layers.Conv1D(filters=128, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.Conv1D(filters=128, kernel_size=5, activation=tf.nn.relu),
-    tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
-    tf.keras.layers.Dropout(rate=0.2),
-    tf.keras.layers.Flatten(),
-    tf.keras.layers.Dense(512, activation=tf.nn.relu),
-    tf.keras.layers.Dense(512, activation=tf.nn.relu),
-    tf.keras.layers.Dense(512, activation=tf.nn.relu),
-    tf.keras.layers.Dense(512, activation=tf.nn.relu),
-    tf.keras.layers.Dense(1, activation=tf.nn.sigmoid),
-])
+## Builds a new (uncompiled) model
+def build_model():
+    import tensorflow as tf
+
+    #activation=tf.nn.relu
+    return tf.keras.Sequential([
+        tf.keras.layers.InputLayer(input_shape=(2001, 1)),
+        tf.keras.layers.Conv1D(filters=16, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.Conv1D(filters=16, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
+        tf.keras.layers.Dropout(rate=0.2),
+        tf.keras.layers.Conv1D(filters=32, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.Conv1D(filters=32, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
+        tf.keras.layers.Dropout(rate=0.2),
+        tf.keras.layers.Conv1D(filters=64, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.Conv1D(filters=64, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
+        tf.keras.layers.Dropout(rate=0.2),
+        tf.keras.layers.Conv1D(filters=128, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.Conv1D(filters=128, kernel_size=5, activation=tf.nn.relu),
+        tf.keras.layers.MaxPooling1D(pool_size=5, strides=2),
+        tf.keras.layers.Dropout(rate=0.2),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(512, activation=tf.nn.relu),
+        tf.keras.layers.Dense(512, activation=tf.nn.relu),
+        tf.keras.layers.Dense(512, activation=tf.nn.relu),
+        tf.keras.layers.Dense(512, activation=tf.nn.relu),
+        tf.keras.layers.Dense(1, activation=tf.nn.sigmoid),
+    ])
+
+## The model trained by fit_model, built on first use
+_model = None
+
+def get_model():
+    global _model
+    if _model is None:
+        _model = build_model()
+    return _model
 
 
 ################
 ## Compiling the model
 ####
 
-## Compiles, displays, fits, and saves the model
-def fit_model(data, labels, batch_size=8, epochs=5):
+## Compiles the model
+def compile_model(model=None, learning_rate=0.0001):
+    import tensorflow as tf
 
-    ## Compiling the model
-    model.compile(optimizer = tf.keras.optimizers.Adam(lr=0.0001, epsilon=1e-08),
+    if model is None:
+        model = get_model()
+    model.compile(optimizer = tf.keras.optimizers.Adam(lr=learning_rate, epsilon=1e-08),
                   loss='mse',
                   metrics=['accuracy'])
+    return model
+
+## Compiles, displays, fits, and saves the model
+## The validation arrays are loaded from npy_arrays/ if not given
+def fit_model(data, labels, batch_size=8, epochs=5,
+              val_data=None, val_labels=None):
+
+    if val_data is None:
+        val_data, val_labels = load_split('val')
+
+    ## Compiling the model
+    model = compile_model()
+
+    ## Displaying the model's summary
+    print(model.summary())
+
+    ## Fit the model and save the output
+    history = model.fit(data,
+                        labels,
+                        validation_data=(val_data, val_labels),
+                        batch_size=batch_size,
+                        epochs=epochs)
+
+    ## Saving the model as an HDF5 file
+    model.save('model.h5')
+
+    ## Return model history object
+    return history
+
+
+## Compiles, displays, fits, and saves the model, streaming the
+## tfrecords written by main_tfrecords_creation instead of npy arrays
+def fit_model_from_tfrecords(tf_dir='tfrecords', batch_size=8, epochs=5,
+                             shuffle_buffer=10000, cache=False):
+    from tfrecords_creation import load_dataset
+
+    ## Input pipelines for training and validation
+    train_dataset = load_dataset(tf_dir, 'train', batch_size=batch_size,
+                                 shuffle_buffer=shuffle_buffer, cache=cache)
+    val_dataset = load_dataset(tf_dir, 'val', batch_size=batch_size,
+                               shuffle_buffer=0, cache=cache)
+
+    ## Compiling the model
+    model = compile_model()
 
     ## Displaying the model's summary
     print(model.summary())
 
     ## Fit the model and save the output
-    history = model.fit(data, 
-                        labels, 
-                        validation_data=(val_flux_data, val_label), 
-                        batch_size=batch_size, 
+    history = model.fit(train_dataset,
+                        validation_data=val_dataset,
                         epochs=epochs)
 
     ## Saving the model as an HDF5 file
@@ -94,3 +154,262 @@ def fit_model(data, labels, batch_size=8, epochs=5):
 
     ## Return model history object
     return history
+
+
+## Keras Sequence of (flux, label) batches of the given rows of a
+## flux_store.FluxStore, read from the HDF5 file one batch at a time.
+## The rows are shuffled after every epoch if shuffle is set.
+def store_sequence(store, rows, batch_size=8, shuffle=True, seed=0):
+    import tensorflow as tf
+
+    class StoreSequence(tf.keras.utils.Sequence):
+
+        def __init__(self):
+            self.rows = np.array(rows, dtype=np.int64)
+            self.random = np.random.RandomState(seed)
+            if shuffle:
+                self.random.shuffle(self.rows)
+
+        def __len__(self):
+            return int(np.ceil(len(self.rows) / float(batch_size)))
+
+        def __getitem__(self, i):
+            ## h5py only reads increasing rows; the order within a
+            ## batch does not matter
+            batch = np.sort(self.rows[i*batch_size:(i+1)*batch_size])
+            flux_data = store.flux[batch]
+            labels = store.labels[batch].astype(np.float32)
+            return flux_data.reshape(len(batch), -1, 1), labels
+
+        def on_epoch_end(self):
+            if shuffle:
+                self.random.shuffle(self.rows)
+
+    return StoreSequence()
+
+## Compiles, displays, fits, and saves the model, reading the batches
+## from the HDF5 flux store (see flux_store.write_store) instead of
+## loading the arrays. The splits are the kepid hash splits of the
+## tfrecords (see tfrecords_creation.split_indices).
+def fit_model_from_store(store_file='flux_store.h5', batch_size=8, epochs=5,
+                         seed=0, model_file='model.h5'):
+    from flux_store import FluxStore
+    from tfrecords_creation import split_indices
+
+    with FluxStore(store_file) as store:
+        ## Train and validation rows (unprocessed rows are left out)
+        rows = split_indices(store.kepids[:], store.labels[:], seed=seed)
+        train_sequence = store_sequence(store, rows['train'], batch_size,
+                                        seed=seed)
+        val_sequence = store_sequence(store, rows['val'], batch_size,
+                                      shuffle=False)
+
+        ## Compiling the model
+        model = compile_model()
+
+        ## Displaying the model's summary
+        print(model.summary())
+
+        ## Fit the model and save the output (h5py reads from one thread)
+        history = model.fit_generator(train_sequence,
+                                      validation_data=val_sequence,
+                                      epochs=epochs,
+                                      workers=1,
+                                      use_multiprocessing=False)
+
+    ## Saving the model as an HDF5 file
+    model.save(model_file)
+
+    ## Return model history object
+    return history
+
+
+################
+## Training on CPU-only machines
+####
+
+## Sets the size of TensorFlow's thread pools: intra-op threads run the
+## inside of one op (e.g. a convolution), inter-op threads run
+## independent ops, including the input pipeline, at the same time.
+## None keeps TensorFlow's default (one thread per core). Must be
+## called before TensorFlow runs anything.
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    import tensorflow as tf
+
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+## Learning rate of every epoch for a given batch size: the rate of
+## compile_model (tuned for batches of 8) scaled linearly with the
+## batch size, reached after warmup_epochs epochs starting from the
+## unscaled rate, so that large batches do not diverge early on
+def learning_rate_schedule(batch_size, base_rate=0.0001, base_batch_size=8,
+                           warmup_epochs=1):
+    peak_rate = base_rate * batch_size / float(base_batch_size)
+
+    def schedule(epoch):
+        if epoch < warmup_epochs:
+            return base_rate + (peak_rate - base_rate) * epoch / float(warmup_epochs)
+        return peak_rate
+
+    return schedule
+
+## Keras callback timing every epoch, printing the epoch time and the
+## samples per second, and adding both to the history of the fit
+def throughput_callback(samples_per_epoch, verbose=True):
+    import tensorflow as tf
+
+    class ThroughputCallback(tf.keras.callbacks.Callback):
+
+        def __init__(self):
+            super(ThroughputCallback, self).__init__()
+            self.epochs = []
+            self._start = None
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self._start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            ## Validation is included in the epoch time
+            seconds = time.perf_counter() - self._start
+            stats = {'epoch': epoch,
+                     'seconds': seconds,
+                     'samples_per_second': samples_per_epoch / seconds}
+            if logs is not None:
+                logs['epoch_seconds'] = seconds
+                logs['samples_per_second'] = stats['samples_per_second']
+                stats.update((key, float(value)) for key, value in logs.items())
+            self.epochs.append(stats)
+            if verbose:
+                print('Epoch {}: {:.1f} s, {:.1f} samples/s'.format(
+                    epoch + 1, seconds, stats['samples_per_second']))
+
+    return ThroughputCallback()
+
+## Compiles, displays, fits, and saves the model on a CPU-only machine,
+## streaming the tfrecords written by main_tfrecords_creation. The input
+## pipeline (load_dataset) reads, parses and prefetches the next batches
+## on the inter-op threads while the current batch is trained on the
+## intra-op threads. Batches are larger than fit_model's, with the
+## learning rate of learning_rate_schedule. The epoch times and samples
+## per second are printed and written to stats_file (json).
+## With num_workers > 1 (see train_cpu_workers), every worker process
+## trains a replica on its own tfrecords shards and the gradients are
+## averaged across processes; batch_size is then per worker.
+def fit_model_cpu(tf_dir='tfrecords', batch_size=64, epochs=5,
+                  intra_op_threads=None, inter_op_threads=None,
+                  warmup_epochs=1, shuffle_buffer=10000, cache=False,
+                  model_file='model.h5', stats_file='training_stats.json',
+                  num_workers=1, is_chief=True):
+    configure_threads(intra_op_threads, inter_op_threads)
+
+    import tensorflow as tf
+    from tfrecords_creation import load_dataset, read_manifest
+
+    ## The strategy has to exist before any other op is created
+    strategy = None
+    if num_workers > 1:
+        strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    global_batch_size = batch_size * num_workers
+
+    ## Input pipelines for training and validation
+    train_dataset = load_dataset(tf_dir, 'train', batch_size=global_batch_size,
+                                 shuffle_buffer=shuffle_buffer, cache=cache)
+    val_dataset = load_dataset(tf_dir, 'val', batch_size=global_batch_size,
+                               shuffle_buffer=0, cache=cache)
+
+    ## Compiling the model (a replica per worker when distributed)
+    schedule = learning_rate_schedule(global_batch_size,
+                                      warmup_epochs=warmup_epochs)
+    if strategy is None:
+        model = compile_model(learning_rate=schedule(0))
+    else:
+        with strategy.scope():
+            model = compile_model(build_model(), learning_rate=schedule(0))
+
+    ## Displaying the model's summary
+    if is_chief:
+        print(model.summary())
+
+    ## Fit the model, timing every epoch
+    manifest = read_manifest(tf_dir)
+    throughput = throughput_callback(manifest['train']['total_records'],
+                                     verbose=is_chief)
+    history = model.fit(train_dataset,
+                        validation_data=val_dataset,
+                        epochs=epochs,
+                        callbacks=[tf.keras.callbacks.LearningRateScheduler(schedule),
+                                   throughput],
+                        verbose=2 if is_chief else 0)
+
+    ## Saving the model as an HDF5 file, and the throughput of every epoch
+    if is_chief:
+        model.save(model_file)
+        with open(stats_file, 'w') as f:
+            json.dump({'batch_size': batch_size,
+                       'global_batch_size': global_batch_size,
+                       'num_workers': num_workers,
+                       'intra_op_threads': intra_op_threads,
+                       'inter_op_threads': inter_op_threads,
+                       'epochs': throughput.epochs}, f, indent=2)
+
+    ## Return model history object
+    return history
+
+## Runs in every worker process of train_cpu_workers
+def _cpu_training_worker(index, num_workers, base_port, kwargs):
+    os.environ['TF_CONFIG'] = json.dumps({
+        'cluster': {'worker': ['localhost:{}'.format(base_port + i)
+                               for i in range(num_workers)]},
+        'task': {'type': 'worker', 'index': index},
+    })
+    fit_model_cpu(num_workers=num_workers, is_chief=index == 0, **kwargs)
+
+## Data-parallel training across num_workers local processes (see
+## fit_model_cpu). Every process gets an equal share of the cores unless
+## intra_op_threads is given. The tfrecords should have at least
+## num_workers shards per split, since workers split them by file.
+## Only the first worker (the chief) saves the model and the stats.
+def train_cpu_workers(num_workers=2, base_port=23456, **kwargs):
+    if num_workers <= 1:
+        return fit_model_cpu(**kwargs)
+
+    if not kwargs.get('intra_op_threads'):
+        kwargs['intra_op_threads'] = max(
+            multiprocessing.cpu_count() // num_workers, 1)
+
+    ## spawn, so that no worker inherits an initialized TensorFlow
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_cpu_training_worker,
+                               args=(index, num_workers, base_port, kwargs))
+               for index in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [index for index, worker in enumerate(workers)
+              if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError('Training workers {} failed'.format(failed))
+
+
+################
+## Lazy module attributes
+####
+
+## Names of the arrays that used to be loaded at import time
+_ARRAY_NAMES = ('train_flux_data', 'train_label', 'val_flux_data',
+                'val_label', 'test_flux_data', 'test_label')
+
+## Keeps cnn_model.model and cnn_model.train_flux_data (etc.) working,
+## building the model or loading the arrays only when first accessed
+def __getattr__(name):
+    if name == 'model':
+        return get_model()
+    if name in _ARRAY_NAMES:
+        globals().update(zip(_ARRAY_NAMES, load_arrays()))
+        return globals()[name]
+    raise AttributeError("module 'cnn_model' has no attribute '{}'".format(name))
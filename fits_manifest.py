@@ -0,0 +1,203 @@
+################
+## Packages to be used
+####
+
+import sqlite3
+import os
+
+################
+## Manifest of the downloaded fits files
+####
+
+class FitsManifest(object):
+    '''
+    The FitsManifest class keeps a kepid -> fits files table in a small
+        SQLite file, so that the data/ tree only has to be walked once
+        instead of once per kepid.
+
+    The data/ tree is expected to look like data/<prefix>/<kepid>/, as
+        downloaded from MAST. refresh only lists the kepid directories
+        whose mtime changed since the last scan, so newly downloaded
+        quarters are picked up without rescanning everything.
+
+    Args:
+        manifest_file: str; location of the SQLite file.
+            Default = 'fits_manifest.sqlite'
+        data_dir: str; root of the downloaded fits files.
+            Default = 'data'
+    '''
+
+    def __init__(self, manifest_file='fits_manifest.sqlite', data_dir='data'):
+        self.manifest_file = manifest_file
+        self.data_dir = data_dir
+        self._connection = None
+
+    def __getstate__(self):
+        ## SQLite connections cannot be sent to worker processes;
+        ## every process opens its own one instead
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.manifest_file)
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY,
+                    kepid INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS files (
+                    kepid INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY (kepid, path));
+            ''')
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _scan_kepid_dirs(self):
+        '''
+        Returns {path: (kepid, mtime_ns)} for every kepid directory
+            currently under data_dir.
+        '''
+
+        kepid_dirs = {}
+        if os.path.isdir(self.data_dir) == False:
+            return kepid_dirs
+
+        for prefix in os.scandir(self.data_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.is_dir() and entry.name.isdigit():
+                    kepid_dirs[entry.path] = (int(entry.name),
+                                              entry.stat().st_mtime_ns)
+        return kepid_dirs
+
+    def refresh(self):
+        '''
+        The refresh method brings the manifest up to date with data_dir.
+        Only new or modified kepid directories are listed again.
+
+        Returns:
+            changes: dict; number of kepid directories added, updated
+                and removed.
+        '''
+
+        current = self._scan_kepid_dirs()
+        known = dict((path, (kepid, mtime_ns)) for path, kepid, mtime_ns in
+                     self.connection.execute(
+                         'SELECT path, kepid, mtime_ns FROM dirs'))
+
+        changes = {'added': 0, 'updated': 0, 'removed': 0}
+        with self.connection:
+            ## Dropping kepid directories that no longer exist
+            for path in set(known) - set(current):
+                kepid = known[path][0]
+                self.connection.execute(
+                    'DELETE FROM files WHERE kepid = ?', (kepid,))
+                self.connection.execute(
+                    'DELETE FROM dirs WHERE path = ?', (path,))
+                changes['removed'] += 1
+
+            ## Listing kepid directories that are new or have changed
+            for path, (kepid, mtime_ns) in current.items():
+                if path in known:
+                    if known[path][1] == mtime_ns:
+                        continue
+                    changes['updated'] += 1
+                else:
+                    changes['added'] += 1
+
+                fits_files = walk_kepid_dir(path, kepid)
+                self.connection.execute(
+                    'DELETE FROM files WHERE kepid = ?', (kepid,))
+                self.connection.executemany(
+                    'INSERT INTO files (kepid, path) VALUES (?, ?)',
+                    [(kepid, f) for f in fits_files])
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO dirs (path, kepid, mtime_ns) '
+                    'VALUES (?, ?, ?)', (path, kepid, mtime_ns))
+
+        return changes
+
+    def lookup(self, kepid):
+        '''
+        The lookup method returns the fits files of a kepid.
+
+        Args:
+            kepid: Object of interest.
+
+        Returns:
+            fits_files: Sorted list of all fits files corresponding to
+                the kepid, or None if the kepid is not in the manifest.
+        '''
+
+        fits_files = [row[0] for row in self.connection.execute(
+            'SELECT path FROM files WHERE kepid = ? ORDER BY path',
+            (int(kepid),))]
+        if len(fits_files) == 0:
+            return None
+        return fits_files
+
+    def kepids(self):
+        '''
+        Returns a sorted list of every kepid in the manifest.
+        '''
+
+        return [row[0] for row in self.connection.execute(
+            'SELECT DISTINCT kepid FROM files ORDER BY kepid')]
+
+
+def walk_kepid_dir(path, kepid):
+    '''
+    The walk_kepid_dir function lists the fits files of a single kepid
+        directory.
+
+    Args:
+        path: str; directory of the kepid (data/<prefix>/<kepid>/).
+        kepid: Object of interest.
+
+    Returns:
+        fits_files: Sorted list of all fits files corresponding to
+            the kepid.
+    '''
+
+    kepid = str(kepid).zfill(9)
+
+    ## r=root, d=directories, f = files
+    fits_files = []
+    for r, d, f in os.walk(path):
+        for file in f:
+            if 'kplr'+kepid in file:
+                fits_files.append(os.path.join(r, file))
+
+    return sorted(fits_files)
+
+
+def build_manifest(data_dir='data', manifest_file='fits_manifest.sqlite'):
+    '''
+    The build_manifest function creates (or updates) the manifest of
+        all fits files under data_dir.
+
+    Args:
+        data_dir: str; root of the downloaded fits files.
+            Default = 'data'
+        manifest_file: str; location of the SQLite file.
+            Default = 'fits_manifest.sqlite'
+
+    Returns:
+        manifest: FitsManifest, ready to be passed to get_kepid_files.
+    '''
+
+    manifest = FitsManifest(manifest_file, data_dir)
+    changes = manifest.refresh()
+    print('Manifest {}: {} added, {} updated, {} removed kepids'.format(
+        manifest_file, changes['added'], changes['updated'],
+        changes['removed']))
+    return manifest
@@ -0,0 +1,65 @@
+################
+## Packages to be used
+####
+
+from astropy.io import fits
+import numpy as np
+import collections
+
+################
+## Lightweight reader for Kepler light curve fits files
+####
+
+## lightkurve's default Kepler quality bitmask: AttitudeTweak, SafeMode,
+## CoarsePoint, EarthPoint, Desat, ManualExclude, DetectorAnomaly,
+## NoData and ThrusterFiring
+DEFAULT_BITMASK = 1130799
+
+## Columns returned by read_pdcsap
+PdcsapData = collections.namedtuple(
+    'PdcsapData', ['time', 'flux', 'flux_err', 'quality'])
+
+
+def read_pdcsap(path, quality_bitmask=DEFAULT_BITMASK, native=False):
+    '''
+    The read_pdcsap function reads TIME, PDCSAP_FLUX, PDCSAP_FLUX_ERR and
+        SAP_QUALITY from a Kepler light curve fits file.
+    The binary table is memory-mapped and only those four columns are
+        touched, instead of building a full LightCurveFile.
+    Cadences are removed the same way lk.search.open(path).PDCSAP_FLUX
+        does it (quality bitmask only; NaN fluxes are kept).
+    Works on one fits file at a time.
+
+    Args:
+        path: str; location of the fits file.
+        quality_bitmask: int; cadences with any of these quality bits
+            set are removed. Default = DEFAULT_BITMASK.
+            None keeps every cadence.
+        native: bool; convert the columns to native byte order.
+            Fits files are big-endian, so this makes a copy. When False
+            and no cadence is removed, the columns are zero-copy views
+            into the memory-mapped file. Default = False.
+
+    Returns:
+        data: PdcsapData with the time, flux, flux_err and quality arrays.
+    '''
+
+    with fits.open(path, memmap=True) as hdul:
+        table = hdul[1].data
+        quality = table.field('SAP_QUALITY')
+
+        ## Only copying when some cadences have to be removed
+        if quality_bitmask is None:
+            select = slice(None)
+        else:
+            good = (quality & quality_bitmask) == 0
+            select = slice(None) if good.all() else good
+
+        columns = [table.field(name)[select] for name in
+                   ('TIME', 'PDCSAP_FLUX', 'PDCSAP_FLUX_ERR', 'SAP_QUALITY')]
+
+    if native:
+        columns = [column.astype(column.dtype.newbyteorder('='), copy=False)
+                   for column in columns]
+
+    return PdcsapData(*columns)
@@ -0,0 +1,268 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+
+################
+## Vectorized Savitzky-Golay flattening of many quarters at once
+####
+
+## lightkurve's LightCurve.flatten detrends one quarter at a time: it
+## sigma clips the flux, splits it into segments at large time gaps,
+## runs scipy's savgol_filter on every segment (or takes the median of
+## segments shorter than the window) and interpolates the trend over
+## the clipped points, niters times. The functions below do the same
+## for any number of quarters (of any number of kepids) in one pass
+## over the concatenated arrays, so the cost no longer grows with the
+## number of LightCurve objects and savgol_filter calls.
+
+
+def savgol_weights(window_length, polyorder):
+    '''
+    The savgol_weights function returns the weights of a Savitzky-Golay
+        filter, as applied by scipy's savgol_filter with mode='interp'.
+
+    Args:
+        window_length: int; odd length of the filter window.
+        polyorder: int; order of the fitted polynomial.
+
+    Returns:
+        center: np.array (window_length,); weights giving the smoothed
+            value at the center of a window.
+        left: np.array (window_length//2, window_length); weights giving
+            the first window_length//2 values of a segment from its
+            first window_length points.
+        right: np.array (window_length//2, window_length); same for the
+            last window_length//2 values of a segment.
+    '''
+
+    if window_length % 2 == 0:
+        raise ValueError('window_length must be odd')
+    polyorder = min(polyorder, window_length - 1)
+    half = window_length // 2
+
+    ## Least squares fit of a polynomial to a window, evaluated at every
+    ## point of the window
+    x = np.arange(window_length, dtype=np.float64) - half
+    vander = np.vander(x, polyorder + 1, increasing=True)
+    projection = vander.dot(np.linalg.pinv(vander))
+
+    return (projection[half], projection[:half],
+            projection[window_length-half:])
+
+
+def group_median(values, groups, n_groups):
+    '''
+    Returns the median of values in every group (NaN for empty groups),
+        the same as np.median on each group. values must be finite.
+    '''
+
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+
+    median = np.full(n_groups, np.nan)
+    has = counts > 0
+    low = (starts + (counts - 1) // 2)[has]
+    high = (starts + counts // 2)[has]
+    median[has] = (values[low] + values[high]) / 2
+    return median
+
+
+def group_std(values, groups, n_groups):
+    '''
+    Returns the standard deviation of values in every group (NaN for
+        empty groups), the same as np.std on each group. values must be
+        finite.
+    '''
+
+    counts = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(groups, weights=values, minlength=n_groups) / counts
+        deviation = values - mean[groups]
+        return np.sqrt(np.bincount(groups, weights=deviation * deviation,
+                                   minlength=n_groups) / counts)
+
+
+def _segment_trend(flux, starts, lengths, window_length, polyorder,
+                   break_tolerance):
+    '''
+    Returns the trend of every segment of flux (segments given by their
+        starts and lengths): savgol_filter for long segments, the median
+        for short ones.
+    '''
+
+    n_segments = len(starts)
+    segment = np.repeat(np.arange(n_segments), lengths)
+    trend = np.empty(len(flux))
+
+    short = lengths < window_length
+    if break_tolerance is not None:
+        short |= lengths < break_tolerance
+
+    ## Long segments: the inside of every segment is one convolution
+    ## over the whole array (the weights are symmetric), and the first
+    ## and last half windows are fitted from the first and last windows
+    if not short.all():
+        center, left, right = savgol_weights(window_length, polyorder)
+        half = window_length // 2
+        trend[:] = np.convolve(flux, center, mode='same')
+
+        long_starts = starts[~short]
+        long_ends = long_starts + lengths[~short]
+        window = np.arange(window_length)
+        edge = np.arange(half)
+        trend[long_starts[:, None] + edge] = flux[
+            long_starts[:, None] + window].dot(left.T)
+        trend[(long_ends - half)[:, None] + edge] = flux[
+            (long_ends - window_length)[:, None] + window].dot(right.T)
+
+    ## Short segments: their median
+    if short.any():
+        in_short = short[segment]
+        median = group_median(flux[in_short], segment[in_short], n_segments)
+        trend[in_short] = median[segment[in_short]]
+
+    return trend
+
+
+def flatten_quarters(time, flux, lengths, window_length=101, polyorder=2,
+                     break_tolerance=5, niters=3, sigma=3, dtype=None):
+    '''
+    The flatten_quarters function computes the trend removed by
+        LightCurve.flatten for many quarters at once.
+    Every quarter is detrended on its own, the same way flatten does
+        it (sigma clipping, gap splitting, short segment medians and
+        interpolation over the clipped points), but all of them go
+        through the same vectorized operations. The trend agrees with
+        flatten's to float rounding. NaN fluxes are left out
+        of the fit and get an interpolated trend.
+    The quarters may belong to any number of kepids.
+
+    Args:
+        time: np.array; times of all quarters, one after the other
+            (increasing within every quarter).
+        flux: np.array; fluxes of all quarters (NaN where missing).
+        lengths: list of int; number of cadences of every quarter.
+        window_length, polyorder, break_tolerance, niters, sigma: see
+            LightCurve.flatten. Defaults = 101, 2, 5, 3, 3.
+        dtype: dtype the fluxes were read as, if they were copied to
+            float64 since. Default = None (flux.dtype).
+
+    Returns:
+        trend: np.array; trend of every cadence (flux / trend is the
+            flattened flux).
+    '''
+
+    time = np.asarray(time, dtype=np.float64)
+    flux = np.asarray(flux)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n_quarters = len(lengths)
+    n = len(flux)
+    quarter = np.repeat(np.arange(n_quarters), lengths)
+
+    ## savgol_filter and np.nanmedian keep float32 fluxes in float32,
+    ## so the trend of every segment is rounded the same way
+    if dtype is None:
+        dtype = flux.dtype
+    rounding = np.float32 if np.dtype(dtype).itemsize == 4 else None
+    flux = flux.astype(np.float64)
+
+    ## No NaNs and no outliers
+    mask = np.isfinite(flux)
+    median = group_median(flux[mask], quarter[mask], n_quarters)
+    std = group_std(flux[mask], quarter[mask], n_quarters)
+    with np.errstate(invalid='ignore'):
+        mask &= np.abs(flux - median[quarter]) <= std[quarter] * sigma
+
+    for _ in range(niters):
+        index = np.flatnonzero(mask)
+        q = quarter[index]
+        t = time[index]
+        f = flux[index]
+
+        ## Segments start at every quarter and at every gap longer than
+        ## break_tolerance times the median time step of the quarter
+        same_quarter = q[1:] == q[:-1]
+        starts = np.ones(len(index), dtype=bool)
+        starts[1:] = ~same_quarter
+        if break_tolerance is not None:
+            dt = t[1:] - t[:-1]
+            dt_median = group_median(dt[same_quarter],
+                                     q[1:][same_quarter], n_quarters)
+            with np.errstate(invalid='ignore'):
+                starts[1:] |= dt > break_tolerance * dt_median[q[1:]]
+        starts = np.flatnonzero(starts)
+        segment_lengths = np.diff(np.append(starts, len(index)))
+
+        trend = _segment_trend(f, starts, segment_lengths, window_length,
+                               polyorder, break_tolerance)
+        if rounding is not None:
+            trend = trend.astype(rounding).astype(np.float64)
+
+        ## No outliers
+        residual = f - trend
+        residual_std = group_std(residual, q, n_quarters)
+        keep = np.abs(residual) < residual_std[q] * sigma
+
+        ## Linear interpolation (and extrapolation) of the trend over
+        ## every cadence, from the points kept in the same quarter
+        kept = index[keep]
+        kept_time = t[keep]
+        kept_trend = trend[keep]
+        kept_counts = np.bincount(q[keep], minlength=n_quarters)
+        if (kept_counts[lengths > 0] < 2).any():
+            raise ValueError('Not enough points left to flatten a quarter')
+        first = np.cumsum(kept_counts) - kept_counts
+
+        high = np.searchsorted(kept, np.arange(n))
+        high = np.clip(high, first[quarter] + 1,
+                       first[quarter] + kept_counts[quarter] - 1)
+        low = high - 1
+        slope = ((kept_trend[high] - kept_trend[low]) /
+                 (kept_time[high] - kept_time[low]))
+        trend_signal = slope * (time - kept_time[low]) + kept_trend[low]
+
+        mask[index[~keep]] = False
+
+    return trend_signal
+
+
+def flatten_light_curves(light_curves, window_length=101, polyorder=2,
+                         break_tolerance=5, niters=3, sigma=3):
+    '''
+    The flatten_light_curves function flattens a list of quarters (e.g.
+        all quarters of many kepids) in one call to flatten_quarters.
+    Gives the same flux as calling LightCurve.flatten on every quarter.
+
+    Args:
+        light_curves: list of (time, flux, flux_err) arrays, one per
+            quarter.
+        window_length, polyorder, break_tolerance, niters, sigma: see
+            LightCurve.flatten. Defaults = 101, 2, 5, 3, 3.
+
+    Returns:
+        flattened: list of (time, flux, flux_err) arrays, one per
+            quarter, with the flux and flux_err divided by the trend.
+    '''
+
+    if len(light_curves) == 0:
+        return []
+
+    lengths = [len(lc_time) for lc_time, _, _ in light_curves]
+    time = np.concatenate([lc[0] for lc in light_curves])
+    flux = np.concatenate([lc[1] for lc in light_curves])
+    flux_err = np.concatenate([lc[2] for lc in light_curves])
+
+    trend = flatten_quarters(time, flux, lengths, window_length, polyorder,
+                             break_tolerance, niters, sigma)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flux = flux / trend
+        flux_err = flux_err / trend
+
+    ## Views into the flattened arrays, one per quarter
+    bounds = np.cumsum([0] + lengths)
+    return [(time[start:stop], flux[start:stop], flux_err[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:])]
@@ -0,0 +1,202 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+import hashlib
+import json
+import glob
+import os
+
+################
+## On-disk cache of processed light curves
+####
+
+class FluxCache(object):
+    '''
+    The FluxCache class stores the processed (2001-point) flux vector of
+        each kepid on disk, so that unchanged kepids do not have to be
+        opened, flattened, stitched, folded and binned again.
+
+    Every entry is keyed on the kepid's FITS files (paths, sizes and
+        mtimes, or their contents), window_length, binsize, period
+        and t0. Changing any of these gives a new key, so only the
+        affected kepids get recomputed.
+    When the cache grows past max_bytes, the least recently used
+        entries are removed.
+
+    Args:
+        cache_dir: str; directory holding the cached .npy files.
+            Default = 'flux_cache'
+        max_bytes: int; size limit of the cache. Default = 2 GB.
+        hash_files: bool; key on the contents of the FITS files instead
+            of their mtimes. Slower, but survives copying the data/ tree.
+            Default = False
+    '''
+
+    def __init__(self, cache_dir='flux_cache', max_bytes=2*1024**3,
+                 hash_files=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_files = hash_files
+        self.hits = 0
+        self.misses = 0
+
+        ## Check if the cache directory already exist. If not, create it
+        if os.path.isdir(cache_dir) == False:
+            os.makedirs(cache_dir)
+
+        ## Running estimate of the cache size, checked when it overflows
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        '''
+        Returns (path, size, last_used) for every cached file.
+        '''
+
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npy')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                ## Removed by another process in the meantime
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _file_fingerprint(self, path):
+        '''
+        Returns what identifies one FITS file inside a key.
+        '''
+
+        if self.hash_files:
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024*1024), b''):
+                    sha1.update(block)
+            return [path, sha1.hexdigest()]
+
+        stat = os.stat(path)
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+    def make_key(self, kepid, paths, window_length, binsize, period, t0,
+                 options=None):
+        '''
+        The make_key method builds the cache key for one kepid.
+
+        Args:
+            kepid: Object of interest.
+            paths: List of all fits files corresponding to the kepid.
+            window_length: Used when flattening.
+            binsize: Used when binning.
+            period: Period given by Kepler pipeline.
+            t0: Time corresponding to zero phase.
+            options: dict; any other settings the flux depends on
+                (e.g. the fold backend). Default = None.
+
+        Returns:
+            key: str; file name (without extension) of the entry.
+        '''
+
+        content = {
+            'files': [self._file_fingerprint(p) for p in sorted(paths)],
+            'window_length': window_length,
+            'binsize': binsize,
+            'period': repr(float(period)),
+            't0': repr(float(t0)),
+            'options': options or {},
+        }
+        digest = hashlib.sha1(
+            json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+        ## Starting with the kepid allows invalidating a single kepid
+        return str(kepid).zfill(9) + '-' + digest
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        '''
+        Returns the cached flux vector for key, or None on a miss.
+        '''
+
+        path = self._path(key)
+        try:
+            flux = np.load(path)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        ## Marking the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return flux
+
+    def put(self, key, flux):
+        '''
+        Stores the flux vector under key, then evicts old entries if
+            the cache became too big.
+        '''
+
+        path = self._path(key)
+
+        ## Writing to a temporary file first, so that readers in other
+        ## processes never see a half written entry
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(flux))
+        os.replace(tmp_path, path)
+
+        self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits
+            in max_bytes.
+        '''
+
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._size -= size
+
+    def invalidate(self, kepid=None):
+        '''
+        The invalidate method removes cached entries.
+
+        Args:
+            kepid: Object of interest. If given, only that kepid's
+                entries are removed. Default = None (remove everything).
+
+        Returns:
+            removed: int; number of entries removed.
+        '''
+
+        if kepid is None:
+            pattern = '*.npy'
+        else:
+            pattern = str(kepid).zfill(9) + '-*.npy'
+
+        removed = 0
+        for path in glob.glob(os.path.join(self.cache_dir, pattern)):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+
+        self._size = sum(size for _, size, _ in self._entries())
+        return removed
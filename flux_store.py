@@ -0,0 +1,263 @@
+################
+## Packages to be used
+####
+
+## h5py is installed with tensorflow (keras saves models with it), but
+## it is only imported when a store is written or opened
+import collections
+import numpy as np
+import pandas as pd
+import json
+import os
+
+################
+## Columnar HDF5 flux store
+####
+
+## Version of the layout written by write_store (2: the index holds
+## every TCE, not only the first row of every kepid)
+STORE_VERSION = 2
+
+## Columns of flux_tce_order.csv kept in the store, with their type
+## (tce_duration only when the csv has it)
+TCE_COLUMNS = [('kepid', np.int64),
+               ('tce_plnt_num', np.int32),
+               ('tce_period', np.float64),
+               ('tce_time0bk', np.float64),
+               ('tce_duration', np.float64),
+               ('av_training_set', 'S3')]
+
+
+def write_store(flux_dir='.', store_file=None, params=None,
+                compression='gzip', chunk_rows=32, copy_rows=4096):
+    '''
+    The write_store function packs the flux store written by
+        main_data_processing (flux_data.npy, flux_labels.npy, the other
+        views and flux_tce_order.csv) into a single HDF5 file:
+          flux: float32, n x FLUX_LEN, chunked by rows and compressed
+          views/<name>: float32, the other views (see open_view_store)
+          label: int8, 1=planet, 0=non-planet, -1=not processed
+          kepid, tce_plnt_num, tce_period, ...: typed TCE columns
+          index/kepid, index/tce_plnt_num, index/row: every TCE,
+              sorted by kepid and tce_plnt_num, and its row, for
+              looking TCEs up without scanning (see FluxStore.row)
+        The processing parameters are stored as JSON in the 'params'
+        attribute.
+    The file is written next to store_file and then moved in place, so
+        readers never see half a store.
+
+    Args:
+        flux_dir: str; directory holding the flux store. Default = '.'
+        store_file: str; the HDF5 file.
+            Default = None (flux_dir/flux_store.h5).
+        params: dict; processing parameters (window_length, backends,
+            views, ...) the flux was made with. Default = None.
+        compression: 'gzip', 'lzf' or None. Default = 'gzip'.
+        chunk_rows: int; rows per chunk. Reading a row decompresses
+            its whole chunk, so small chunks keep random reads cheap.
+            Default = 32.
+        copy_rows: int; rows copied from the npy arrays at once.
+            Default = 4096.
+
+    Returns:
+        store_file: str; location of the HDF5 file.
+    '''
+
+    import h5py
+    from kepler_data_processing import read_store_views, load_view_arrays
+
+    if store_file is None:
+        store_file = os.path.join(flux_dir, 'flux_store.h5')
+
+    tce_data = pd.read_csv(os.path.join(flux_dir, 'flux_tce_order.csv'))
+    flux_data = np.load(os.path.join(flux_dir, 'flux_data.npy'),
+                        mmap_mode='r')
+    labels = np.load(os.path.join(flux_dir, 'flux_labels.npy'))
+    views = read_store_views(flux_dir) or {}
+    view_data = load_view_arrays(flux_dir)
+    n = len(tce_data)
+
+    def create_rows(h5, name, array):
+        ## Chunked by rows, compressed, copied a block at a time
+        dataset = h5.create_dataset(
+            name, shape=array.shape, dtype=np.float32,
+            chunks=(max(1, min(chunk_rows, n)), array.shape[1]),
+            compression=compression, shuffle=compression is not None,
+            fillvalue=np.nan)
+        for start in range(0, n, copy_rows):
+            dataset[start:start+copy_rows] = array[start:start+copy_rows]
+        return dataset
+
+    with h5py.File(store_file + '.new', 'w') as h5:
+        h5.attrs['version'] = STORE_VERSION
+        h5.attrs['params'] = json.dumps(params or {}, sort_keys=True)
+        h5.attrs['views'] = json.dumps(
+            [[name, n_bins, half_width]
+             for name, (n_bins, half_width) in views.items()])
+
+        create_rows(h5, 'flux', flux_data)
+        for name, view in view_data.items():
+            create_rows(h5, 'views/'+name, view)
+
+        h5.create_dataset('label', data=labels.astype(np.int8))
+        for column, dtype in TCE_COLUMNS:
+            if column in tce_data:
+                h5.create_dataset(
+                    column, data=tce_data[column].values.astype(dtype))
+
+        ## Row of every TCE, sorted by kepid and tce_plnt_num
+        kepids = tce_data['kepid'].values.astype(np.int64)
+        plnt_nums = tce_data['tce_plnt_num'].values.astype(np.int32)
+        rows = np.lexsort((plnt_nums, kepids))
+        h5.create_dataset('index/kepid', data=kepids[rows])
+        h5.create_dataset('index/tce_plnt_num', data=plnt_nums[rows])
+        h5.create_dataset('index/row', data=rows.astype(np.int64))
+
+    os.replace(store_file + '.new', store_file)
+
+    return store_file
+
+
+class FluxStore(object):
+    '''
+    The FluxStore class reads an HDF5 flux store written by write_store.
+    Nothing is loaded when it is opened: flux, labels, kepids and views
+        are h5py datasets, read a chunk at a time when indexed (e.g.
+        store.flux[i], store.labels[:]). They can be given to
+        create_data_record and visualize_all in place of the npy arrays.
+
+    Args:
+        store_file: str; the HDF5 file. Default = 'flux_store.h5'
+        cache_bytes: int; size of the chunk cache of every dataset, so
+            that rows of recently read chunks are not decompressed
+            again. Default = 64 MB.
+
+    Ex. with FluxStore('flux_store.h5') as store:
+            flux = store.get(6022556)
+            flux = store.get(6022556, plnt_num=2)
+    '''
+
+    def __init__(self, store_file='flux_store.h5', cache_bytes=64*1024**2):
+        import h5py
+
+        self.store_file = store_file
+        self.file = h5py.File(store_file, 'r', rdcc_nbytes=cache_bytes)
+        self.flux = self.file['flux']
+        self.labels = self.file['label']
+        self.kepids = self.file['kepid']
+        self.params = json.loads(self.file.attrs['params'])
+        self.views = collections.OrderedDict(
+            (name, self.file['views/'+name])
+            for name, _, _ in json.loads(self.file.attrs['views'])[1:])
+        self._index = None
+
+    def __len__(self):
+        return len(self.flux)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def index(self):
+        '''
+        Dict mapping every kepid to the rows of its TCEs, as an ordered
+            dict tce_plnt_num -> row (lowest tce_plnt_num first), built
+            on first use.
+        '''
+
+        if self._index is None:
+            if 'index/tce_plnt_num' in self.file:
+                kepids = self.file['index/kepid'][:]
+                plnt_nums = self.file['index/tce_plnt_num'][:]
+                rows = self.file['index/row'][:]
+            else:
+                ## Version 1 stores only indexed the first row of every
+                ## kepid, so the index is built from the columns
+                kepids = self.kepids[:]
+                plnt_nums = self.file['tce_plnt_num'][:]
+                rows = np.lexsort((plnt_nums, kepids))
+                kepids, plnt_nums = kepids[rows], plnt_nums[rows]
+
+            self._index = collections.OrderedDict()
+            for kepid, plnt_num, row in zip(kepids.tolist(),
+                                            plnt_nums.tolist(),
+                                            rows.tolist()):
+                tces = self._index.setdefault(kepid,
+                                              collections.OrderedDict())
+                tces.setdefault(plnt_num, row)
+        return self._index
+
+    def rows(self, kepid):
+        '''
+        Returns the rows of all TCEs of kepid, lowest tce_plnt_num
+            first. Raises KeyError if the kepid is not in the store.
+        '''
+
+        return list(self.index[int(kepid)].values())
+
+    def row(self, kepid, plnt_num=None):
+        '''
+        Returns the row of the TCE plnt_num of kepid, or of its TCE with
+            the lowest tce_plnt_num. Raises KeyError if the TCE is not in
+            the store.
+        '''
+
+        tces = self.index[int(kepid)]
+        if plnt_num is None:
+            return next(iter(tces.values()))
+        return tces[int(plnt_num)]
+
+    def get(self, kepid, plnt_num=None, view=None):
+        '''
+        Returns the flux of a TCE of kepid (see row), or its view with
+            the given name.
+        '''
+
+        dataset = self.flux if view is None else self.views[view]
+        return dataset[self.row(kepid, plnt_num)]
+
+    def read_rows(self, rows, view=None):
+        '''
+        The read_rows method reads the given rows of the flux (or of a
+            view) in any order. h5py only reads increasing rows, so
+            they are read sorted and put back in order.
+
+        Returns:
+            flux: np.array of shape (len(rows), n_bins).
+        '''
+
+        dataset = self.flux if view is None else self.views[view]
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return np.empty((0, dataset.shape[1]), dtype=dataset.dtype)
+        unique, inverse = np.unique(rows, return_inverse=True)
+        return dataset[unique][inverse]
+
+    def tce_data(self):
+        '''
+        Returns the TCE columns of the store as a DataFrame (in the
+            order of the rows), like flux_tce_order.csv.
+        '''
+
+        tce_data = pd.DataFrame(collections.OrderedDict(
+            (column, self.file[column][:])
+            for column, _ in TCE_COLUMNS if column in self.file))
+        tce_data['av_training_set'] = (
+            tce_data['av_training_set'].str.decode('ascii'))
+        return tce_data
+
+    def kepid_labels(self):
+        '''
+        Returns the kepids and (original) labels of all rows, as the
+            n x 2 str array written to flux_kepid_labels.npy.
+        '''
+
+        return np.column_stack([
+            self.kepids[:].astype(str),
+            self.file['av_training_set'][:].astype(str)]).astype(str)
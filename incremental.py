@@ -0,0 +1,301 @@
+################
+## Packages to be used
+####
+
+import kepler_data_processing as kdp
+from processing_journal import ProcessingJournal, read_journal, COMPLETED
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+
+################
+## Fingerprints of the processed TCEs
+####
+
+## Columns of a TCE that its processed flux (and label) depend on
+FINGERPRINT_COLUMNS = ['kepid', 'av_training_set', 'tce_plnt_num',
+                       'tce_period', 'tce_time0bk']
+
+
+def tce_fingerprints(tce_data, manifest=None, data_dir='data', views=None):
+    '''
+    The tce_fingerprints function identifies what every TCE would be
+        processed from: its csv row, the period and t0 used for its
+        kepid (see get_metadata), and the name, size and mtime of every
+        fits file of the kepid. A new quarter, a changed label or a
+        changed period all give a new fingerprint.
+    With views, the transit duration (see get_duration) is part of the
+        fingerprint too, as the local views depend on it.
+
+    Args:
+        tce_data: DataFrame containing needed parameter values.
+        manifest: FitsManifest used to find the fits files.
+            Default = None (walk the data directory).
+        data_dir: str; root of the downloaded fits files.
+            Default = 'data'
+        views: OrderedDict of the views, see main_data_processing.
+            Default = None
+
+    Returns:
+        fingerprints: list of str, one per row of tce_data.
+    '''
+
+    ## The fits files are only listed once per kepid
+    kepid_files = {}
+
+    fingerprints = []
+    for row in tce_data[FINGERPRINT_COLUMNS].itertuples(index=False):
+        kepid = int(row.kepid)
+        if kepid not in kepid_files:
+            kepid_files[kepid] = [
+                [os.path.basename(path), os.stat(path).st_size,
+                 os.stat(path).st_mtime_ns]
+                for path in kdp.get_kepid_files(kepid, manifest, data_dir)]
+
+        metadata = list(kdp.get_metadata(kepid, tce_data))
+        if views is not None:
+            metadata.append(kdp.get_duration(kepid, tce_data))
+        content = json.dumps([[str(value) for value in row],
+                              [str(value) for value in metadata],
+                              kepid_files[kepid]])
+        fingerprints.append(hashlib.sha1(content.encode()).hexdigest())
+
+    return fingerprints
+
+
+def read_flux_store_state(out_dir='.'):
+    '''
+    The read_flux_store_state function returns the TCEs of the flux
+        store in out_dir, in the order of its rows, and their
+        fingerprints.
+    Stores written by main_data_processing alone have no fingerprints;
+        their rows are then identified by their csv parameters only.
+
+    Returns:
+        tce_data: DataFrame of the TCEs (flux_tce_order.csv).
+        fingerprints: list of str, one per row.
+    '''
+
+    tce_data = pd.read_csv(os.path.join(out_dir, 'flux_tce_order.csv'))
+
+    if 'fingerprint' in tce_data:
+        fingerprints = tce_data['fingerprint'].astype(str).tolist()
+    else:
+        fingerprints = [
+            hashlib.sha1(json.dumps([str(value) for value in row]).encode())
+            .hexdigest()
+            for row in tce_data[FINGERPRINT_COLUMNS].itertuples(index=False)]
+
+    return tce_data, fingerprints
+
+
+################
+## Incremental update of the flux store
+####
+
+def diff_tces(old_tce_data, old_fingerprints, new_tce_data,
+              new_fingerprints, old_completed=None):
+    '''
+    The diff_tces function compares the TCEs of the previous run to the
+        current ones. TCEs are matched on (kepid, tce_plnt_num).
+    Unchanged TCEs that the previous run did not complete (they failed,
+        were skipped or were never reached) are processed again.
+
+    Args:
+        old_completed: set of the old rows that were completed (that
+            have a label). Default = None (all of them).
+
+    Returns:
+        kept: list of (old row, new row) of the unchanged, completed
+            TCEs, in the order of the old rows.
+        todo: list of the new rows that are added, changed or retried.
+        changes: dict; number of kept, added, changed, retried and
+            removed TCEs.
+    '''
+
+    old_rows = dict(
+        ((int(kepid), int(plnt_num)), i) for i, (kepid, plnt_num) in
+        enumerate(zip(old_tce_data['kepid'], old_tce_data['tce_plnt_num'])))
+
+    kept = []
+    todo = []
+    changes = {'kept': 0, 'added': 0, 'changed': 0, 'retried': 0,
+               'removed': 0}
+    for j, (kepid, plnt_num) in enumerate(zip(new_tce_data['kepid'],
+                                              new_tce_data['tce_plnt_num'])):
+        i = old_rows.pop((int(kepid), int(plnt_num)), None)
+        if i is None:
+            todo.append(j)
+            changes['added'] += 1
+        elif old_fingerprints[i] != new_fingerprints[j]:
+            todo.append(j)
+            changes['changed'] += 1
+        elif old_completed is not None and i not in old_completed:
+            todo.append(j)
+            changes['retried'] += 1
+        else:
+            kept.append((i, j))
+            changes['kept'] += 1
+
+    ## Whatever was not matched is no longer in the csv
+    changes['removed'] = len(old_rows)
+    kept.sort()
+
+    return kept, todo, changes
+
+
+def update_flux_store(csv_file, out_dir='.', manifest=None, data_dir='data',
+                      chunk_rows=4096, **processing_kwargs):
+    '''
+    The update_flux_store function updates the flux store of a previous
+        run after TCEs were added to (or removed from) the csv, or new
+        quarters were downloaded.
+    Only the added and changed TCEs are processed. Unchanged TCEs keep
+        their flux, label and journal entry, and removed TCEs are
+        dropped. The first run (no flux store yet) processes everything,
+        and so does a run with other views than the flux store's.
+
+    Args:
+        csv_file: Should contain desired TCEs and parameters.
+        out_dir: str; directory holding the flux store. Default = '.'
+        manifest: FitsManifest used to find the fits files. Refresh it
+            first (see fits_manifest.build_manifest) so that new
+            quarters are seen. Default = None (walk the data directory).
+        data_dir: str; root of the downloaded fits files.
+            Default = 'data'
+        chunk_rows: int; rows copied from the old store at once.
+            Default = 4096.
+        **processing_kwargs: passed on to main_data_processing (e.g.
+            n_workers, cache, fold_backend, views). With a prefetcher, 
+            the fits files of all TCEs are staged first (they are 
+            needed for the fingerprints) and read from its stage_dir.
+
+    Writes Out:
+        The flux store and journal of main_data_processing, with a
+            fingerprint column in flux_tce_order.csv.
+
+    Returns:
+        flux_data, flux_labels, flux_kepid_labels: see
+            main_data_processing.
+        changes: dict; number of kept, added, changed and removed TCEs.
+    '''
+
+    if os.path.isdir(out_dir) == False:
+        os.makedirs(out_dir)
+
+    order_file = os.path.join(out_dir, 'flux_tce_order.csv')
+    data_file = os.path.join(out_dir, 'flux_data.npy')
+    labels_file = os.path.join(out_dir, 'flux_labels.npy')
+    kepids_file = os.path.join(out_dir, 'flux_kepids.npy')
+    journal_file = os.path.join(out_dir, 'processing_journal.jsonl')
+    views_file = os.path.join(out_dir, 'flux_views.json')
+    views = processing_kwargs.get('views')
+    view_files = [os.path.join(out_dir, 'flux_{}.npy'.format(name))
+                  for name in list(views or [])[1:]]
+
+    ## Current TCEs and what they would be processed from
+    new_tce_data = kdp.open_files(csv_file)
+    prefetcher = processing_kwargs.get('prefetcher')
+    if prefetcher is not None:
+        prefetcher.fetch_kepids(new_tce_data['kepid'].values)
+        data_dir = prefetcher.stage_dir
+    new_fingerprints = tce_fingerprints(new_tce_data, manifest, data_dir,
+                                        views)
+
+    ## Previous run, if any (with the same views). Only its completed 
+    ## TCEs (the rows with a label) are kept, the others are tried again
+    if (os.path.isfile(order_file) and
+            kdp.read_store_views(out_dir) == views):
+        old_tce_data, old_fingerprints = read_flux_store_state(out_dir)
+        old_completed = set(np.flatnonzero(
+            np.load(labels_file, mmap_mode='r') >= 0).tolist())
+    else:
+        old_tce_data = new_tce_data.iloc[:0]
+        old_fingerprints = []
+        old_completed = set()
+
+    kept, todo, changes = diff_tces(old_tce_data, old_fingerprints,
+                                    new_tce_data, new_fingerprints,
+                                    old_completed)
+    print('Flux store update: {kept} kept, {added} added, {changed} changed, '
+          '{retried} retried, {removed} removed TCEs'.format(**changes))
+
+    ## New row order: the kept TCEs (in their old order), then the rest
+    old_rows = np.array([i for i, _ in kept], dtype=np.int64)
+    new_rows = [j for _, j in kept] + todo
+    tce_data = new_tce_data.iloc[new_rows].reset_index(drop=True)
+    tce_data['fingerprint'] = [new_fingerprints[j] for j in new_rows]
+    tce_num = len(tce_data)
+
+    ## Writing the new store next to the old one
+    flux_data = np.lib.format.open_memmap(
+        data_file + '.new', mode='w+', dtype=np.float32,
+        shape=(tce_num, kdp.FLUX_LEN))
+    flux_labels = np.lib.format.open_memmap(
+        labels_file + '.new', mode='w+', dtype=np.int8, shape=(tce_num,))
+    flux_kepids = np.lib.format.open_memmap(
+        kepids_file + '.new', mode='w+', dtype=np.int64, shape=(tce_num,))
+    view_data = [np.lib.format.open_memmap(
+        view_file + '.new', mode='w+', dtype=np.float32,
+        shape=(tce_num, views[name][0]))
+        for name, view_file in zip(list(views or [])[1:], view_files)]
+
+    flux_data[len(kept):] = np.nan
+    flux_labels[len(kept):] = -1
+    flux_kepids[:] = tce_data['kepid'].values
+    for view in view_data:
+        view[len(kept):] = np.nan
+
+    ## Copying the kept rows, a chunk at a time
+    old_entries = {}
+    if len(kept):
+        old_data = np.load(data_file, mmap_mode='r')
+        old_labels = np.load(labels_file, mmap_mode='r')
+        old_views = [np.load(view_file, mmap_mode='r')
+                     for view_file in view_files]
+        for start in range(0, len(kept), chunk_rows):
+            rows = old_rows[start:start+chunk_rows]
+            flux_data[start:start+len(rows)] = old_data[rows]
+            flux_labels[start:start+len(rows)] = old_labels[rows]
+            for view, old_view in zip(view_data, old_views):
+                view[start:start+len(rows)] = old_view[rows]
+        del old_data, old_labels, old_views
+        if os.path.isfile(journal_file):
+            old_entries = read_journal(journal_file)
+
+    flux_data.flush()
+    flux_labels.flush()
+    flux_kepids.flush()
+    for view in view_data:
+        view.flush()
+    del flux_data, flux_labels, flux_kepids, view_data
+
+    ## Carrying the journal entries of the kept (completed) TCEs over to
+    ## their new row
+    with ProcessingJournal(journal_file + '.new') as journal:
+        for new_i, old_i in enumerate(old_rows):
+            entry = old_entries.get(int(old_i))
+            if entry is not None:
+                journal.record(new_i, entry['kepid'], entry['status'],
+                               entry['error'])
+
+    ## Swapping the new store in, the order file last
+    swapped = [data_file, labels_file, kepids_file] + view_files
+    if views is not None:
+        kdp.write_views_file(views_file + '.new', views)
+        swapped.append(views_file)
+    elif os.path.isfile(views_file):
+        os.remove(views_file)
+    tce_data.to_csv(order_file + '.new', index=False)
+    for path in swapped + [journal_file, order_file]:
+        os.replace(path + '.new', path)
+
+    ## Processing the added and changed TCEs
+    processing_kwargs['resume'] = True
+    flux_data, flux_labels, flux_kepid_labels = kdp.main_data_processing(
+        csv_file, out_dir=out_dir, manifest=manifest, data_dir=data_dir,
+        **processing_kwargs)
+
+    return flux_data, flux_labels, flux_kepid_labels, changes
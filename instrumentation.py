@@ -0,0 +1,310 @@
+################
+## Packages to be used
+####
+
+import collections
+import tracemalloc
+import cProfile
+import json
+import time
+import csv
+import sys
+import os
+
+## resource (peak RSS) does not exist on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+################
+## Per-stage timers and counters
+####
+
+## StageRecord currently collecting stage times (None = not recording).
+## Set by recording; stage and count do nothing while it is None, so the
+## instrumented methods cost next to nothing when used on their own.
+_active = None
+
+
+def peak_rss_bytes():
+    '''
+    Returns the peak resident set size of this process in bytes
+        (None where the resource module is not available).
+    '''
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == 'darwin':
+        return int(peak)
+    return int(peak) * 1024
+
+
+class StageRecord(object):
+    '''
+    The StageRecord class holds the time spent in every stage, and the
+        counters, of one unit of work (e.g. one kepid or one shard).
+    Records are small and picklable, so worker processes send them back
+        to the parent, which merges them into a RunStats.
+
+    Args:
+        name: name of the unit of work (e.g. the kepid).
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.counts = {}
+        self.seconds = 0.
+        self.peak_rss_bytes = None
+        self.pid = os.getpid()
+
+    def add_time(self, stage_name, seconds):
+        total = self.stages.get(stage_name)
+        if total is None:
+            self.stages[stage_name] = [seconds, 1]
+        else:
+            total[0] += seconds
+            total[1] += 1
+
+    def add_count(self, counter, n=1):
+        self.counts[counter] = self.counts.get(counter, 0) + n
+
+
+class _Stage(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _active is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None and _active is not None:
+            _active.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name):
+    '''
+    The stage function times a block of code as one stage of the
+        current recording.
+        Ex. with stage('flatten'):
+                lc = lc.flatten()
+    '''
+
+    return _Stage(name)
+
+
+def count(counter, n=1):
+    '''
+    Adds n to a counter of the current recording.
+    '''
+
+    if _active is not None:
+        _active.add_count(counter, n)
+
+
+class recording(object):
+    '''
+    The recording context manager collects the stages and counters of
+        everything run inside it into a new StageRecord.
+    Recordings can be nested; the inner one gets the stages run inside
+        it, the outer one the rest.
+        Ex. with recording(kepid) as record:
+                flux = get_flux_vector(kepid, tce_data)
+    '''
+
+    def __init__(self, name):
+        self.record = StageRecord(name)
+        self._previous = None
+        self._start = None
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self.record
+        self._start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc_info):
+        global _active
+        self.record.seconds = time.perf_counter() - self._start
+        self.record.peak_rss_bytes = peak_rss_bytes()
+        _active = self._previous
+        return False
+
+
+################
+## Summaries of a whole run
+####
+
+class RunStats(object):
+    '''
+    The RunStats class merges the StageRecords of a run (from any
+        number of processes) into totals per stage, counters, the
+        peak RSS of every process, and one row per unit of work.
+    '''
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.statuses = collections.Counter()
+        self.peak_rss = {}
+        self.rows = []
+        self.start = time.time()
+
+    def merge(self, record, status=None, keep_row=True):
+        '''
+        The merge method adds a StageRecord to the totals.
+
+        Args:
+            record: StageRecord, e.g. returned by a worker.
+            status: str; outcome of the unit of work (e.g. 'completed').
+                Default = None.
+            keep_row: bool; keep a row for this record in the csv
+                written by write_csv. Default = True.
+        '''
+
+        for stage_name, (seconds, calls) in record.stages.items():
+            total = self.stages.setdefault(stage_name, [0., 0])
+            total[0] += seconds
+            total[1] += calls
+        for counter, n in record.counts.items():
+            self.counts[counter] = self.counts.get(counter, 0) + n
+        if status is not None:
+            self.statuses[status] += 1
+        if record.peak_rss_bytes is not None:
+            self.peak_rss[record.pid] = max(self.peak_rss.get(record.pid, 0),
+                                            record.peak_rss_bytes)
+
+        if keep_row:
+            row = {'name': record.name, 'status': status,
+                   'seconds': record.seconds,
+                   'peak_rss_bytes': record.peak_rss_bytes,
+                   'pid': record.pid}
+            for stage_name, (seconds, _) in record.stages.items():
+                row[stage_name] = seconds
+            self.rows.append(row)
+
+    def summary(self):
+        '''
+        Returns the totals of the run as a dict (see write_json).
+        '''
+
+        stage_seconds = sum(seconds for seconds, _ in self.stages.values())
+        units = max(len(self.rows), 1)
+
+        stages = collections.OrderedDict()
+        for stage_name, (seconds, calls) in self.stages.items():
+            stages[stage_name] = {
+                'seconds': seconds,
+                'calls': calls,
+                'ms_per_unit': 1000 * seconds / units,
+                'share': seconds / stage_seconds if stage_seconds else None,
+            }
+
+        return {
+            'wall_seconds': time.time() - self.start,
+            'units': len(self.rows),
+            'statuses': dict(self.statuses),
+            'stages': stages,
+            'counts': dict(self.counts),
+            'peak_rss_bytes': max(self.peak_rss.values())
+                              if self.peak_rss else None,
+            'peak_rss_bytes_per_process': {str(pid): rss for pid, rss
+                                           in self.peak_rss.items()},
+        }
+
+    def write_json(self, json_file):
+        '''
+        Writes the summary of the run to json_file.
+        '''
+
+        with open(json_file, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_csv(self, csv_file):
+        '''
+        Writes one row per unit of work (name, status, seconds, peak
+            RSS and the seconds of every stage) to csv_file.
+        '''
+
+        columns = ['name', 'status', 'seconds', 'peak_rss_bytes', 'pid']
+        columns += list(self.stages)
+        with open(csv_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, columns, restval='')
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def print_summary(self):
+        '''
+        Prints the time spent in every stage, slowest first.
+        '''
+
+        summary = self.summary()
+        print('Time per stage ({} units):'.format(summary['units']))
+        for stage_name, info in sorted(summary['stages'].items(),
+                                       key=lambda item: -item[1]['seconds']):
+            print('  {:<20}: {:9.2f} s ({:5.1%}), {:.1f} ms per unit'.format(
+                stage_name, info['seconds'], info['share'] or 0,
+                info['ms_per_unit']))
+        if summary['peak_rss_bytes'] is not None:
+            print('  Peak RSS: {:.1f} MB'.format(
+                summary['peak_rss_bytes'] / 1e6))
+
+
+################
+## Optional profiling for deep dives
+####
+
+class profiling(object):
+    '''
+    The profiling context manager runs cProfile or tracemalloc over a
+        block of code. Both slow the code down a lot, so they are off
+        unless asked for. Only the current process is profiled (use
+        n_workers=1 to profile the processing itself).
+
+    Args:
+        mode: None (do nothing), 'cprofile' or 'tracemalloc'.
+        out_file: str; where the results are written. cProfile stats
+            can be read with pstats; tracemalloc writes the 50 lines
+            allocating the most memory as text.
+    '''
+
+    def __init__(self, mode, out_file):
+        if mode not in (None, 'cprofile', 'tracemalloc'):
+            raise ValueError('Unknown profiling mode: {}'.format(mode))
+        self.mode = mode
+        self.out_file = out_file
+        self._profiler = None
+
+    def __enter__(self):
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.mode == 'tracemalloc':
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+            self._profiler.dump_stats(self.out_file)
+        elif self.mode == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with open(self.out_file, 'w') as f:
+                f.write('Peak traced memory: {} bytes\n'.format(peak))
+                for statistic in snapshot.statistics('lineno')[:50]:
+                    f.write('{}\n'.format(statistic))
+        if self.mode is not None:
+            print('Profile written to ' + self.out_file)
+        return False
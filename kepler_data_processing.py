@@ -2,10 +2,17 @@
 ## Packages to be used
 ####
 
-import matplotlib.pyplot as plt
-import lightkurve as lk
+## lightkurve, astropy and matplotlib are slow to import, so they are
+## only imported inside the methods that use them
 import pandas as pd
 import numpy as np
+from fits_manifest import walk_kepid_dir
+from processing_journal import ProcessingJournal, COMPLETED, FAILED, SKIPPED
+from instrumentation import stage, count, recording, RunStats, profiling
+from progress import ProgressReporter
+import concurrent.futures
+import collections
+import json
 import time
 import os
 
@@ -13,10 +20,12 @@ import os
 ## Methods to be used for data cleaning/processing
 ####
 
-def open_files(csv_file):
+def open_files(csv_file, multi_planet='lowest_plnt_num', seed=0):
     '''
     The open_files function opens the csv and extracts the needed data.
     Works on entire file at once.
+    Also builds the kepid index used by get_metadata (see 
+        build_metadata_index).
     
     Args: 
         csv_file: Should contain desired TCEs and parameters. 
@@ -25,6 +34,12 @@ def open_files(csv_file):
                               tce_plnt_num,
                               tce_period,
                               tce_time0bk.
+          Optional Parameter: tce_duration (hours; used for the local
+                              view, see fold_views).
+        multi_planet: Which TCE to use for kepids with several TCEs.
+            Default = 'lowest_plnt_num'.
+        seed: int; seed of the shuffle, so the order can be reproduced.
+            None shuffles differently every time. Default = 0.
     
     Returns:
         tce_data: Panda DataFrame that has the parameters listed above.
@@ -50,7 +65,7 @@ def open_files(csv_file):
     tce_info = pd.concat([pc_only, not_pc], ignore_index=True, sort=False)
 
     ## Shuffle the dataframe because all PCs are at the start
-    tce_info = tce_info.sample(frac=1).reset_index(drop=True)
+    tce_info = tce_info.sample(frac=1, random_state=seed).reset_index(drop=True)
     
 
     ## Extracting and combining kepids, periods, epochs into one DataFrame
@@ -58,29 +73,213 @@ def open_files(csv_file):
                          'av_training_set', 
                          'tce_plnt_num', 
                          'tce_period', 
-                         'tce_time0bk']]
+                         'tce_time0bk'] + 
+                        [c for c in OPTIONAL_COLUMNS if c in tce_info]]
+    
+    ## Building the kepid index once for get_metadata
+    attach_metadata_index(tce_data, multi_planet)
     
     return tce_data
+
+
+## Columns of the csv that are kept when present
+OPTIONAL_COLUMNS = ['tce_duration']
+
+
+def estimate_duration(period):
+    '''
+    Returns the duration (days) of a central transit of an Earth-like 
+        planet around a Sun-like star with the given period (days), 
+        used for TCEs without a tce_duration.
+    '''
+    
+    return 13. / 24 * (np.asarray(period, dtype=float) / 365.25) ** (1 / 3.)
+
+
+class MetadataIndex(dict):
+    '''
+    Dict mapping kepid to (period, tranmid, plnt_num, label, duration).
+    Its tces attribute maps every (kepid, plnt_num) to the same tuple,
+        for looking up one TCE of a kepid with several TCEs.
+    It is attached to tce_data, and pandas copies attached objects on
+        most operations, so copying it just returns the same index.
+    '''
+    
+    tces = None
+    
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return self
+
+
+def build_metadata_index(tce_data, multi_planet='lowest_plnt_num'):
+    '''
+    The build_metadata_index function maps every kepid to its metadata.
+    Works on entire DataFrame at once.
+    
+    Some kepids have more than one TCE (one per planet number). 
+        multi_planet picks which one is used for those kepids:
+          'lowest_plnt_num': the TCE with the lowest tce_plnt_num.
+          'first_row': the first TCE in tce_data.
+          'last_row': the last TCE in tce_data (the old behaviour 
+              of get_metadata).
+          'error': raise a ValueError.
+    
+    Args: 
+        tce_data: DataFrame containing needed parameter values.
+        multi_planet: Which TCE to use for kepids with several TCEs.
+            Default = 'lowest_plnt_num'.
+    
+    Returns:
+        index: MetadataIndex; kepid -> (period, tranmid, plnt_num, label,
+            duration). The duration is in days (from tce_duration, or 
+            estimate_duration if the csv has none). index.tces holds 
+            every TCE, by (kepid, plnt_num).
+    '''
+    
+    ## Ordering the TCEs so that the chosen one comes first per kepid
+    if multi_planet == 'lowest_plnt_num':
+        chosen = tce_data.sort_values('tce_plnt_num', kind='mergesort')
+        chosen = chosen.drop_duplicates('kepid', keep='first')
+    elif multi_planet == 'first_row':
+        chosen = tce_data.drop_duplicates('kepid', keep='first')
+    elif multi_planet == 'last_row':
+        chosen = tce_data.drop_duplicates('kepid', keep='last')
+    elif multi_planet == 'error':
+        duplicated = tce_data.kepid[tce_data.kepid.duplicated()]
+        if len(duplicated) > 0:
+            raise ValueError('kepids with more than one TCE: {}'.format(
+                sorted(set(duplicated.tolist()))[:10]))
+        chosen = tce_data
+    else:
+        raise ValueError('Unknown multi_planet policy: {}'.format(
+            multi_planet))
+    
+    index = MetadataIndex(zip(chosen['kepid'].tolist(), 
+                              _metadata_tuples(chosen)))
+    
+    ## Every TCE, whatever the policy
+    tces = tce_data.drop_duplicates(['kepid', 'tce_plnt_num'])
+    index.tces = dict(zip(zip(tces['kepid'].tolist(), 
+                              tces['tce_plnt_num'].tolist()), 
+                          _metadata_tuples(tces)))
+    
+    return index
+
+
+def _metadata_tuples(tce_data):
+    ## (period, tranmid, plnt_num, label, duration) of every row
+    periods = tce_data['tce_period'].astype(float)
+    durations = estimate_duration(periods)
+    if 'tce_duration' in tce_data:
+        ## Missing durations are estimated
+        durations = np.where(tce_data['tce_duration'].notnull(), 
+                             tce_data['tce_duration'].astype(float) / 24, 
+                             durations)
+    
+    return list(zip(periods.tolist(),
+                    tce_data['tce_time0bk'].astype(float).tolist(),
+                    tce_data['tce_plnt_num'].tolist(),
+                    tce_data['av_training_set'].tolist(),
+                    np.asarray(durations).tolist()))
+
+
+def attach_metadata_index(tce_data, multi_planet='lowest_plnt_num'):
+    '''
+    The attach_metadata_index function builds the kepid index and 
+        stores it on tce_data, where get_metadata looks for it.
+    
+    Args: 
+        tce_data: DataFrame containing needed parameter values.
+        multi_planet: Which TCE to use for kepids with several TCEs.
+            Default = 'lowest_plnt_num'.
+    
+    Returns:
+        index: MetadataIndex; see build_metadata_index.
+    '''
+    
+    index = build_metadata_index(tce_data, multi_planet)
+    tce_data.attrs['metadata_index'] = index
+    return index
+
+
+def get_metadata_index(tce_data):
+    '''
+    The get_metadata_index function returns the kepid index of tce_data,
+        building it first if open_files did not.
+    
+    Args: 
+        tce_data: DataFrame containing needed parameter values, 
+            or a MetadataIndex.
+    
+    Returns:
+        index: MetadataIndex; see build_metadata_index.
+    '''
+    
+    if isinstance(tce_data, MetadataIndex):
+        return tce_data
+    
+    index = tce_data.attrs.get('metadata_index')
+    if index is None:
+        index = attach_metadata_index(tce_data)
+    return index
+
+
+def _lookup_metadata(kepid, tce_data, plnt_num=None):
+    ## The TCE chosen for the kepid, or the given one of its TCEs
+    index = get_metadata_index(tce_data)
+    if plnt_num is None:
+        return index[int(kepid)]
+    return index.tces[(int(kepid), int(plnt_num))]
     
     
-def get_metadata(kepid, tce_data):
+def get_metadata(kepid, tce_data, plnt_num=None):
     '''
     The get_metadata function gathers required metadata.
-    Works on one kepid at a time.
+    Works on one kepid at a time, using the index built by open_files.
     
     Args: 
         kepid: Object of interest.
-        tce_data: DataFrame containing needed parameter values.
+        tce_data: DataFrame containing needed parameter values,
+            or a MetadataIndex.
+        plnt_num: tce_plnt_num of the TCE, for kepids with several 
+            TCEs. Default = None (the TCE picked by the multi_planet 
+            policy, see build_metadata_index).
     
     Returns:
         period: Period given by Kepler pipeline.
         tranmid: Time corresponding to zero phase; used for folding a lc.
     '''
     
+    ## Looking up period and tranmid
+    period, tranmid = _lookup_metadata(kepid, tce_data, plnt_num)[:2]
+    
+    ## Returns period and tranmid
+    return period, tranmid
+
+
+def get_duration(kepid, tce_data, plnt_num=None):
+    '''
+    The get_duration function returns the transit duration of a kepid 
+        (or of its TCE plnt_num) in days (see build_metadata_index).
+    Works on one kepid at a time.
+    '''
+    
+    return _lookup_metadata(kepid, tce_data, plnt_num)[4]
+
+
+def _get_metadata_scan(kepid, tce_data):
+    '''
+    The original get_metadata, which scans all of tce_data for every 
+        kepid. Only kept to benchmark get_metadata against.
+    '''
+    
     ## Getting period and tranmid
     period = tce_data[tce_data.kepid == kepid]
     if len(period) == 1:
-        period = float(period['tce_period'])
+        period = float(period['tce_period'].iloc[0])
     else:
         temp_var_period = 1
         for i in period['tce_period']:
@@ -90,7 +289,7 @@ def get_metadata(kepid, tce_data):
             
     tranmid = tce_data[tce_data.kepid == kepid]
     if len(tranmid) == 1:
-        tranmid = float(tranmid['tce_time0bk'])
+        tranmid = float(tranmid['tce_time0bk'].iloc[0])
     else:
         temp_var_tranmid = 1
         for i in tranmid['tce_time0bk']:
@@ -102,7 +301,7 @@ def get_metadata(kepid, tce_data):
     return period, tranmid
     
     
-def get_kepid_files(kepid):
+def get_kepid_files(kepid, manifest=None, data_dir='data'):
     '''
     The get_kepid_files function gathers list of required files.
     There are about ~12-18 fits files per kepid.
@@ -110,33 +309,486 @@ def get_kepid_files(kepid):
     
     Args: 
         kepid: Object of interest.
+        manifest: FitsManifest to look the files up in. The kepid's 
+            directory is only walked if it is missing from the manifest.
+            Default = None (always walk).
+        data_dir: str; root of the downloaded fits files. Default = 'data'
     
     Returns:
-        fits_files: List of all fits files corresponding to the kepid.
+        fits_files: Sorted list of all fits files corresponding to the kepid.
     '''
     
+    ## Looking the kepid up in the manifest first
+    if manifest is not None:
+        with stage('find_files'):
+            fits_files = manifest.lookup(kepid)
+        if fits_files is not None:
+            return fits_files
+    
     ## Pad the kepid with leading zeros to be a str of length 9
     kepid = str(kepid).zfill(9)
     
     ## Get the first four numbers (because of the filesystem)
     kepid_front = str(kepid[0:4])
     
-    ## Will hold paths to fits files for the input kepid
-    path = ('data' + '/' + kepid_front + '/' + kepid + '/')
-    fits_files = []
-    
     ## Searches the path for fits files
-    ## r=root, d=directories, f = files
-    for r, d, f in os.walk(path):
-        for file in f:
-            if 'kplr'+kepid in file:
-                fits_files.append(os.path.join(r, file))
+    path = (data_dir + '/' + kepid_front + '/' + kepid + '/')
     
     # Returns list containing all found files
-    return fits_files
+    with stage('find_files'):
+        return walk_kepid_dir(path, kepid)
+    
+    
+class NoFitsFilesError(Exception):
+    '''
+    Raised when no fits files were found for a kepid.
+    '''
+    pass
+
+
+def get_fits_row_count(path):
+    '''
+    The get_fits_row_count function reads the number of cadences in a 
+        fits file from its header, without reading the table itself.
+    
+    Args: 
+        path: str; location of the fits file.
+    
+    Returns:
+        row_count: int; number of rows in the light curve table.
+    '''
+    
+    from astropy.io import fits
+    
+    return int(fits.getheader(path, 1)['NAXIS2'])
+
+
+def read_quarter(path, reader='lightkurve'):
+    '''
+    The read_quarter function opens one fits file and returns its 
+        PDCSAP_FLUX (not flattened).
+    Works on one fits file at a time.
+    
+    Args: 
+        path: str; location of the fits file.
+        reader: 'lightkurve' to open the file with lk.search.open, or 
+            'fits' to only read the needed columns with 
+            fits_reader.read_pdcsap. Default = 'lightkurve'.
+    
+    Returns:
+        lc: Light curve of the quarter.
+    '''
+    
+    from fits_reader import read_pdcsap
+    import lightkurve as lk
+    
+    with stage('fits_open'):
+        if reader == 'fits':
+            data = read_pdcsap(path)
+            lc = lk.LightCurve(time=data.time, flux=data.flux, 
+                               flux_err=data.flux_err)
+        else:
+            lc = lk.search.open(path).PDCSAP_FLUX
+    count('quarters')
+    count('cadences', len(lc.flux))
+    
+    return lc
+
+
+def open_quarter(path, window_length=101, reader='lightkurve'):
+    '''
+    The open_quarter function opens one fits file and flattens its 
+        PDCSAP_FLUX.
+    Works on one fits file at a time.
+    
+    Args: 
+        path: str; location of the fits file.
+        window_length: Used when flattening. Default = 101.
+        reader: 'lightkurve' or 'fits', see read_quarter.
+            Default = 'lightkurve'.
+    
+    Returns:
+        lc: Flattened light curve of the quarter.
+    '''
+    
+    lc = read_quarter(path, reader)
+    
+    with stage('flatten'):
+        return lc.flatten(window_length=window_length)
+
+
+def stitch_kepid(paths, window_length=101, reader='lightkurve', 
+                 flatten_backend='lightkurve'):
+    '''
+    The stitch_kepid function flattens the PDCSAP_FLUX of every fits 
+        file of a kepid and stitches them into one light curve.
+    The flattened quarters are copied into arrays allocated once, using
+        the number of cadences in the fits headers as an upper bound, 
+        instead of appending one LightCurve to another.
+    Works on one kepid at a time.
+    
+    Args: 
+        paths: List of all fits files corresponding to the kepid.
+        window_length: Used when flattening. Default = 101.
+        reader: 'lightkurve' or 'fits', see read_quarter.
+            Default = 'lightkurve'.
+        flatten_backend: 'lightkurve' to flatten every quarter with 
+            LightCurve.flatten, or 'numpy' to stitch the quarters first
+            and flatten all of them at once with 
+            flatten_engine.flatten_quarters (same flux, to float 
+            rounding). Default = 'lightkurve'.
+    
+    Returns:
+        main_lc: Stitched light curve (not folded yet).
+    '''
+    
+    import lightkurve as lk
+    
+    if len(paths) == 0:
+        raise NoFitsFilesError('No fits files found')
+    
+    ## Upper bound on the stitched length (quality flagged cadences 
+    ## are removed when opening)
+    with stage('fits_header'):
+        total_len = sum(get_fits_row_count(path) for path in paths)
+    time_data = np.empty(total_len)
+    flux_data = np.empty(total_len)
+    flux_err_data = np.empty(total_len)
+    
+    ## Flattening every fits file (unless all are flattened at once 
+    ## below) and copying it in place
+    filled = 0
+    lengths = []
+    for path in paths:
+        if flatten_backend == 'numpy':
+            lc = read_quarter(path, reader)
+        else:
+            lc = open_quarter(path, window_length, reader)
+        with stage('stitch'):
+            n = len(lc.flux)
+            time_data[filled:filled+n] = lc.time
+            flux_data[filled:filled+n] = lc.flux
+            flux_err_data[filled:filled+n] = lc.flux_err
+            filled += n
+            lengths.append(n)
+    
+    time_data = time_data[:filled]
+    flux_data = flux_data[:filled]
+    flux_err_data = flux_err_data[:filled]
+    
+    ## Flattening all quarters in one pass
+    if flatten_backend == 'numpy':
+        from flatten_engine import flatten_quarters
+        with stage('flatten'):
+            trend = flatten_quarters(time_data, flux_data, lengths, 
+                                     window_length, dtype=lc.flux.dtype)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                flux_data /= trend
+                flux_err_data /= trend
+    
+    return lk.LightCurve(time=time_data, flux=flux_data, 
+                         flux_err=flux_err_data)
+
+
+def _stitch_kepid_append(paths, window_length=101):
+    '''
+    The original stitching, appending every quarter to the light curve
+        gathered so far. Only kept to benchmark stitch_kepid against.
+    '''
+    
+    import lightkurve as lk
+    
+    ## Opening the first fits file (will append others onto this one)
+    main_lc = lk.search.open(
+        paths[0]).PDCSAP_FLUX.flatten(
+        window_length=window_length)
+    
+    ## Append the remaining fits files to the first fits file
+    for i in range(len(paths)-1): 
+        ## Opening the following fits file
+        main_lc = main_lc.append(lk.search.open(
+            paths[i+1]).PDCSAP_FLUX.flatten(
+            window_length=window_length))
+    
+    return main_lc
+
+
+def calculate_binsize(flux_len, binsize='calculated'):
+    '''
+    The calculate_binsize function returns the binsize to use for a 
+        light curve with flux_len points.
+    
+    Args: 
+        flux_len: int; number of points in the stitched light curve.
+        binsize: If binsize is explicitly given as a float, that value 
+            will be used. Otherwise, binsize will be calculated so that
+            the output has length 2001.
+    
+    Returns:
+        binsize: float
+    '''
+    
+    ## Calculating binsize to make total length of vector 2001
+    if binsize == 'calculated':
+        binsize = round((flux_len / 2001.4), 4)
+    
+    return binsize
+
+
+def fold_bin_normalize(time, flux, period, t0, binsize, dtype='float64'):
+    '''
+    The fold_bin_normalize function folds, bins and normalizes a light
+        curve using NumPy only, without any LightCurve objects.
+    Gives the same result as lightkurve's fold(...).bin(...).normalize():
+        the folded points are sorted by phase, split into 
+        len(flux) // binsize bins of (almost) equal count, each bin is 
+        averaged ignoring NaNs, and the result is divided by its median.
+    
+    Args: 
+        time: np.array; time of the stitched light curve.
+        flux: np.array; flux of the stitched light curve.
+        period: Period given by Kepler pipeline.
+        t0: Time corresponding to zero phase.
+        binsize: float; number of points per bin.
+        dtype: dtype of the returned arrays. Default = 'float64'.
+            'float32' halves the size of the output.
+    
+    Returns:
+        binned_phase: np.array; mean phase of every bin (-0.5 to 0.5).
+        binned_flux: np.array; normalized mean flux of every bin.
+    '''
+    
+    fold_time, fold_flux = fold_light_curve(time, flux, period, t0)
+    binned_phase, binned_flux = bin_normalize_by_count(
+        fold_time, fold_flux, int(len(fold_flux) // binsize))
+    
+    return binned_phase.astype(dtype), binned_flux.astype(dtype)
+
+
+def fold_light_curve(time, flux, period, t0):
+    '''
+    The fold_light_curve function folds a light curve at the period of
+        a TCE, with the transit at phase 0, and sorts it by phase.
+    Every view (see fold_bin_normalize and fold_views) starts from it.
+    
+    Args: 
+        time: np.array; time of the stitched light curve.
+        flux: np.array; flux of the stitched light curve.
+        period: Period given by Kepler pipeline.
+        t0: Time corresponding to zero phase.
+    
+    Returns:
+        fold_time: np.array; phase of every point (-0.5 to 0.5), sorted.
+        fold_flux: np.array; flux of every point, in the same order.
+    '''
+    
+    ## Folding (always in float64, float32 is not precise enough for 
+    ## times of ~1500 days)
+    with stage('fold'):
+        time = np.asarray(time, dtype=np.float64)
+        phase = (t0 % period) / period
+        fold_time = ((time - phase * period) / period) % 1
+        fold_time[fold_time > 0.5] -= 1
+        
+        ## Sorting by phase
+        order = np.argsort(fold_time)
+        fold_time = fold_time[order]
+        fold_flux = np.asarray(flux)[order]
+    
+    return fold_time, fold_flux
+
+
+def bin_normalize_by_count(fold_time, fold_flux, n_bins):
+    '''
+    The bin_normalize_by_count function bins a folded light curve into
+        n_bins bins of (almost) equal count (see bin_by_count) and 
+        divides the binned flux by its median: the global view.
+    
+    Returns:
+        binned_phase: np.array; mean phase of every bin.
+        binned_flux: np.array; normalized mean flux of every bin.
+    '''
+    
+    with stage('bin'):
+        binned_phase, binned_flux = bin_by_count(fold_time, fold_flux, 
+                                                 n_bins)
+    
+    ## Normalizing
+    with stage('normalize'):
+        binned_flux /= np.nanmedian(binned_flux)
+    
+    return binned_phase, binned_flux
+
+
+def bin_by_count(fold_time, fold_flux, n_bins):
+    '''
+    The bin_by_count function bins a light curve sorted by phase into 
+        n_bins bins of (almost) equal count, the same bins as 
+        np.array_split (and lightkurve's bin): the first 
+        (len(fold_flux) % n_bins) bins get one extra point.
+    
+    Args: 
+        fold_time: np.array; phase of every point, sorted.
+        fold_flux: np.array; flux of every point.
+        n_bins: int; number of bins.
+    
+    Returns:
+        binned_phase: np.array; mean phase of every bin.
+        binned_flux: np.array; mean flux of every bin, ignoring NaNs 
+            (NaN for bins without any finite flux).
+    '''
+    
+    n = len(fold_flux)
+    base, extra = divmod(n, n_bins)
+    bin_sizes = np.full(n_bins, base, dtype=np.int64)
+    bin_sizes[:extra] += 1
+    bin_ids = np.repeat(np.arange(n_bins), bin_sizes)
+    
+    ## Mean of every bin, ignoring NaNs
+    finite = np.isfinite(fold_flux)
+    counts = np.bincount(bin_ids, weights=finite, minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned_flux = np.bincount(
+            bin_ids, weights=np.where(finite, fold_flux, 0.), 
+            minlength=n_bins) / counts
+        binned_phase = np.bincount(bin_ids, weights=fold_time, 
+                                   minlength=n_bins) / bin_sizes
+    
+    return binned_phase, binned_flux
+
+
+def bin_by_phase(fold_time, fold_flux, n_bins, half_width):
+    '''
+    The bin_by_phase function bins the points of a light curve sorted 
+        by phase that lie within half_width of phase 0 into n_bins bins
+        of equal width.
+    Bins without any finite flux (e.g. a data gap during the transit)
+        are interpolated from the nearest bins on either side.
+    
+    Args: 
+        fold_time: np.array; phase of every point, sorted.
+        fold_flux: np.array; flux of every point.
+        n_bins: int; number of bins.
+        half_width: float; the bins cover -half_width to half_width.
+    
+    Returns:
+        binned_flux: np.array; mean flux of every bin.
+    '''
+    
+    ## The points in the window are contiguous, since they are sorted
+    start = np.searchsorted(fold_time, -half_width, 'left')
+    stop = np.searchsorted(fold_time, half_width, 'right')
+    window_time = fold_time[start:stop]
+    window_flux = fold_flux[start:stop]
+    
+    bin_ids = ((window_time + half_width) / (2 * half_width) * n_bins)
+    bin_ids = np.minimum(bin_ids.astype(np.int64), n_bins - 1)
+    
+    ## Mean of every bin, ignoring NaNs
+    finite = np.isfinite(window_flux)
+    counts = np.bincount(bin_ids[finite], minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned_flux = np.bincount(bin_ids[finite], 
+                                  weights=window_flux[finite], 
+                                  minlength=n_bins) / counts
+    
+    ## Filling the empty bins
+    empty = counts == 0
+    if empty.any() and not empty.all():
+        centers = np.arange(n_bins)
+        binned_flux[empty] = np.interp(centers[empty], centers[~empty], 
+                                       binned_flux[~empty])
+    
+    return binned_flux
+
+
+## Views generated by fold_views: name -> (number of bins, half width 
+## of the view in transit durations, or None for the whole orbit). 
+## The first view is the one cnn_model is trained on (FLUX_LEN bins).
+VIEWS = collections.OrderedDict([
+    ('global', (2001, None)),
+    ('local', (201, 4.)),
+])
+
+
+def fold_views(time, flux, period, t0, duration, views=None, 
+               dtype='float64'):
+    '''
+    The fold_views function folds a light curve once and bins it into 
+        several fixed-length views, e.g. a global view of the whole 
+        orbit and a local view zoomed in on the transit.
+    Global views (half width None) use the same equal-count bins as 
+        fold_bin_normalize, but always exactly the requested number of
+        bins. Local views use equal-width bins within a number of 
+        transit durations of the transit. Every view is divided by its
+        median.
+    
+    Args: 
+        time: np.array; time of the stitched light curve.
+        flux: np.array; flux of the stitched light curve.
+        period: Period given by Kepler pipeline.
+        t0: Time corresponding to zero phase.
+        duration: float; transit duration in days (see get_duration).
+        views: OrderedDict; name -> (n_bins, half width in durations or
+            None). Default = None (VIEWS).
+        dtype: dtype of the returned arrays. Default = 'float64'.
+    
+    Returns:
+        binned: OrderedDict; name -> np.array of exactly n_bins values.
+    '''
     
+    if views is None:
+        views = VIEWS
     
-def get_total_flux(kepid,tce_data,window_length=101,binsize='calculated'): 
+    ## Folding once for all views
+    fold_time, fold_flux = fold_light_curve(time, flux, period, t0)
+    
+    binned = collections.OrderedDict()
+    for name, (n_bins, half_width) in views.items():
+        if half_width is None:
+            ## The same bins as fold_bin_normalize
+            _, view = bin_normalize_by_count(fold_time, fold_flux, n_bins)
+        else:
+            with stage('bin'):
+                view = bin_by_phase(fold_time, fold_flux, n_bins, 
+                                    min(half_width * duration / period, 0.5))
+            with stage('normalize'):
+                view /= np.nanmedian(view)
+        binned[name] = view.astype(dtype)
+    
+    return binned
+
+
+def views_length(views):
+    '''
+    Returns the total number of bins of the views (the length of the 
+        vector returned by get_flux_vector with views).
+    '''
+    
+    return sum(n_bins for n_bins, _ in views.values())
+
+
+def split_views(vector, views):
+    '''
+    The split_views function splits a vector returned by 
+        get_flux_vector with views back into its views.
+    
+    Returns:
+        binned: OrderedDict; name -> np.array of the view.
+    '''
+    
+    binned = collections.OrderedDict()
+    start = 0
+    for name, (n_bins, _) in views.items():
+        binned[name] = vector[start:start+n_bins]
+        start += n_bins
+    return binned
+
+
+def get_total_flux(kepid,tce_data,window_length=101,binsize='calculated',
+                   paths=None,fold_backend='lightkurve',dtype='float64',
+                   reader='lightkurve',flatten_backend='lightkurve',
+                   plnt_num=None): 
     '''
     The get_total_flux function stiches all the cleaned fits files 
       and cleans the folded light curve.
@@ -153,6 +805,19 @@ def get_total_flux(kepid,tce_data,window_length=101,binsize='calculated'):
         binsize: Used when binning. If binsize is explicitly given as
             a float, that value will be used. Otherwise, binsize will be 
             calculated so that the output has length 2001.
+        paths: List of all fits files corresponding to the kepid.
+            Default = None (found using get_kepid_files).
+        fold_backend: 'lightkurve' to fold, bin and normalize with 
+            LightCurve methods, or 'numpy' to use fold_bin_normalize.
+            Default = 'lightkurve'.
+        dtype: dtype of the flux when fold_backend='numpy'.
+            Default = 'float64'.
+        reader: 'lightkurve' or 'fits', see read_quarter.
+            Default = 'lightkurve'.
+        flatten_backend: 'lightkurve' or 'numpy', see stitch_kepid.
+            Default = 'lightkurve'.
+        plnt_num: tce_plnt_num of the TCE to fold at, see get_metadata.
+            Default = None.
     
     Returns:
         main_lc: Main light curve corresponding to the given kepid.
@@ -160,88 +825,556 @@ def get_total_flux(kepid,tce_data,window_length=101,binsize='calculated'):
             the correct length (of 2001).
     '''
     
-    ## Getting all fits files for this kepid
-    paths = get_kepid_files(kepid)
+    import lightkurve as lk
     
-    ## Opening the first fits file (will append others onto this one)
-    main_lc = lk.search.open(
-        paths[0]).PDCSAP_FLUX.flatten(
-        window_length=window_length)
+    ## Getting all fits files for this kepid
+    if paths is None:
+        paths = get_kepid_files(kepid)
     
-    ## Append the remaining fits files to the first fits file
-    for i in range(len(paths)-1): 
-        ## Opening the following fits file
-        main_lc = main_lc.append(lk.search.open(
-            paths[i+1]).PDCSAP_FLUX.flatten(
-            window_length=window_length))
+    ## Flattening and stitching all fits files
+    main_lc = stitch_kepid(paths, window_length, reader, flatten_backend)
     
     ## Getting kepid's metadata
-    period, tranmid = get_metadata(kepid, tce_data)
+    period, tranmid = get_metadata(kepid, tce_data, plnt_num)
 
     ## Calculating binsize to make total length of vector 2001
-    if binsize == 'calculated':
-        binsize = round((len(main_lc.flux) / 2001.4), 4)
-    elif type(binsize) == float:
-        binsize = binsize
+    binsize = calculate_binsize(len(main_lc.flux), binsize)
     
     ## Returning the cleaned main_lc
-    return main_lc.fold(
-            period=period, 
-            t0=tranmid).bin(
-            binsize=binsize).normalize()
+    if fold_backend == 'numpy':
+        binned_phase, binned_flux = fold_bin_normalize(
+            main_lc.time, main_lc.flux, period, tranmid, binsize, dtype)
+        return lk.LightCurve(time=binned_phase, flux=binned_flux)
+    
+    with stage('fold'):
+        main_lc = main_lc.fold(period=period, t0=tranmid)
+    with stage('bin'):
+        main_lc = main_lc.bin(binsize=binsize)
+    with stage('normalize'):
+        return main_lc.normalize()
+
+
+def get_total_views(kepid, tce_data, views=None, window_length=101, 
+                    paths=None, dtype='float64', reader='lightkurve', 
+                    flatten_backend='lightkurve', plnt_num=None):
+    '''
+    The get_total_views function stitches all the cleaned fits files of
+        a kepid and folds them once into every view (see fold_views).
+    Works on one kepid at a time.
+    
+    Args: 
+        kepid: Object of interest.
+        tce_data: DataFrame containing needed parameter values.
+        views: OrderedDict of the views. Default = None (VIEWS).
+        window_length: Used when flattening. Default = 101.
+        paths: List of all fits files corresponding to the kepid.
+            Default = None (found using get_kepid_files).
+        dtype: dtype of the views. Default = 'float64'.
+        reader: 'lightkurve' or 'fits', see read_quarter.
+            Default = 'lightkurve'.
+        flatten_backend: 'lightkurve' or 'numpy', see stitch_kepid.
+            Default = 'lightkurve'.
+        plnt_num: tce_plnt_num of the TCE to fold at, see get_metadata.
+            Default = None.
+    
+    Returns:
+        binned: OrderedDict; name -> np.array of the view.
+    '''
+    
+    ## Getting all fits files for this kepid
+    if paths is None:
+        paths = get_kepid_files(kepid)
+    
+    ## Flattening and stitching all fits files
+    main_lc = stitch_kepid(paths, window_length, reader, flatten_backend)
+    
+    ## Getting kepid's metadata
+    period, tranmid = get_metadata(kepid, tce_data, plnt_num)
+    duration = get_duration(kepid, tce_data, plnt_num)
+    
+    return fold_views(main_lc.time, main_lc.flux, period, tranmid, 
+                      duration, views, dtype)
+
+
+def get_flux_vector(kepid, tce_data, window_length=101, 
+                    binsize='calculated', cache=None, manifest=None,
+                    fold_backend='lightkurve', dtype='float64', 
+                    reader='lightkurve', flatten_backend='lightkurve',
+                    views=None, data_dir='data', plnt_num=None):
+    '''
+    The get_flux_vector function returns the cleaned flux of a kepid
+        as an np.array, going through the on-disk cache if one is given.
+    On a cache hit, none of the fits files are opened.
+    With views, the kepid is folded once into every view (see 
+        get_total_views) and the views are returned one after the 
+        other in a single vector (see split_views).
+    Works on one kepid at a time.
+    
+    Args: 
+        kepid: Object of interest.
+        tce_data: DataFrame containing needed parameter values.
+        window_length: Used when flattening. Default = 101.
+        binsize: Used when binning. Default = 'calculated'.
+        cache: FluxCache holding previously processed kepids.
+            Default = None (always process).
+        manifest: FitsManifest used to find the fits files.
+            Default = None (walk the data directory).
+        fold_backend: 'lightkurve' or 'numpy', see get_total_flux.
+            Default = 'lightkurve'.
+        dtype: dtype of the flux when fold_backend='numpy'.
+            Default = 'float64'.
+        reader: 'lightkurve' or 'fits', see read_quarter.
+            Default = 'lightkurve'.
+        flatten_backend: 'lightkurve' or 'numpy', see stitch_kepid.
+            Default = 'lightkurve'.
+        views: OrderedDict of the views (e.g. VIEWS), see fold_views.
+            fold_backend and binsize are then not used.
+            Default = None (only the flux of get_total_flux).
+        data_dir: str; root of the downloaded fits files. 
+            Default = 'data'
+        plnt_num: tce_plnt_num of the TCE to fold at, for kepids with
+            several TCEs (see get_metadata). Default = None.
+    
+    Returns:
+        flux: Np.array containing the cleaned flux (length 2001), or 
+            all views (length views_length(views)).
+    '''
+    
+    ## Getting all fits files for this kepid
+    paths = get_kepid_files(kepid, manifest, data_dir)
+    
+    ## Options passed on to get_total_flux
+    options = {'fold_backend': fold_backend, 'dtype': dtype, 
+               'reader': reader, 'flatten_backend': flatten_backend}
+    
+    if cache is None:
+        return _process_flux_vector(kepid, tce_data, window_length, 
+                                    binsize, paths, views, options, 
+                                    plnt_num)
+    
+    ## Everything the cached flux depends on
+    period, tranmid = get_metadata(kepid, tce_data, plnt_num)
+    key_options = options
+    if views is not None:
+        key_options = dict(options, views=views, 
+                           duration=get_duration(kepid, tce_data, plnt_num))
+    key = cache.make_key(kepid, paths, window_length, binsize, 
+                         period, tranmid, key_options)
+    
+    ## Only processing the kepid if it is not cached yet
+    with stage('cache_get'):
+        flux = cache.get(key)
+    if flux is None:
+        count('cache_misses')
+        flux = _process_flux_vector(kepid, tce_data, window_length, 
+                                    binsize, paths, views, options, 
+                                    plnt_num)
+        with stage('cache_put'):
+            cache.put(key, flux)
+    else:
+        count('cache_hits')
+    
+    return flux
+
+
+def _process_flux_vector(kepid, tce_data, window_length, binsize, paths, 
+                         views, options, plnt_num=None):
+    ## The flux of get_total_flux, or all views one after the other
+    if views is None:
+        return np.asarray(get_total_flux(
+            kepid, tce_data, window_length, binsize, paths=paths, 
+            plnt_num=plnt_num, **options).flux)
+    
+    binned = get_total_views(kepid, tce_data, views, window_length, 
+                             paths=paths, dtype=options['dtype'], 
+                             reader=options['reader'], 
+                             flatten_backend=options['flatten_backend'],
+                             plnt_num=plnt_num)
+    return np.concatenate(list(binned.values()))
+
+
+################
+## Methods to be used for (parallel) processing of many TCEs
+####
+
+## Copy of tce_data and get_total_flux options held by each worker 
+_worker_tce_data = None
+_worker_flux_kwargs = {}
+
+
+def _init_worker(tce_data, flux_kwargs):
+    '''
+    The _init_worker function stores tce_data once per worker, so that 
+        it is not sent along with every single TCE.
+    '''
+    
+    global _worker_tce_data, _worker_flux_kwargs
+    _worker_tce_data = tce_data
+    _worker_flux_kwargs = flux_kwargs
+
+
+def process_tce(i, kepid, plnt_num=None):
+    '''
+    The process_tce function processes a single TCE and catches any 
+        error, so that one bad kepid does not stop the whole run.
+    The time spent in every stage is recorded (see instrumentation) and 
+        sent back along with the flux.
+    Works on one kepid at a time.
+    
+    Args: 
+        i: index of the TCE in tce_data
+        kepid: Object of interest.
+        plnt_num: tce_plnt_num of the TCE, see get_flux_vector.
+            Default = None.
+    
+    Returns:
+        i: index of the TCE in tce_data
+        flux: Np.array containing the cleaned flux, or None on failure.
+        status: 'completed', 'failed', or 'skipped' (no fits files).
+        error: str describing the failure, or None on success.
+        record: StageRecord of the TCE.
+    '''
+    
+    flux, status, error = None, COMPLETED, None
+    with recording(int(kepid)) as record:
+        try:
+            flux = get_flux_vector(int(kepid), _worker_tce_data, 
+                                   plnt_num=plnt_num, 
+                                   **_worker_flux_kwargs)
+            check_flux_length(flux, _worker_flux_kwargs.get('views'))
+        except NoFitsFilesError as e:
+            flux, status, error = None, SKIPPED, str(e)
+        except Exception as e:
+            flux, status, error = (None, FAILED, 
+                                   '{}: {}'.format(type(e).__name__, e))
+    
+    return i, flux, status, error, record
+
+
+class _SerialExecutor(object):
+    '''
+    Stand-in for a ProcessPoolExecutor that runs every task right away
+        in the current process. Lets serial and parallel runs share 
+        one code path.
+    '''
+    
+    def __init__(self, initializer, initargs):
+        initializer(*initargs)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+    
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
 
 
-def print_info(tce_num, tce_data, i):
+def iter_processed_tces(tce_data, n_workers=1, max_in_flight=None, 
+                        flux_kwargs=None, rows=None, stats=None, 
+                        per_tce=False):
     '''
-    The print_info function will display the progress of the 
-        light curve cleaning process, depending on dataset size.
-    The printed info will look like this:
-        08 Processing:  kepid-001026133 UNK
-        (IndexNumber):     (kepid)    (Label)
+    The iter_processed_tces function processes every TCE in tce_data,
+        either serially or across a pool of worker processes.
+    Results are yielded in the same order as tce_data, no matter 
+        which worker finishes first.
     
     Args: 
-        tce_num: int; number of TCEs in dataset
-        tce_data: Panda DataFrame containing TCE metadata
-        i: index keeping track of which TCE is being worked on
-    '''
-    
-    ## Checking for small datsets
-    if tce_num < 20:
-        ## Printing step by step
-        ## Only useful for small datasets
-        print(str(i).zfill(2)+' Processing:  '+'kepid-'+
-            str(tce_data['kepid'][i]).zfill(9)+
-            str(tce_data['av_training_set'][i]).rjust(4, ' '))
-        if i == (tce_num-1):
-            print('Done cleaning and combining flux data.')
+        tce_data: DataFrame containing needed parameter values.
+        n_workers: int; number of worker processes. Default = 1 (serial).
+        max_in_flight: int; maximum number of TCEs queued or being 
+            processed at once. Default = 4 * n_workers.
+        flux_kwargs: dict; extra keyword arguments for get_flux_vector.
+        rows: indices of the TCEs to process. Default = None (all).
+        stats: RunStats the StageRecord of every TCE is merged into.
+            Default = None.
+        per_tce: bool; fold every row at the period and t0 of its own 
+            TCE (tce_plnt_num), e.g. when scoring all TCEs of a kepid.
+            Default = False (the TCE of the multi_planet policy).
+    
+    Yields:
+        (i, flux, status, error) for each TCE, as returned by process_tce.
+    '''
+    
+    if flux_kwargs is None:
+        flux_kwargs = {}
+    if max_in_flight is None:
+        max_in_flight = 4 * n_workers
+    
+    ## Picking the executor; both are used the exact same way below
+    if n_workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers, 
+            initializer=_init_worker, 
+            initargs=(tce_data, flux_kwargs))
     else:
-        if (i % 100 == 0):
-            ## For large datasets, will show progress every 100 TCEs
-            print('Processed '+str(i).rjust(5, ' ')+
-                  '/'+str(tce_num)+'..')
-        elif (i == tce_num-1):
-            print('Processed '+str(tce_num).rjust(5, ' ')+
-                  '/'+str(tce_num)+'..')
+        executor = _SerialExecutor(_init_worker, (tce_data, flux_kwargs))
+    
+    kepids = tce_data['kepid'].values
+    plnt_nums = tce_data['tce_plnt_num'].values
+    if rows is None:
+        rows = range(len(kepids))
+    rows = iter(rows)
+    
+    with executor:
+        ## Holds the submitted TCEs, oldest first
+        pending = collections.deque()
+        next_i = next(rows, None)
+        
+        while next_i is not None or pending:
+            ## Keeping at most max_in_flight TCEs submitted at once
+            while next_i is not None and len(pending) < max_in_flight:
+                pending.append(executor.submit(
+                    process_tce, next_i, kepids[next_i], 
+                    plnt_nums[next_i] if per_tce else None))
+                next_i = next(rows, None)
+            
+            ## Waiting on the oldest TCE keeps the output in order
+            i, flux, status, error, record = pending.popleft().result()
+            if stats is not None:
+                stats.merge(record, status)
+            yield i, flux, status, error
+
+
+################
+## Methods to be used for storing processed data
+####
+
+## Length of every processed flux vector
+FLUX_LEN = 2001
+
+## Labels for tensorflow (1=planet, 0=non-planet)
+LABEL_VALUES = {'PC': 1, 'AFP': 0, 'NTP': 0}
+
+
+def open_flux_store(csv_file, out_dir='.', resume=False):
+    '''
+    The open_flux_store function opens the TCEs and the memory-mapped 
+        arrays the processed flux is written into:
+          flux_tce_order.csv: the TCEs, in the order of the rows
+          flux_data.npy: float32, tce_num x FLUX_LEN
+          flux_labels.npy: int8, -1 until the row is completed
+          flux_kepids.npy: int64, kepid of every row
+    
+    Args: 
+        csv_file: Should contain desired TCEs and parameters. 
+        out_dir: str; directory holding the flux store. Default = '.'
+        resume: bool; reopen the store of a previous run instead of 
+            creating a new one. Default = False.
+    
+    Returns:
+        tce_data: DataFrame containing needed parameter values.
+        flux_data: Np.memmap of the flux.
+        flux_labels: Np.memmap of the labels.
+        flux_kepids: Np.memmap of the kepids.
+    '''
+    
+    ## Check if the output directory already exist. If not, create it
+    if os.path.isdir(out_dir) == False:
+        os.makedirs(out_dir)
+    
+    order_file = os.path.join(out_dir, 'flux_tce_order.csv')
+    data_file = os.path.join(out_dir, 'flux_data.npy')
+    labels_file = os.path.join(out_dir, 'flux_labels.npy')
+    kepids_file = os.path.join(out_dir, 'flux_kepids.npy')
+    
+    ## Reopening the previous run, in the same (shuffled) order
+    if resume and os.path.isfile(order_file):
+        tce_data = pd.read_csv(order_file)
+        attach_metadata_index(tce_data)
+        flux_data = np.lib.format.open_memmap(data_file, mode='r+')
+        flux_labels = np.lib.format.open_memmap(labels_file, mode='r+')
+        flux_kepids = np.lib.format.open_memmap(kepids_file, mode='r+')
+        
+        if not np.array_equal(flux_kepids, tce_data['kepid'].values):
+            raise ValueError('{} does not match {}'.format(
+                kepids_file, order_file))
+        return tce_data, flux_data, flux_labels, flux_kepids
+    
+    ## Opens the chosen csv file and extracts the needed data
+    tce_data = open_files(csv_file)
+    tce_data.to_csv(order_file, index=False)
+    tce_num = len(tce_data)
+    
+    ## Creating the arrays on disk
+    flux_data = np.lib.format.open_memmap(
+        data_file, mode='w+', dtype=np.float32, shape=(tce_num, FLUX_LEN))
+    flux_labels = np.lib.format.open_memmap(
+        labels_file, mode='w+', dtype=np.int8, shape=(tce_num,))
+    flux_kepids = np.lib.format.open_memmap(
+        kepids_file, mode='w+', dtype=np.int64, shape=(tce_num,))
+    
+    flux_data[:] = np.nan
+    flux_labels[:] = -1
+    flux_kepids[:] = tce_data['kepid'].values
+    flux_kepids.flush()
+    
+    return tce_data, flux_data, flux_labels, flux_kepids
+
+
+def read_store_views(out_dir='.'):
+    '''
+    Returns the views of the flux store in out_dir (OrderedDict, see 
+        VIEWS), or None if it was written without views.
+    '''
+    
+    views_file = os.path.join(out_dir, 'flux_views.json')
+    if os.path.isfile(views_file) == False:
+        return None
+    with open(views_file) as f:
+        return collections.OrderedDict(
+            (name, (n_bins, half_width)) 
+            for name, n_bins, half_width in json.load(f))
+
+
+def write_views_file(views_file, views):
+    '''
+    Writes the views (OrderedDict, see VIEWS) to views_file, in order.
+    '''
+    
+    with open(views_file, 'w') as f:
+        json.dump([[name, n_bins, half_width] 
+                   for name, (n_bins, half_width) in views.items()], f)
+
+
+def open_view_store(out_dir, tce_num, views=None, resume=False):
+    '''
+    The open_view_store function opens the memory-mapped arrays of the 
+        views of the flux store, stored side by side with flux_data.npy:
+          flux_data.npy: the first view (which must have FLUX_LEN bins)
+          flux_<name>.npy: float32, tce_num x n_bins, every other view
+          flux_views.json: the views, in order
+    
+    Args: 
+        out_dir: str; directory holding the flux store.
+        tce_num: int; number of rows of the flux store.
+        views: OrderedDict of the views, see fold_views.
+            Default = None (no views; a stale flux_views.json is 
+            removed).
+        resume: bool; reopen the arrays of a previous run, which must
+            have been written with the same views. Default = False.
+    
+    Returns:
+        view_data: OrderedDict; name -> np.memmap of every view but the
+            first.
+    '''
     
+    views_file = os.path.join(out_dir, 'flux_views.json')
+    view_data = collections.OrderedDict()
     
+    if resume:
+        if read_store_views(out_dir) != views:
+            raise ValueError('The flux store in {} was written with other '
+                             'views'.format(out_dir))
+        for name in list(views or [])[1:]:
+            view_data[name] = np.lib.format.open_memmap(
+                os.path.join(out_dir, 'flux_{}.npy'.format(name)), mode='r+')
+        return view_data
+    
+    if views is None:
+        if os.path.isfile(views_file):
+            os.remove(views_file)
+        return view_data
+    
+    names = list(views)
+    if views[names[0]][0] != FLUX_LEN:
+        raise ValueError('The first view must have {} bins'.format(FLUX_LEN))
+    
+    for name in names[1:]:
+        view_data[name] = np.lib.format.open_memmap(
+            os.path.join(out_dir, 'flux_{}.npy'.format(name)), mode='w+', 
+            dtype=np.float32, shape=(tce_num, views[name][0]))
+        view_data[name][:] = np.nan
+    
+    write_views_file(views_file, views)
+    
+    return view_data
+
+
+def load_view_arrays(out_dir='.', mmap_mode='r'):
+    '''
+    The load_view_arrays function loads the views of the flux store in 
+        out_dir, other than the first one (flux_data.npy).
+    
+    Returns:
+        view_data: OrderedDict; name -> np.array (memory-mapped by 
+            default); empty if the store has no views.
+    '''
+    
+    views = read_store_views(out_dir) or {}
+    return collections.OrderedDict(
+        (name, np.load(os.path.join(out_dir, 'flux_{}.npy'.format(name)), 
+                       mmap_mode=mmap_mode))
+        for name in list(views)[1:])
+
+
+def check_flux_length(flux, views=None):
+    '''
+    The check_flux_length function raises a ValueError if a vector 
+        returned by get_flux_vector does not have the length of a row 
+        of the flux store (FLUX_LEN, or views_length(views) with 
+        views). Such a vector is not stored, cut or padded.
+    '''
+    
+    n_bins = FLUX_LEN if views is None else views_length(views)
+    if np.ndim(flux) != 1 or len(flux) != n_bins:
+        raise ValueError('flux has length {} instead of {}'.format(
+            np.size(flux), n_bins))
+
+
+def write_flux_row(flux_data, i, flux):
+    '''
+    The write_flux_row function writes one processed flux vector into 
+        row i of the flux store.
+    Vectors that do not have the length of a row raise a ValueError 
+        (see check_flux_length) and nothing is written.
+    
+    Args: 
+        flux_data: Np.memmap of the flux.
+        i: index of the row.
+        flux: Np.array containing the cleaned flux.
+    '''
+    
+    n_bins = flux_data.shape[1]
+    if np.ndim(flux) != 1 or len(flux) != n_bins:
+        raise ValueError('flux has length {} instead of {}'.format(
+            np.size(flux), n_bins))
+    flux_data[i] = flux
+
+
 ################
 ## Methods to be used for data visualization
 ####
 
-def visualize_all(data, kepid_labels, every='all'):
+def visualize_all(data, kepid_labels=None, every='all'):
     '''
     The visualize_all function plots all the given TCE fluxes. 
+    One figure is shown at a time; to review many TCEs, 
+        render.render_pages draws them into PNG pages instead.
     
     Args: 
         data: Numpy array containing flux data. Should have been 
             generated using the main function.
+            Can also be a flux_store.FluxStore, whose rows are then 
+            read one at a time instead of loading the whole store.
         kepid_labels: Numpy array containing labels. Should have been 
             generated using the main function.
+            Default = None (only with a FluxStore, which has them).
         every: Specify how many light curves to plot. 
             For every 8th light curve, quanity=8.
             Default is 'all'. 
     '''
     
+    import matplotlib.pyplot as plt
+    import lightkurve as lk
+    
+    if kepid_labels is None:
+        kepid_labels = data.kepid_labels()
+        data = data.flux
+    
     if every == 'all':
         for i in range(len(data)):
             lc = lk.LightCurve(flux=data[i][:])
@@ -266,19 +1399,105 @@ def visualize_all(data, kepid_labels, every='all'):
 ## Main method for data cleaning/processing
 ####
 
-def main_data_processing(csv_file):
+def _iter_fetched_rows(prefetcher, rows, kepids, journal, progress, stats):
+    '''
+    Yields the rows whose fits files were all staged by the prefetcher.
+        The others are journaled as failed (with the fetch error) and
+        not processed, as only some of their quarters may be staged.
+    '''
+    
+    for i, error in prefetcher.iter_staged(rows, kepids):
+        if error is None:
+            yield i
+            continue
+        journal.record(i, kepids[i], FAILED, 'fetch failed: ' + error)
+        stats.statuses[FAILED] += 1
+        progress.update()
+
+
+def main_data_processing(csv_file, n_workers=1, max_in_flight=None, 
+                         cache=None, manifest=None, 
+                         fold_backend='lightkurve', reader='lightkurve',
+                         flatten_backend='lightkurve', views=None,
+                         out_dir='.', resume=False, retry_failed=False,
+                         flush_every=100, profile=None, 
+                         progress_interval=10., log_format='text',
+                         store_file=None, data_dir='data', prefetcher=None,
+                         window_length=101):
     '''
     The main_data_processing function processes the light curves for the TCEs in
         the given csv file, assuming that the corresponding light curves 
         have already been downloaded.
+    Every TCE is written to the memory-mapped flux store (see 
+        open_flux_store) as soon as it is done, and recorded as 
+        completed, failed or skipped in out_dir/processing_journal.jsonl.
+        A crashed run can then be resumed from where it stopped.
+    TCEs that fail to process (or have no fits files) keep the label -1
+        (and NaN flux) in the returned arrays. They are listed in 
+        out_dir/processing_failures.csv at the end of the run.
+    The time spent in every stage (fits open, flatten, stitch, fold, 
+        bin, ...) is summed over all workers and written to 
+        out_dir/processing_stats.json, with one row per TCE in 
+        out_dir/processing_stats.csv.
     
     Args: 
         csv_file: Should contain desired TCEs and parameters. 
+        n_workers: int; number of worker processes. Default = 1 (serial).
+        max_in_flight: int; maximum number of TCEs queued or being 
+            processed at once. Default = 4 * n_workers.
+        cache: FluxCache used to skip kepids that were already 
+            processed with the same files and parameters.
+            Default = None (no caching).
+        manifest: FitsManifest used to find the fits files, see 
+            fits_manifest.build_manifest. Default = None (walk the 
+            data directory for every kepid).
+        fold_backend: 'lightkurve' or 'numpy', see get_total_flux.
+            Default = 'lightkurve'.
+        reader: 'lightkurve' or 'fits', see read_quarter.
+            Default = 'lightkurve'.
+        flatten_backend: 'lightkurve' or 'numpy', see stitch_kepid.
+            Default = 'lightkurve'.
+        views: OrderedDict of the views (e.g. VIEWS). Every kepid is 
+            then folded once into all of them (see get_total_views); 
+            the first view goes to flux_data.npy and the others to 
+            flux_<name>.npy (see open_view_store). 
+            Default = None (flux_data.npy only, from get_total_flux).
+        out_dir: str; directory holding the flux store. Default = '.'
+        resume: bool; continue the run stored in out_dir, only 
+            processing the rows that are not in the journal yet.
+            Default = False.
+        retry_failed: bool; when resuming, also process the rows that
+            failed or were skipped before. Default = False.
+        flush_every: int; number of TCEs between flushes of the flux 
+            store to disk. Default = 100.
+        profile: None, 'cprofile' or 'tracemalloc'; profiles the run 
+            (in this process only) into out_dir/processing_profile.prof
+            or .txt. Default = None.
+        progress_interval: float; seconds between two progress reports 
+            (see ProgressReporter). Default = 10.
+        log_format: 'text' or 'json' (one JSON object per line) for the
+            progress reports. Default = 'text'.
+        store_file: str; if given, the finished flux store is also 
+            packed into this compressed HDF5 file, with typed columns, 
+            a kepid index and the processing parameters (see 
+            flux_store.write_store). Default = None.
+        data_dir: str; root of the downloaded fits files. 
+            Default = 'data'
+        prefetcher: prefetch.Prefetcher fetching the fits files of the 
+            next TCEs from a mirror while the current ones are 
+            processed (see Prefetcher.iter_staged). The files are then
+            read from its stage_dir instead of data_dir. TCEs whose 
+            files could not all be fetched are journaled as failed.
+            Default = None (the files are already in data_dir).
+        window_length: Used when flattening (written into the HDF5 
+            store with the other processing parameters). Default = 101.
     
     Returns:
-        flux_data: Np.array containing all TCE flux data. 
-            For n TCEs, the list is of size n x 2001.
-        flux_labels: Np.array containing all TCE kepids and labels.
+        flux_data: Np.memmap containing all TCE flux data (float32). 
+            For n TCEs, the array is of size n x 2001.
+        flux_labels: Np.memmap containing all TCE labels (int8).
+            1=planet, 0=non-planet, -1=not processed.
+        flux_kepid_labels: Np.array containing all TCE kepids and labels.
             For n TCEs, the list is of size n x 2.
     '''
     
@@ -286,55 +1505,130 @@ def main_data_processing(csv_file):
     start = time.time()
     print('Commencing data processing...')
     
-    ## Opens the chosen csv file and extracts the needed data
-    tce_data = open_files(csv_file)
+    ## Opens the chosen csv file (or the previous run) and the flux store
+    tce_data, flux_data, flux_labels, flux_kepids = open_flux_store(
+        csv_file, out_dir, resume)
     
     ## Holds the number of TCEs
     tce_num = len(tce_data)
-
-    ## Will contain all the flux data (tce_num x 2001)
-    flux_data = []
     
-    ## Will contain all the labels (tce_num x 1)
-    flux_labels = []
+    ## The other views, stored next to flux_data
+    view_data = open_view_store(out_dir, tce_num, views, resume)
     
-    ## Will contain all the kepids and labels (tce_num x 2)
-    flux_kepid_labels = []
-
-    ## Getting total flux for each kepid
-    for i in range(tce_num):
-
-        ## Current flux data as list 
-        temp_flux_data = get_total_flux(
-            int(tce_data['kepid'][i]), tce_data).flux.tolist()
-
-        ## Adding current flux data to flux_data
-        flux_data.append(temp_flux_data)
-        
-        ## Adding current label to flux_labels
-        flux_labels.append(tce_data['av_training_set'][i])
+    ## Opens the journal (keeping the previous entries when resuming)
+    journal = ProcessingJournal(
+        os.path.join(out_dir, 'processing_journal.jsonl'), resume)
+    
+    ## Only processing the rows that are not completed (or given up on)
+    todo = flux_labels < 0
+    if not retry_failed:
+        todo[journal.rows_with_status(FAILED, SKIPPED)] = False
+    rows = np.flatnonzero(todo)
+    if resume:
+        print('Resuming: {} of {} TCEs left to process'.format(
+            len(rows), tce_num))
+    
+    ## Time per stage of every TCE (from all workers) and of this process
+    stats = RunStats()
+    profile_file = os.path.join(out_dir, 'processing_profile' + 
+                                ('.prof' if profile == 'cprofile' else '.txt'))
+    
+    ## Rate, ETA, failures and cache hits, reported every so often
+    progress = ProgressReporter(len(rows), 'Processing', 
+                                interval=progress_interval, 
+                                log_format=log_format, stats=stats)
+    
+    ## Fetching the fits files of the upcoming rows from a mirror
+    if prefetcher is not None:
+        data_dir = prefetcher.stage_dir
+        rows = _iter_fetched_rows(prefetcher, rows, tce_data['kepid'].values,
+                                  journal, progress, stats)
+    
+    ## Getting total flux for each kepid (in the same order as tce_data)
+    with journal, profiling(profile, profile_file), \
+            recording('main_data_processing') as main_record:
+        for n_done, (i, temp_flux_data, status, error) in enumerate(
+                iter_processed_tces(
+                    tce_data, n_workers=n_workers, 
+                    max_in_flight=max_in_flight,
+                    flux_kwargs={'cache': cache, 'manifest': manifest,
+                                 'fold_backend': fold_backend, 
+                                 'reader': reader,
+                                 'flatten_backend': flatten_backend,
+                                 'views': views,
+                                 'data_dir': data_dir,
+                                 'window_length': window_length},
+                    rows=rows, stats=stats)):
+            
+            ## Writing the flux first and the label last, so that a row 
+            ## only counts as completed once all of it is written
+            with stage('store'):
+                if status == COMPLETED:
+                    if views is not None:
+                        binned = split_views(temp_flux_data, views)
+                        temp_flux_data = binned.popitem(last=False)[1]
+                        for name, view in binned.items():
+                            view_data[name][i] = view
+                    write_flux_row(flux_data, i, temp_flux_data)
+                    flux_labels[i] = LABEL_VALUES[
+                        tce_data['av_training_set'][i]]
+                
+                ## Keeping track of every kepid without stopping the run
+                journal.record(i, tce_data['kepid'][i], status, error)
+                
+                ## Flushing to disk every so often
+                if (n_done % flush_every) == 0:
+                    flux_data.flush()
+                    for view in view_data.values():
+                        view.flush()
+                    flux_labels.flush()
+            
+            ## Reporting progress (rate limited)
+            progress.update()
         
-        ## Adding current kepid/index and label to flux_index_labels
-        flux_kepid_labels.append([tce_data['kepid'][i], 
-                           tce_data['av_training_set'][i]])
-
-        ## Printing relevant info 
-        print_info(tce_num, tce_data, i)
+        with stage('store'):
+            flux_data.flush()
+            for view in view_data.values():
+                view.flush()
+            flux_labels.flush()
+    
+    progress.close()
     
-    ## Converting from list to np.array
-    flux_data = np.asarray(flux_data)
-    flux_labels = np.asarray(flux_labels)
-    flux_kepid_labels = np.asarray(flux_kepid_labels)
+    ## Writing out the time spent in every stage
+    stats.merge(main_record, keep_row=False)
+    stats.write_json(os.path.join(out_dir, 'processing_stats.json'))
+    stats.write_csv(os.path.join(out_dir, 'processing_stats.csv'))
+    stats.print_summary()
     
-    ## Changing labels for tensorflow
-    flux_labels[flux_labels == 'PC'] = 1
-    flux_labels[flux_labels == 'AFP'] = 0
-    flux_labels[flux_labels == 'NTP'] = 0
+    ## Reporting the kepids that could not be processed
+    if prefetcher is not None:
+        print(prefetcher.summary())
+    counts = journal.counts()
+    print('Completed: {}, failed: {}, skipped: {} (of {} TCEs)'.format(
+        counts[COMPLETED], counts[FAILED], counts[SKIPPED], tce_num))
+    if counts[FAILED] or counts[SKIPPED]:
+        report_file = os.path.join(out_dir, 'processing_failures.csv')
+        journal.write_report(report_file)
+        print('Failed and skipped TCEs were written to ' + report_file)
     
-    ## Saving the processed data arrays as npy files
-    np.save('flux_data.npy', flux_data)
-    np.save('flux_labels.npy', flux_labels)
-    np.save('flux_kepid_labels.npy', flux_kepid_labels)
+    ## Saving the kepids with their (original) labels, as a str array 
+    ## (pandas gives object arrays, which np.load refuses by default)
+    flux_kepid_labels = np.column_stack([
+        tce_data['kepid'].astype(str).values, 
+        tce_data['av_training_set'].astype(str).values]).astype(str)
+    np.save(os.path.join(out_dir, 'flux_kepid_labels.npy'), flux_kepid_labels)
+    
+    ## Packing the flux store into a single HDF5 file
+    if store_file is not None:
+        from flux_store import write_store
+        params = {'csv_file': os.path.basename(csv_file),
+                  'window_length': window_length, 'binsize': 'calculated',
+                  'flux_len': FLUX_LEN, 'fold_backend': fold_backend,
+                  'reader': reader, 'flatten_backend': flatten_backend,
+                  'views': None if views is None else list(views.items())}
+        with stage('store'):
+            write_store(out_dir, store_file, params)
+        print('Wrote the flux store to ' + store_file)
     
     ## Display time of completion
     end = time.time()
@@ -342,5 +1636,3 @@ def main_data_processing(csv_file):
     
     ## Return np.arrays containing all kepids and flux data
     return flux_data, flux_labels, flux_kepid_labels
-    
-                
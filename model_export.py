@@ -0,0 +1,433 @@
+################
+## Packages to be used
+####
+
+## tensorflow (or only tflite_runtime, when running an exported model)
+## is imported inside the functions that use it
+import collections
+import numpy as np
+import json
+import time
+import os
+
+from score_tces import summarize_latencies
+
+## Post-training quantizations of convert_tflite
+QUANTIZATIONS = ['float32', 'dynamic', 'int8']
+
+################
+## Loading the flux of a split
+####
+
+def load_split_data(split='val', tf_dir=None, store_file=None, npy_dir=None,
+                    max_samples=None, seed=0):
+    '''
+    The load_split_data function loads the flux and labels of one split
+        into memory, from the tfrecords, the HDF5 flux store or the npy
+        arrays (the first one given), e.g. to calibrate or evaluate an
+        exported model.
+
+    Args:
+        split: str; 'train', 'val' or 'test'. Default = 'val'.
+        tf_dir: str; tfrecords written by main_tfrecords_creation.
+        store_file: str; HDF5 flux store, split like the tfrecords (see
+            tfrecords_creation.split_indices).
+        npy_dir: str; npy arrays written by save_arrays.
+        max_samples: int; only keep this many TCEs, picked at random.
+            Default = None (all).
+        seed: int; seed of the store splits and of the sampling.
+            Default = 0.
+
+    Returns:
+        flux_data: np.array of float32, shape (n, FLUX_LEN, 1).
+        labels: np.array of floats, 1=planet, 0=non-planet.
+    '''
+
+    if tf_dir:
+        from tfrecords_creation import load_dataset
+
+        flux_data, labels = [], []
+        for flux, label in load_dataset(tf_dir, split, batch_size=256,
+                                        shuffle_buffer=0):
+            flux_data.append(np.asarray(flux))
+            labels.append(np.asarray(label).ravel())
+        flux_data = np.concatenate(flux_data)
+        labels = np.concatenate(labels)
+    elif store_file:
+        from flux_store import FluxStore
+        from tfrecords_creation import split_indices
+
+        with FluxStore(store_file) as store:
+            rows = split_indices(store.kepids[:], store.labels[:],
+                                 seed=seed)[split]
+            if max_samples is not None and len(rows) > max_samples:
+                rows = np.sort(np.random.RandomState(seed).choice(
+                    rows, max_samples, replace=False))
+            flux_data = store.read_rows(rows)
+            labels = store.labels[:][rows]
+    elif npy_dir:
+        from cnn_model import load_split
+
+        flux_data, labels = load_split(split, npy_dir, mmap_mode='r')
+    else:
+        raise ValueError('One of tf_dir, store_file or npy_dir is needed')
+
+    if max_samples is not None and len(flux_data) > max_samples:
+        keep = np.sort(np.random.RandomState(seed).choice(
+            len(flux_data), max_samples, replace=False))
+        flux_data, labels = flux_data[keep], labels[keep]
+
+    flux_data = np.asarray(flux_data, dtype=np.float32)
+    flux_data = flux_data.reshape(len(flux_data), flux_data.shape[1], 1)
+    return flux_data, np.asarray(labels, dtype=float).ravel()
+
+
+################
+## Exporting the model
+####
+
+def export_saved_model(model, out_dir):
+    '''
+    The export_saved_model function writes a Keras model as a
+        SavedModel, which TensorFlow Serving and the TFLite converter
+        read without the Python code of the model.
+
+    Args:
+        model: tf.keras model, see load_scoring_model.
+        out_dir: str; directory of the SavedModel.
+
+    Returns:
+        out_dir: str
+    '''
+
+    from tfrecords_creation import import_tensorflow
+
+    tf = import_tensorflow()
+    tf.compat.v2.saved_model.save(model, out_dir)
+    return out_dir
+
+
+def convert_tflite(model, out_file, quantization='float32',
+                   calibration_data=None):
+    '''
+    The convert_tflite function converts a Keras model to a TFLite
+        flatbuffer, optionally with post-training quantization:
+          float32: no quantization
+          dynamic: int8 weights, float activations; no calibration
+          int8: int8 weights and activations, with the activation ranges
+              calibrated on calibration_data (ops without an int8
+              kernel stay float). The input and output stay float32,
+              so the model is used like the others.
+
+    Args:
+        model: tf.keras model, see load_scoring_model.
+        out_file: str; location of the .tflite file.
+        quantization: one of QUANTIZATIONS. Default = 'float32'.
+        calibration_data: np.array of shape (n, FLUX_LEN, 1); needed for
+            int8, e.g. a few hundred TCEs of the validation split (see
+            load_split_data).
+
+    Returns:
+        out_file: str
+    '''
+
+    from tfrecords_creation import import_tensorflow
+
+    tf = import_tensorflow()
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError('Unknown quantization {}, expected one of {}'.format(
+            quantization, QUANTIZATIONS))
+    if quantization == 'int8' and calibration_data is None:
+        raise ValueError('int8 quantization needs calibration_data')
+
+    ## The v2 converter works on the (eager) Keras model in TF 1.14+
+    converter = tf.compat.v2.lite.TFLiteConverter.from_keras_model(model)
+    if quantization != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        def representative_dataset():
+            for flux in calibration_data:
+                yield [np.asarray(flux, dtype=np.float32)[np.newaxis]]
+        converter.representative_dataset = representative_dataset
+
+    with open(out_file, 'wb') as f:
+        f.write(converter.convert())
+
+    return out_file
+
+
+################
+## Running an exported model
+####
+
+class TFLiteModel(object):
+    '''
+    The TFLiteModel class runs a .tflite model written by convert_tflite
+        with the same predict_on_batch as a Keras model, so it can be
+        given to score_stream and the scoring server (load_scoring_model
+        returns one for .tflite files).
+    The interpreter of tflite_runtime is used when it is installed,
+        which needs neither tensorflow nor its start-up time; otherwise
+        the one of tensorflow. The input is resized when the batch size
+        changes, so fixed-size batches are the fastest (score_stream and
+        the scoring server pad their batches).
+
+    Args:
+        model_file: str; location of the .tflite file.
+        num_threads: int; threads of the interpreter.
+            Default = None (its default).
+    '''
+
+    def __init__(self, model_file, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        kwargs = {}
+        if num_threads is not None:
+            kwargs['num_threads'] = num_threads
+        self.model_file = model_file
+        self.interpreter = Interpreter(model_path=model_file, **kwargs)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+
+    def predict_on_batch(self, batch):
+        '''
+        Returns the probabilities of a batch of shape (n, FLUX_LEN, 1),
+            as an (n, 1) array.
+        '''
+
+        batch = np.asarray(batch, dtype=np.float32)
+        if tuple(self.input['shape']) != batch.shape:
+            self.interpreter.resize_tensor_input(self.input['index'],
+                                                 batch.shape)
+            self.interpreter.allocate_tensors()
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+
+        ## Models with integer inputs and outputs (de)quantize here
+        if self.input['dtype'] != np.float32:
+            scale, zero_point = self.input['quantization']
+            batch = np.round(batch / scale + zero_point).astype(
+                self.input['dtype'])
+        self.interpreter.set_tensor(self.input['index'], batch)
+        self.interpreter.invoke()
+        probabilities = self.interpreter.get_tensor(self.output['index'])
+        if self.output['dtype'] != np.float32:
+            scale, zero_point = self.output['quantization']
+            probabilities = (probabilities.astype(np.float32)
+                             - zero_point) * scale
+        return probabilities
+
+
+################
+## Accuracy versus latency
+####
+
+def benchmark_model(model, flux_data, labels, batch_size=256,
+                    single_samples=100, reference=None):
+    '''
+    The benchmark_model function measures the accuracy and the CPU
+        latency of a model (Keras or TFLiteModel) on flux_data.
+    Batches are padded to batch_size like in score_stream; single TCEs
+        are scored one at a time like in the scoring server.
+
+    Args:
+        model: model with a predict_on_batch method.
+        flux_data: np.array of shape (n, FLUX_LEN, 1).
+        labels: np.array; 1=planet, 0=non-planet.
+        batch_size: int; TCEs per batch. Default = 256.
+        single_samples: int; TCEs scored one at a time. Default = 100.
+        reference: np.array; probabilities of the original model, to
+            which these are compared. Default = None.
+
+    Returns:
+        results: dict with the accuracy, the batch and single TCE
+            latency percentiles and the TCEs per second.
+        probabilities: np.array, one per TCE.
+    '''
+
+    ## Warming up both input shapes (TFLite resizes its input)
+    batch = np.zeros((batch_size,) + flux_data.shape[1:], dtype=np.float32)
+    model.predict_on_batch(batch)
+    model.predict_on_batch(batch[:1])
+    model.predict_on_batch(batch)
+
+    probabilities = np.empty(len(flux_data))
+    batch_latencies = []
+    start = time.perf_counter()
+    for first in range(0, len(flux_data), batch_size):
+        n = min(batch_size, len(flux_data) - first)
+        batch[:n] = flux_data[first:first+n]
+        batch[n:] = 0
+        batch_start = time.perf_counter()
+        output = np.asarray(model.predict_on_batch(batch))
+        batch_latencies.append(time.perf_counter() - batch_start)
+        probabilities[first:first+n] = output.reshape(-1)[:n]
+    elapsed = time.perf_counter() - start
+
+    single_latencies = []
+    for flux in flux_data[:single_samples]:
+        single_start = time.perf_counter()
+        model.predict_on_batch(flux[np.newaxis])
+        single_latencies.append(time.perf_counter() - single_start)
+
+    predictions = probabilities >= 0.5
+    results = collections.OrderedDict([
+        ('accuracy', float(np.mean(predictions == (labels >= 0.5)))),
+        ('tces_per_second', len(flux_data) / max(elapsed, 1e-9)),
+        ('batch_size', batch_size),
+        ('batch_latency', summarize_latencies(batch_latencies)),
+        ('single_latency', summarize_latencies(single_latencies)),
+    ])
+    if reference is not None:
+        results['agreement'] = float(np.mean(predictions ==
+                                             (reference >= 0.5)))
+        results['max_probability_difference'] = float(
+            np.max(np.abs(probabilities - reference)))
+
+    return results, probabilities
+
+
+def print_report(report):
+    '''
+    Prints the accuracy versus latency table of main_export.
+    '''
+
+    print('{:<16}{:>10}{:>10}{:>10}{:>12}{:>12}{:>10}'.format(
+        'model', 'size MB', 'accuracy', 'agreement', 'batch p50',
+        'single p50', 'TCEs/sec'))
+    for name, results in report['models'].items():
+        print('{:<16}{:>10.2f}{:>10.4f}{:>10}{:>10.1f}ms{:>10.2f}ms'
+              '{:>10.1f}'.format(
+                  name, results['size_bytes'] / 1024.**2,
+                  results['accuracy'],
+                  '{:.4f}'.format(results['agreement'])
+                  if 'agreement' in results else '-',
+                  results['batch_latency']['p50_ms'] or 0.,
+                  results['single_latency']['p50_ms'] or 0.,
+                  results['tces_per_second']))
+
+
+################
+## Main method for exporting
+####
+
+def main_export(model_file='model.h5', out_dir='export',
+                quantizations=QUANTIZATIONS, saved_model=True, tf_dir=None,
+                store_file=None, npy_dir=None, calibration_samples=256,
+                eval_split='test', eval_samples=None, batch_size=256,
+                num_threads=None, seed=0):
+    '''
+    The main_export function exports the model trained by fit_model for
+        CPU inference: a SavedModel and one TFLite model per
+        quantization, int8 calibrated on the validation split. When a
+        split can be loaded, every exported model is then compared with
+        the Keras model on eval_split, so the accuracy lost to
+        quantization can be weighed against the latency gained.
+
+    Args:
+        model_file: str; location of the HDF5 model. Default = 'model.h5'
+        out_dir: str; directory of the exported models. Default = 'export'
+        quantizations: list of QUANTIZATIONS to convert to.
+            Default = all of them.
+        saved_model: bool; also write out_dir/saved_model.
+            Default = True.
+        tf_dir, store_file, npy_dir: where the splits are read from, see
+            load_split_data. Default = None (no calibration, no report).
+        calibration_samples: int; validation TCEs int8 is calibrated on.
+            Default = 256.
+        eval_split: str; split the models are compared on.
+            Default = 'test'.
+        eval_samples: int; TCEs of eval_split compared on.
+            Default = None (all).
+        batch_size: int; TCEs per batch, see benchmark_model.
+            Default = 256.
+        num_threads: int; threads of the TFLite interpreters.
+            Default = None.
+        seed: int; seed of the splits and of the sampling. Default = 0.
+
+    Writes Out:
+        out_dir/saved_model, out_dir/model_<quantization>.tflite and
+            out_dir/export_report.json
+
+    Returns:
+        report: dict; the files written and, for every model, the
+            results of benchmark_model and its size.
+    '''
+
+    from tfrecords_creation import import_tensorflow
+    from score_tces import load_scoring_model
+
+    ## Eager execution has to be on before the model is loaded
+    import_tensorflow()
+
+    print('Exporting {}...'.format(model_file))
+    start = time.time()
+
+    if os.path.isdir(out_dir) == False:
+        os.makedirs(out_dir)
+
+    split_kwargs = {'tf_dir': tf_dir, 'store_file': store_file,
+                    'npy_dir': npy_dir, 'seed': seed}
+    has_splits = bool(tf_dir or store_file or npy_dir)
+
+    model = load_scoring_model(model_file)
+
+    report = collections.OrderedDict([('model_file', model_file),
+                                      ('files', collections.OrderedDict()),
+                                      ('models', collections.OrderedDict())])
+
+    if saved_model:
+        report['files']['saved_model'] = export_saved_model(
+            model, os.path.join(out_dir, 'saved_model'))
+
+    calibration_data = None
+    if 'int8' in quantizations:
+        if not has_splits:
+            raise ValueError('int8 quantization needs the validation split '
+                             '(tf_dir, store_file or npy_dir)')
+        calibration_data, _ = load_split_data(
+            'val', max_samples=calibration_samples, **split_kwargs)
+        print('Calibrating int8 on {} validation TCEs'.format(
+            len(calibration_data)))
+
+    for quantization in quantizations:
+        report['files'][quantization] = convert_tflite(
+            model, os.path.join(out_dir, 'model_{}.tflite'.format(
+                quantization)),
+            quantization=quantization, calibration_data=calibration_data)
+
+    ## Accuracy versus latency of every model
+    if has_splits:
+        flux_data, labels = load_split_data(eval_split,
+                                            max_samples=eval_samples,
+                                            **split_kwargs)
+        report['eval_split'] = eval_split
+        report['eval_samples'] = len(flux_data)
+
+        results, reference = benchmark_model(model, flux_data, labels,
+                                             batch_size)
+        results['size_bytes'] = os.path.getsize(model_file)
+        report['models']['keras'] = results
+
+        for quantization in quantizations:
+            tflite_file = report['files'][quantization]
+            results, _ = benchmark_model(
+                TFLiteModel(tflite_file, num_threads), flux_data, labels,
+                batch_size, reference=reference)
+            results['size_bytes'] = os.path.getsize(tflite_file)
+            report['models']['tflite_' + quantization] = results
+
+        print_report(report)
+
+    with open(os.path.join(out_dir, 'export_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('Completed export in {:.4f} seconds'.format(time.time() - start))
+
+    return report
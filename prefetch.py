@@ -0,0 +1,378 @@
+################
+## Packages to be used
+####
+
+import concurrent.futures
+import collections
+import threading
+import asyncio
+import shutil
+import re
+import os
+
+################
+## Sources of fits files
+####
+
+## Links to fits files in a directory listing
+_LINK = re.compile(r'href="([^"/?]+\.fits)"')
+
+
+def kepid_subdir(kepid):
+    '''
+    Returns the directory of a kepid, relative to the root of the data
+        (the same layout as MAST and data/): 0069/006922244
+    '''
+
+    kepid = str(kepid).zfill(9)
+    return kepid[0:4] + '/' + kepid
+
+
+class FetchError(Exception):
+    '''
+    Raised when a file cannot be fetched and retrying would not help
+        (e.g. it is missing from the mirror).
+    '''
+
+
+class LocalSource(object):
+    '''
+    The LocalSource class reads fits files from a local (or mounted)
+        copy of the MAST directory tree, e.g. on slow network storage.
+
+    Args:
+        root: str; root of the copy (holding 0069/006922244/...).
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_files(self, kepid):
+        '''
+        Returns the names and sizes of the fits files of a kepid
+            (an empty list if the mirror does not have it).
+        '''
+
+        path = os.path.join(self.root, kepid_subdir(kepid))
+        if os.path.isdir(path) == False:
+            return []
+        prefix = 'kplr' + str(kepid).zfill(9)
+        return sorted((name, os.path.getsize(os.path.join(path, name)))
+                      for name in os.listdir(path)
+                      if name.startswith(prefix) and name.endswith('.fits'))
+
+    def fetch(self, kepid, name, out_file):
+        '''
+        Copies one fits file of a kepid to out_file.
+        '''
+
+        path = os.path.join(self.root, kepid_subdir(kepid), name)
+        if os.path.isfile(path) == False:
+            raise FetchError('{} is not in the mirror'.format(path))
+        shutil.copyfile(path, out_file)
+
+
+class HttpSource(object):
+    '''
+    The HttpSource class downloads fits files from an HTTP mirror of
+        the MAST directory tree, e.g.
+        https://archive.stsci.edu/pub/kepler/lightcurves or a local
+        stand-in (python -m http.server in a copy of the tree). The
+        files of a kepid are found in the directory listing.
+
+    Args:
+        base_url: str; root of the mirror.
+        timeout: float; seconds before a request is given up (and
+            retried, see Prefetcher). Default = 60.
+    '''
+
+    def __init__(self, base_url, timeout=60.):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _url(self, kepid, name=''):
+        return '{}/{}/{}'.format(self.base_url, kepid_subdir(kepid), name)
+
+    def _open(self, url):
+        from urllib.request import urlopen
+        from urllib.error import HTTPError
+
+        try:
+            return urlopen(url, timeout=self.timeout)
+        except HTTPError as error:
+            ## Client errors (e.g. 404) will not go away by retrying
+            if 400 <= error.code < 500:
+                raise FetchError('{}: HTTP {}'.format(url, error.code))
+            raise
+
+    def list_files(self, kepid):
+        '''
+        Returns the names and sizes (None: unknown) of the fits files of
+            a kepid (an empty list if the mirror does not have it).
+        '''
+
+        try:
+            response = self._open(self._url(kepid))
+        except FetchError:
+            return []
+        with response:
+            listing = response.read().decode('utf-8', 'replace')
+
+        prefix = 'kplr' + str(kepid).zfill(9)
+        return sorted((name, None) for name in set(_LINK.findall(listing))
+                      if name.startswith(prefix))
+
+    def fetch(self, kepid, name, out_file):
+        '''
+        Downloads one fits file of a kepid to out_file.
+        '''
+
+        with self._open(self._url(kepid, name)) as response:
+            with open(out_file, 'wb') as f:
+                shutil.copyfileobj(response, f, 1024*1024)
+
+
+def open_source(mirror, timeout=60.):
+    '''
+    Returns the source of a mirror: an HttpSource for http(s) URLs, a
+        LocalSource for directories.
+    '''
+
+    if mirror.startswith('http://') or mirror.startswith('https://'):
+        return HttpSource(mirror, timeout)
+    return LocalSource(mirror)
+
+
+################
+## Asynchronous prefetching into a staging directory
+####
+
+class Prefetcher(object):
+    '''
+    The Prefetcher class copies the fits files of kepids from a mirror
+        (see open_source) into a local staging directory, with the same
+        layout as data/, so that get_kepid_files finds them there.
+    Files are fetched by an asyncio event loop running in a background
+        thread: at most max_concurrency files are transferred at once
+        (the transfers themselves run in a thread pool), and failed
+        transfers are retried with an exponential backoff. Files that
+        are already staged (with the right size) are not fetched again.
+        A file only appears in the staging directory once it is
+        complete.
+    main_data_processing uses iter_staged to keep the files of the next
+        kepids coming in while the workers process the current ones.
+
+    Args:
+        mirror: str; URL or directory of the mirror, or a source with
+            list_files and fetch methods.
+        stage_dir: str; staging directory. Default = 'data'
+        max_concurrency: int; transfers at once. Default = 8.
+        retries: int; retries of a failed transfer. Default = 3.
+        backoff: float; seconds before the first retry, doubled for
+            every other one. Default = 1.
+        lookahead: int; kepids fetched ahead of the one being
+            processed, see iter_staged. Default = 32.
+        timeout: float; seconds before an HTTP request is given up.
+            Default = 60.
+
+    Ex. with Prefetcher('https://archive.stsci.edu/pub/kepler/lightcurves',
+                        'data') as prefetcher:
+            main_data_processing(csv_file, prefetcher=prefetcher)
+    '''
+
+    def __init__(self, mirror, stage_dir='data', max_concurrency=8,
+                 retries=3, backoff=1., lookahead=32, timeout=60.):
+        if isinstance(mirror, str):
+            mirror = open_source(mirror, timeout)
+        self.source = mirror
+        self.stage_dir = stage_dir
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.lookahead = lookahead
+
+        ## Partial files are kept out of the kepid directories
+        self.partial_dir = os.path.join(stage_dir, '.partial')
+        if os.path.isdir(self.partial_dir) == False:
+            os.makedirs(self.partial_dir)
+
+        ## Only changed from the event loop thread
+        self.stats = collections.Counter()
+        self.failures = {}
+
+        self._futures = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='prefetcher', daemon=True)
+        self._thread.start()
+
+        ## The semaphore belongs to the loop it is created in
+        self._semaphore = asyncio.run_coroutine_threadsafe(
+            self._make_semaphore(), self._loop).result()
+
+    async def _make_semaphore(self):
+        return asyncio.Semaphore(self.max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''
+        Stops the event loop (cancelling what is still being fetched)
+            and the transfer threads.
+        '''
+
+        if self._loop.is_closed():
+            return
+        for future in self._futures.values():
+            future.cancel()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown(wait=True)
+
+        ## Transfers that were cancelled or failed
+        for name in os.listdir(self.partial_dir):
+            os.remove(os.path.join(self.partial_dir, name))
+
+    async def _retry(self, function, *args):
+        '''
+        Runs function(*args) in the thread pool, retrying on OSError
+            (e.g. timeouts, resets or HTTP 5xx) with an exponential
+            backoff. FetchErrors are not retried.
+        '''
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    return await self._loop.run_in_executor(
+                        self._executor, function, *args)
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                self.stats['retries'] += 1
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _fetch_file(self, kepid, name, size):
+        out_dir = os.path.join(self.stage_dir, kepid_subdir(kepid))
+        out_file = os.path.join(out_dir, name)
+
+        ## Already staged
+        if os.path.isfile(out_file) and (
+                size is None or os.path.getsize(out_file) == size):
+            self.stats['files_staged'] += 1
+            return out_file
+
+        if os.path.isdir(out_dir) == False:
+            os.makedirs(out_dir, exist_ok=True)
+        partial_file = os.path.join(self.partial_dir, name + '.part')
+        await self._retry(self.source.fetch, kepid, name, partial_file)
+        os.replace(partial_file, out_file)
+
+        self.stats['files_fetched'] += 1
+        self.stats['bytes_fetched'] += os.path.getsize(out_file)
+        return out_file
+
+    async def _fetch_kepid(self, kepid):
+        tasks = []
+        try:
+            files = await self._retry(self.source.list_files, kepid)
+            tasks = [asyncio.ensure_future(self._fetch_file(kepid, name, size))
+                     for name, size in files]
+            paths = await asyncio.gather(*tasks)
+        except Exception as error:
+            ## The kepid will not be processed, so the rest of its files
+            ## are not fetched (transfers already running end in
+            ## partial_dir and are never moved into place)
+            for task in tasks:
+                task.cancel()
+            self.failures[kepid] = '{}: {}'.format(type(error).__name__,
+                                                   error)
+            self.stats['kepids_failed'] += 1
+            raise
+        self.stats['kepids'] += 1
+        return sorted(paths)
+
+    def submit(self, kepid):
+        '''
+        The submit method starts fetching the fits files of a kepid (once
+            per kepid) and returns right away.
+
+        Returns:
+            future: concurrent.futures.Future of the sorted list of the
+                staged files of the kepid.
+        '''
+
+        kepid = int(kepid)
+        if kepid not in self._futures:
+            self._futures[kepid] = asyncio.run_coroutine_threadsafe(
+                self._fetch_kepid(kepid), self._loop)
+        return self._futures[kepid]
+
+    def fetch_kepids(self, kepids):
+        '''
+        The fetch_kepids method stages the fits files of all kepids
+            (e.g. before building a manifest of the staging directory)
+            and waits until they are done.
+
+        Returns:
+            failures: dict; kepid -> error of the kepids that failed.
+        '''
+
+        futures = [self.submit(kepid) for kepid in kepids]
+        concurrent.futures.wait(futures)
+        return dict(self.failures)
+
+    def iter_staged(self, rows, kepids):
+        '''
+        The iter_staged method yields the rows in order, each once the
+            files of its kepid are staged, while the files of the next
+            lookahead kepids are being fetched.
+        Rows whose kepid could not be fetched are yielded with the
+            error; some of their files may be staged, but not all of
+            them, so they should not be processed.
+
+        Args:
+            rows: iterable of row indices.
+            kepids: np.array; kepid of every row.
+
+        Yields:
+            (row, error): error is None once all files of the kepid
+                are staged.
+        '''
+
+        pending = collections.deque()
+        for row in rows:
+            pending.append((row, self.submit(kepids[row])))
+            if len(pending) > self.lookahead:
+                row, future = pending.popleft()
+                yield row, self._fetch_error(future)
+        while pending:
+            row, future = pending.popleft()
+            yield row, self._fetch_error(future)
+
+    def _fetch_error(self, future):
+        concurrent.futures.wait([future])
+        if future.cancelled():
+            return 'CancelledError: prefetcher was closed'
+        error = future.exception()
+        if error is None:
+            return None
+        return '{}: {}'.format(type(error).__name__, error)
+
+    def summary(self):
+        '''
+        Returns a one line summary of what was fetched.
+        '''
+
+        return ('Prefetched {} kepids: {} files fetched ({:.1f} MB), {} '
+                'already staged, {} retries, {} kepids failed'.format(
+                    self.stats['kepids'], self.stats['files_fetched'],
+                    self.stats['bytes_fetched'] / 1024.**2,
+                    self.stats['files_staged'], self.stats['retries'],
+                    self.stats['kepids_failed']))
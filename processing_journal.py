@@ -0,0 +1,137 @@
+################
+## Packages to be used
+####
+
+import json
+import csv
+import os
+
+################
+## Journal of the TCEs handled by main_data_processing
+####
+
+## Possible status of a TCE
+COMPLETED = 'completed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class ProcessingJournal(object):
+    '''
+    The ProcessingJournal class records, one JSON line per TCE, whether
+        a TCE was completed, failed (with the error) or skipped.
+    Lines are appended and flushed as the run goes, so after a crash
+        the journal says exactly which TCEs are left.
+
+    Args:
+        journal_file: str; location of the journal.
+            Default = 'processing_journal.jsonl'
+        resume: bool; keep the entries of a previous run. Otherwise the
+            journal is emptied. Default = False.
+    '''
+
+    def __init__(self, journal_file='processing_journal.jsonl', resume=False):
+        self.journal_file = journal_file
+
+        ## Latest entry of every row
+        self.entries = {}
+        if resume:
+            self.entries = read_journal(journal_file)
+
+        self._file = open(journal_file, 'a' if resume else 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        self._file.close()
+
+    def record(self, row, kepid, status, error=None):
+        '''
+        The record method appends the outcome of one TCE.
+
+        Args:
+            row: index of the TCE in tce_data.
+            kepid: Object of interest.
+            status: COMPLETED, FAILED or SKIPPED.
+            error: str describing the failure. Default = None.
+        '''
+
+        entry = {'row': int(row), 'kepid': int(kepid), 'status': status,
+                 'error': error}
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        self.entries[int(row)] = entry
+
+    def rows_with_status(self, *statuses):
+        '''
+        Returns the sorted rows whose latest status is one of statuses.
+        '''
+
+        return sorted(row for row, entry in self.entries.items()
+                      if entry['status'] in statuses)
+
+    def counts(self):
+        '''
+        Returns the number of rows per status.
+        '''
+
+        counts = {COMPLETED: 0, FAILED: 0, SKIPPED: 0}
+        for entry in self.entries.values():
+            counts[entry['status']] += 1
+        return counts
+
+    def write_report(self, report_file):
+        '''
+        The write_report method writes every failed and skipped TCE, with
+            its error, to a csv file.
+
+        Args:
+            report_file: str; location of the csv file.
+
+        Returns:
+            n_reported: int; number of TCEs in the report.
+        '''
+
+        rows = self.rows_with_status(FAILED, SKIPPED)
+        with open(report_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['row', 'kepid', 'status', 'error'])
+            for row in rows:
+                entry = self.entries[row]
+                writer.writerow([row, entry['kepid'], entry['status'],
+                                 entry['error']])
+
+        return len(rows)
+
+
+def read_journal(journal_file):
+    '''
+    The read_journal function reads a journal back.
+    Later lines override earlier ones for the same row, and a half
+        written last line (from a crash) is ignored.
+
+    Args:
+        journal_file: str; location of the journal.
+
+    Returns:
+        entries: dict; row -> latest entry.
+    '''
+
+    entries = {}
+    if os.path.isfile(journal_file) == False:
+        return entries
+
+    with open(journal_file) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['row']] = entry
+
+    return entries
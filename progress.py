@@ -0,0 +1,151 @@
+################
+## Packages to be used
+####
+
+import datetime
+import json
+import time
+import sys
+
+################
+## Progress and ETA reporting
+####
+
+class ProgressReporter(object):
+    '''
+    The ProgressReporter class reports the progress of a long run: how
+        many items are done, the rate, the ETA, the failures and the
+        cache hit rate.
+    It is only updated in the parent process (as results come back from
+        the workers), and prints at most once every interval seconds,
+        so it can be called for every item.
+
+    Args:
+        total: int; number of items in the run.
+        name: str; name of the run in the output. Default = 'Processing'
+        unit: str; name of the items. Default = 'TCEs'
+        interval: float; minimum number of seconds between two reports.
+            Default = 10.
+        log_format: 'text' for human readable lines, or 'json' for one
+            JSON object per line (for batch schedulers).
+            Default = 'text'.
+        stream: file to write to. Default = None (sys.stdout).
+        stats: RunStats to read the failures and cache hits from.
+            Default = None (only count what is passed to update).
+    '''
+
+    def __init__(self, total, name='Processing', unit='TCEs', interval=10.,
+                 log_format='text', stream=None, stats=None):
+        if log_format not in ('text', 'json'):
+            raise ValueError('Unknown log format: {}'.format(log_format))
+
+        self.total = total
+        self.name = name
+        self.unit = unit
+        self.interval = interval
+        self.log_format = log_format
+        self.stream = stream if stream is not None else sys.stdout
+        self.stats = stats
+
+        self.done = 0
+        self.statuses = {}
+        self.start = time.time()
+        self._last_report = self.start
+        self._last_done = 0
+
+    def update(self, n=1, status=None):
+        '''
+        Marks n more items as done (with the given status, if any) and
+            reports if the last report is older than interval.
+        '''
+
+        self.done += n
+        if status is not None:
+            self.statuses[status] = self.statuses.get(status, 0) + n
+
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self.report(now)
+
+    def snapshot(self, now=None):
+        '''
+        Returns the current progress as a dict.
+        '''
+
+        if now is None:
+            now = time.time()
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        recent = now - self._last_report
+        recent_rate = ((self.done - self._last_done) / recent
+                       if recent > 0 else 0.)
+        remaining = max(self.total - self.done, 0)
+
+        statuses = dict(self.statuses)
+        cache_hit_rate = None
+        if self.stats is not None:
+            statuses.update(self.stats.statuses)
+            hits = self.stats.counts.get('cache_hits', 0)
+            misses = self.stats.counts.get('cache_misses', 0)
+            if hits + misses:
+                cache_hit_rate = hits / float(hits + misses)
+
+        return {
+            'event': 'progress',
+            'name': self.name,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'done': self.done,
+            'total': self.total,
+            'percent': 100. * self.done / self.total if self.total else 100.,
+            'elapsed_seconds': elapsed,
+            'rate': rate,
+            'recent_rate': recent_rate,
+            'eta_seconds': remaining / rate if rate > 0 else None,
+            'statuses': statuses,
+            'cache_hit_rate': cache_hit_rate,
+        }
+
+    def report(self, now=None, event='progress'):
+        '''
+        Writes the current progress (whatever the interval).
+        '''
+
+        progress = self.snapshot(now)
+        progress['event'] = event
+        self._last_report = time.time() if now is None else now
+        self._last_done = self.done
+
+        if self.log_format == 'json':
+            line = json.dumps(progress)
+        else:
+            line = self._format_text(progress)
+
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def close(self):
+        '''
+        Writes the final report (event 'finished' in json logs).
+        '''
+
+        self.report(event='finished')
+
+    def _format_text(self, progress):
+        line = '{}: {}/{} {} ({:.1f}%), {:.2f} {}/s'.format(
+            self.name, progress['done'], progress['total'], self.unit,
+            progress['percent'], progress['rate'], self.unit)
+
+        if progress['done'] < progress['total']:
+            eta = progress['eta_seconds']
+            line += ', ETA {}'.format(
+                '?' if eta is None
+                else datetime.timedelta(seconds=int(round(eta))))
+
+        for status in ('failed', 'skipped'):
+            if progress['statuses'].get(status):
+                line += ', {} {}'.format(progress['statuses'][status], status)
+
+        if progress['cache_hit_rate'] is not None:
+            line += ', cache hits {:.0%}'.format(progress['cache_hit_rate'])
+
+        return line
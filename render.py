@@ -0,0 +1,328 @@
+################
+## Packages to be used
+####
+
+## matplotlib is only imported in the processes that draw, and only its
+## Agg canvas: no pyplot, no GUI backend and no display are needed
+import concurrent.futures
+import multiprocessing
+import pandas as pd
+import numpy as np
+import os
+
+from progress import ProgressReporter
+
+################
+## Selecting the light curves to render
+####
+
+def read_scores(scores_file, tce_data):
+    '''
+    The read_scores function looks up the probability written by
+        main_scoring for every TCE, by kepid and tce_plnt_num (NaN if
+        it was not scored or failed).
+    Scores without a tce_plnt_num (scored from a .npy flux array) are
+        only used for kepids with a single TCE in tce_data.
+
+    Args:
+        scores_file: str; csv written by main_scoring.
+        tce_data: DataFrame with the kepid and tce_plnt_num of every row
+            (flux_tce_order.csv, or FluxStore.tce_data()).
+
+    Returns:
+        scores: np.array of floats, one per row of tce_data.
+    '''
+
+    scored = pd.read_csv(scores_file)
+    scored['kepid'] = scored['kepid'].astype(np.int64)
+    scored['probability'] = scored['probability'].astype(float)
+    kepids = tce_data['kepid'].values.astype(np.int64)
+    plnt_nums = tce_data['tce_plnt_num'].values.astype(np.int64)
+
+    ## Scores of every TCE
+    by_tce = scored[scored['tce_plnt_num'].notnull()].drop_duplicates(
+        ['kepid', 'tce_plnt_num'])
+    scores = dict(zip(zip(by_tce['kepid'].tolist(),
+                          by_tce['tce_plnt_num'].astype(np.int64).tolist()),
+                      by_tce['probability'].tolist()))
+
+    ## Scores of kepids, for kepids with a single TCE
+    single = pd.Series(kepids).value_counts()
+    single = set(single.index[single == 1].tolist())
+    by_kepid = scored[scored['tce_plnt_num'].isnull() &
+                      scored['kepid'].isin(single)].drop_duplicates('kepid')
+    for kepid, probability in zip(by_kepid['kepid'].tolist(),
+                                  by_kepid['probability'].tolist()):
+        plnt_num = int(plnt_nums[kepids == kepid][0])
+        scores.setdefault((kepid, plnt_num), probability)
+
+    return np.array([scores.get(tce, np.nan)
+                     for tce in zip(kepids.tolist(), plnt_nums.tolist())])
+
+
+def select_rows(kepid_labels, label=None, scores=None, min_score=None,
+                max_score=None, rows=None, sort_by_score=False):
+    '''
+    The select_rows function picks the rows to render.
+
+    Args:
+        kepid_labels: np.array; kepids and labels of every row (see
+            main_data_processing).
+        label: str or list of str; only keep these labels (e.g. 'PC').
+            Default = None (all labels).
+        scores: np.array; model score of every row (see read_scores).
+            Default = None.
+        min_score, max_score: only keep rows scored within these bounds.
+            Default = None.
+        rows: np.array; only pick among these rows (e.g. a split, see
+            tfrecords_creation.split_indices). Default = None (all).
+        sort_by_score: bool; highest scores first. Default = False
+            (order of the rows).
+
+    Returns:
+        rows: np.array of row indices.
+    '''
+
+    if rows is None:
+        rows = np.arange(len(kepid_labels))
+    rows = np.asarray(rows, dtype=np.int64)
+    keep = np.ones(len(rows), dtype=bool)
+
+    if label is not None:
+        labels = [label] if isinstance(label, str) else list(label)
+        keep &= np.isin(np.asarray(kepid_labels)[rows, 1].astype(str),
+                        labels)
+
+    if scores is not None:
+        row_scores = np.asarray(scores, dtype=float)[rows]
+        with np.errstate(invalid='ignore'):
+            if min_score is not None:
+                keep &= row_scores >= min_score
+            if max_score is not None:
+                keep &= row_scores <= max_score
+        if sort_by_score:
+            order = np.argsort(-np.where(keep, row_scores, -np.inf),
+                               kind='stable')
+            return rows[order[:int(keep.sum())]]
+
+    return rows[keep]
+
+
+################
+## Drawing pages of light curves
+####
+
+class PageRenderer(object):
+    '''
+    The PageRenderer class draws light curves into PNG pages of
+        nrows x ncols panels.
+    The figure, its axes and one line per panel are made once; every
+        page only replaces their data and titles, which is much faster
+        than building a LightCurve and a new figure per light curve.
+
+    Args:
+        nrows, ncols: int; panels per page. Default = 4, 5.
+        panel_size: (width, height) of a panel in inches.
+            Default = (3.2, 2.0).
+        dpi: int; resolution of the pages. Default = 100.
+        marker_size: float; size of the points. Default = 1.
+    '''
+
+    def __init__(self, nrows=4, ncols=5, panel_size=(3.2, 2.0), dpi=100,
+                 marker_size=1.):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.dpi = dpi
+        self.figure = Figure(figsize=(panel_size[0] * ncols,
+                                      panel_size[1] * nrows))
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.subplots(nrows, ncols, squeeze=False).ravel()
+        self.lines = [ax.plot([], [], '.', color='k', markersize=marker_size,
+                              linestyle='none')[0]
+                      for ax in self.axes]
+        ## Few, fixed ticks: laying out tick labels is most of the
+        ## drawing time
+        from matplotlib.ticker import MaxNLocator
+        for ax in self.axes:
+            ax.set_xlim(-0.5, 0.5)
+            ax.set_xticks([-0.25, 0, 0.25])
+            ax.set_xticklabels([])
+            ax.yaxis.set_major_locator(MaxNLocator(3))
+            ax.tick_params(labelsize=6, length=2)
+        self.figure.subplots_adjust(left=0.03, right=0.99, bottom=0.04,
+                                    top=0.96, wspace=0.25, hspace=0.45)
+
+    def __len__(self):
+        return len(self.axes)
+
+    def render(self, out_file, flux, titles):
+        '''
+        The render method draws up to len(self) light curves and saves
+            the page to out_file.
+
+        Args:
+            out_file: str; location of the PNG page.
+            flux: np.array; one light curve per row, binned in phase
+                (see main_data_processing).
+            titles: list of str; title of every panel.
+        '''
+
+        for i, (ax, line) in enumerate(zip(self.axes, self.lines)):
+            if i >= len(flux):
+                ax.set_visible(False)
+                continue
+            ax.set_visible(True)
+
+            y = np.asarray(flux[i], dtype=float)
+            x = np.linspace(-0.5, 0.5, len(y))
+            line.set_data(x, y)
+            ax.set_title(titles[i], fontsize=7)
+
+            ## Limits from the finite points only
+            finite = np.isfinite(y)
+            if finite.any():
+                low, high = y[finite].min(), y[finite].max()
+                margin = 0.05 * (high - low) or 1e-4
+                ax.set_ylim(low - margin, high + margin)
+
+        self.figure.savefig(out_file, dpi=self.dpi)
+
+
+## Renderer of this process, kept between the pages it is given
+_renderer = None
+_renderer_options = None
+
+
+def _render_pages(pages, renderer_options):
+    '''
+    Renders a list of (out_file, flux, titles) pages; runs in the worker
+        processes of render_pages.
+    '''
+
+    global _renderer, _renderer_options
+    if _renderer is None or _renderer_options != renderer_options:
+        _renderer = PageRenderer(**renderer_options)
+        _renderer_options = renderer_options
+
+    for out_file, flux, titles in pages:
+        _renderer.render(out_file, flux, titles)
+    return len(pages)
+
+
+def render_pages(data, kepid_labels, out_dir='pages', rows=None,
+                 scores=None, plnt_nums=None, nrows=4, ncols=5, n_workers=1,
+                 pages_per_task=5, prefix='page', dpi=100, marker_size=1.,
+                 log_format='text'):
+    '''
+    The render_pages function draws many light curves into grid-tiled
+        PNG pages, without a display, in n_workers processes.
+    Every worker keeps one figure and reuses it for all its pages (see
+        PageRenderer). Rows are read from data a task at a time, so
+        data can be the memory-mapped flux store or the flux of a
+        flux_store.FluxStore.
+
+    Args:
+        data: np.array; flux of every row (e.g. flux_data.npy).
+        kepid_labels: np.array; kepids and labels of every row.
+        out_dir: str; directory the pages are written to.
+            Default = 'pages'
+        rows: np.array; rows to render, in this order (see
+            select_rows). Default = None (all rows).
+        scores: np.array; model score of every row, shown in the
+            titles. Default = None.
+        plnt_nums: np.array; tce_plnt_num of every row, shown in the
+            titles and the index. Default = None.
+        nrows, ncols: int; panels per page. Default = 4, 5.
+        n_workers: int; number of worker processes. Default = 1.
+        pages_per_task: int; pages sent to a worker at once.
+            Default = 5.
+        prefix: str; pages are named <prefix>-00000.png, ...
+            Default = 'page'
+        dpi: int; resolution of the pages. Default = 100.
+        marker_size: float; size of the points. Default = 1.
+        log_format: 'text' or 'json', see ProgressReporter.
+            Default = 'text'.
+
+    Writes Out:
+        The PNG pages in out_dir, and out_dir/<prefix>_index.csv giving
+            the page and panel of every kepid (and tce_plnt_num).
+
+    Returns:
+        files: list of str; the pages written.
+    '''
+
+    from tfrecords_creation import RowView
+
+    if os.path.isdir(out_dir) == False:
+        os.makedirs(out_dir)
+
+    if rows is None:
+        rows = np.arange(len(kepid_labels))
+    rows = np.asarray(rows, dtype=np.int64)
+    kepid_labels = np.asarray(kepid_labels).astype(str)
+
+    ## Panel titles
+    titles = []
+    for row in rows:
+        title = 'kepid-{}'.format(kepid_labels[row][0].zfill(9))
+        if plnt_nums is not None:
+            title += '.{}'.format(plnt_nums[row])
+        title += ' ' + kepid_labels[row][1]
+        if scores is not None:
+            title += ' p={:.3f}'.format(scores[row])
+        titles.append(title)
+
+    per_page = nrows * ncols
+    n_pages = int(np.ceil(len(rows) / float(per_page)))
+    files = [os.path.join(out_dir, '{}-{:05d}.png'.format(prefix, page))
+             for page in range(n_pages)]
+
+    ## Which page and panel every kepid is on
+    index = pd.DataFrame({'kepid': kepid_labels[rows, 0],
+                          'label': kepid_labels[rows, 1],
+                          'page': [os.path.basename(files[i // per_page])
+                                   for i in range(len(rows))],
+                          'panel': np.arange(len(rows)) % per_page})
+    if plnt_nums is not None:
+        index.insert(1, 'tce_plnt_num', np.asarray(plnt_nums)[rows])
+    index.to_csv(os.path.join(out_dir, prefix + '_index.csv'), index=False)
+
+    renderer_options = {'nrows': nrows, 'ncols': ncols, 'dpi': dpi,
+                        'marker_size': marker_size}
+    flux = RowView(data, rows)
+
+    def tasks():
+        ## Reading the rows of a task only when it is submitted
+        for first in range(0, n_pages, pages_per_task):
+            pages = []
+            for page in range(first, min(first + pages_per_task, n_pages)):
+                start, stop = page * per_page, (page + 1) * per_page
+                pages.append((files[page], np.asarray(flux[start:stop]),
+                              titles[start:stop]))
+            yield pages
+
+    progress = ProgressReporter(n_pages, 'Rendering', unit='pages',
+                                log_format=log_format)
+
+    if n_workers <= 1:
+        for pages in tasks():
+            progress.update(_render_pages(pages, renderer_options))
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+        with executor:
+            ## Keeping at most two tasks per worker in flight
+            pending = []
+            for pages in tasks():
+                pending.append(executor.submit(_render_pages, pages,
+                                               renderer_options))
+                if len(pending) >= 2 * n_workers:
+                    progress.update(pending.pop(0).result())
+            for future in pending:
+                progress.update(future.result())
+
+    progress.close()
+
+    return files
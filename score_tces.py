@@ -0,0 +1,290 @@
+################
+## Packages to be used
+####
+
+import kepler_data_processing as kdp
+import pandas as pd
+import numpy as np
+import time
+import csv
+import os
+
+################
+## Methods to be used for scoring new TCEs
+####
+
+def load_scoring_model(model_file='model.h5', num_threads=None):
+    '''
+    The load_scoring_model function loads the model saved by fit_model,
+        or a .tflite model written by model_export.main_export.
+
+    Args:
+        model_file: str; location of the HDF5 or .tflite model.
+            Default = 'model.h5'
+        num_threads: int; threads of the TFLite interpreter.
+            Default = None.
+
+    Returns:
+        model: tf.keras model or model_export.TFLiteModel, ready for
+            predictions.
+    '''
+
+    if os.path.splitext(model_file)[1] == '.tflite':
+        from model_export import TFLiteModel
+        return TFLiteModel(model_file, num_threads)
+
+    import tensorflow as tf
+
+    return tf.keras.models.load_model(model_file, compile=False)
+
+
+def read_tce_csv(csv_file):
+    '''
+    The read_tce_csv function opens a csv of TCEs to be scored.
+    Unlike open_files, no TCE is removed or shuffled, and the
+        av_training_set column is optional (new TCEs have no label).
+
+    Args:
+        csv_file: Should contain kepid, tce_plnt_num, tce_period and
+            tce_time0bk; tce_duration is kept if present.
+
+    Returns:
+        tce_data: Panda DataFrame that has the parameters listed above.
+    '''
+
+    tce_info = pd.read_csv(csv_file)
+    if 'av_training_set' not in tce_info:
+        tce_info['av_training_set'] = 'UNK'
+
+    tce_data = tce_info[['kepid',
+                         'av_training_set',
+                         'tce_plnt_num',
+                         'tce_period',
+                         'tce_time0bk'] +
+                        [c for c in kdp.OPTIONAL_COLUMNS
+                         if c in tce_info]].reset_index(drop=True)
+
+    ## Building the kepid index once for get_metadata
+    kdp.attach_metadata_index(tce_data)
+
+    return tce_data
+
+
+def iter_csv_fluxes(csv_file, n_workers=1, max_in_flight=None,
+                    flux_kwargs=None):
+    '''
+    The iter_csv_fluxes function processes the TCEs of a csv in
+        parallel (see kdp.iter_processed_tces), in csv order. Every TCE
+        is folded at its own period and t0, also when its kepid has
+        several TCEs.
+
+    Yields:
+        (kepid, tce_plnt_num, flux, error) for every TCE; flux is None
+            if the TCE could not be processed.
+    '''
+
+    tce_data = read_tce_csv(csv_file)
+    kepids = tce_data['kepid'].values
+    plnt_nums = tce_data['tce_plnt_num'].values
+
+    for i, flux, _, error in kdp.iter_processed_tces(
+            tce_data, n_workers=n_workers, max_in_flight=max_in_flight,
+            flux_kwargs=flux_kwargs, per_tce=True):
+        yield kepids[i], plnt_nums[i], flux, error
+
+
+def iter_array_fluxes(flux_file, kepids_file, labels_file=None):
+    '''
+    The iter_array_fluxes function reads already processed TCEs from a
+        memory-mapped flux array (e.g. flux_data.npy and flux_kepids.npy
+        written by main_data_processing).
+    Rows that were not processed (label -1 in flux_labels.npy, see
+        open_flux_store) are not scored. Without a labels file, rows
+        that are all NaN are taken as not processed.
+
+    Args:
+        flux_file: str; the flux array.
+        kepids_file: str; kepid of every row.
+        labels_file: str; label of every row.
+            Default = None (flux_labels.npy next to flux_file, if any).
+
+    Yields:
+        (kepid, tce_plnt_num, flux, error) for every row; tce_plnt_num
+            is unknown and left empty. flux is None for rows that were
+            not processed.
+    '''
+
+    flux_data = np.load(flux_file, mmap_mode='r')
+    kepids = np.load(kepids_file, mmap_mode='r')
+
+    if labels_file is None:
+        labels_file = os.path.join(os.path.dirname(flux_file),
+                                   'flux_labels.npy')
+    labels = None
+    if os.path.isfile(labels_file):
+        labels = np.load(labels_file, mmap_mode='r')
+
+    for i in range(len(flux_data)):
+        if labels is not None:
+            processed = labels[i] >= 0
+        else:
+            processed = not np.isnan(flux_data[i]).all()
+        if processed:
+            yield kepids[i], '', flux_data[i], None
+        else:
+            yield kepids[i], '', None, 'not processed'
+
+
+def summarize_latencies(latencies):
+    '''
+    Returns the p50, p90 and p99 of latencies (in seconds), in ms.
+    '''
+
+    if len(latencies) == 0:
+        return {'p50_ms': None, 'p90_ms': None, 'p99_ms': None}
+
+    p50, p90, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 90, 99])
+    return {'p50_ms': float(p50), 'p90_ms': float(p90), 'p99_ms': float(p99)}
+
+
+def score_stream(model, items, out_file, batch_size=256):
+    '''
+    The score_stream function feeds processed TCEs to the model in
+        fixed-size batches and writes the results as soon as every
+        batch is scored.
+    The last batch is padded, so the model always sees the same input
+        shape.
+
+    Args:
+        model: tf.keras model, see load_scoring_model.
+        items: iterable of (kepid, tce_plnt_num, flux, error).
+        out_file: str; csv the scores are written to.
+        batch_size: int; number of TCEs per forward pass. Default = 256.
+
+    Returns:
+        stats: dict with the number of scored and failed TCEs, the
+            throughput and the batch latency percentiles.
+    '''
+
+    ## Fixed-size input batch, reused for every forward pass
+    batch = np.zeros((batch_size, kdp.FLUX_LEN, 1), dtype=np.float32)
+    batch_ids = []
+
+    batch_latencies = []
+    scored = 0
+    failed = 0
+    start = time.time()
+
+    with open(out_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['kepid', 'tce_plnt_num', 'probability', 'error'])
+
+        def flush_batch():
+            batch_start = time.perf_counter()
+            probabilities = np.asarray(model.predict_on_batch(batch))
+            batch_latencies.append(time.perf_counter() - batch_start)
+
+            for j, (kepid, plnt_num) in enumerate(batch_ids):
+                writer.writerow([kepid, plnt_num,
+                                 float(probabilities[j].ravel()[0]), ''])
+            f.flush()
+            del batch_ids[:]
+
+        for kepid, plnt_num, flux, error in items:
+            ## TCEs that could not be processed are written right away
+            if flux is None:
+                writer.writerow([kepid, plnt_num, '', error])
+                failed += 1
+                continue
+
+            try:
+                kdp.write_flux_row(batch[:, :, 0], len(batch_ids), flux)
+            except ValueError as e:
+                writer.writerow([kepid, plnt_num, '', str(e)])
+                failed += 1
+                continue
+            batch_ids.append((kepid, plnt_num))
+            scored += 1
+
+            if len(batch_ids) == batch_size:
+                flush_batch()
+
+        ## Padding and scoring the last batch
+        if batch_ids:
+            batch[len(batch_ids):] = 0
+            flush_batch()
+
+    elapsed = time.time() - start
+    stats = {
+        'scored': scored,
+        'failed': failed,
+        'seconds': elapsed,
+        'tces_per_second': scored / max(elapsed, 1e-9),
+        'batch_size': batch_size,
+        'batch_latency': summarize_latencies(batch_latencies),
+    }
+
+    return stats
+
+
+################
+## Main method for scoring
+####
+
+def main_scoring(source, model_file='model.h5', out_file='scores.csv',
+                 batch_size=256, n_workers=1, max_in_flight=None,
+                 kepids_file='flux_kepids.npy', labels_file=None,
+                 **flux_kwargs):
+    '''
+    The main_scoring function scores new TCEs with a trained model.
+
+    Args:
+        source: str; either a csv of TCEs (processed here with
+            get_flux_vector, in n_workers processes) or a .npy flux
+            array that was already processed.
+        model_file: str; location of the HDF5 or .tflite model.
+            Default = 'model.h5'
+        out_file: str; csv the scores are written to.
+            Default = 'scores.csv'
+        batch_size: int; number of TCEs per forward pass. Default = 256.
+        n_workers: int; number of worker processes used to process the
+            csv. Default = 1.
+        max_in_flight: int; see kdp.iter_processed_tces.
+        kepids_file: str; kepids of every row of a .npy source.
+            Default = 'flux_kepids.npy'
+        labels_file: str; labels of every row of a .npy source; rows
+            that were not processed are written with an error.
+            Default = None (flux_labels.npy next to the source).
+        **flux_kwargs: passed on to get_flux_vector (e.g. cache,
+            manifest, fold_backend).
+
+    Writes Out:
+        out_file with kepid, tce_plnt_num, probability and error columns.
+
+    Returns:
+        stats: dict with the throughput and latency of the run.
+    '''
+
+    print('Commencing scoring of {}...'.format(source))
+
+    model = load_scoring_model(model_file)
+
+    if os.path.splitext(source)[1] == '.npy':
+        items = iter_array_fluxes(source, kepids_file, labels_file)
+    else:
+        items = iter_csv_fluxes(source, n_workers=n_workers,
+                                max_in_flight=max_in_flight,
+                                flux_kwargs=flux_kwargs)
+
+    stats = score_stream(model, items, out_file, batch_size)
+
+    latency = stats['batch_latency']
+    print('Scored {} TCEs ({} failed) in {:.2f} seconds: {:.1f} TCEs/sec'.format(
+        stats['scored'], stats['failed'], stats['seconds'],
+        stats['tces_per_second']))
+    if latency['p50_ms'] is not None:
+        print('Batch latency (batch_size={}): p50 {:.1f} ms, p90 {:.1f} ms, '
+              'p99 {:.1f} ms'.format(batch_size, latency['p50_ms'],
+                                     latency['p90_ms'], latency['p99_ms']))
+
+    return stats
@@ -0,0 +1,305 @@
+################
+## Packages to be used
+####
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from score_tces import load_scoring_model, read_tce_csv, summarize_latencies
+from flux_cache import FluxCache
+import kepler_data_processing as kdp
+import urllib.parse
+import numpy as np
+import concurrent.futures
+import collections
+import threading
+import queue
+import json
+import time
+
+################
+## Micro-batching of concurrent requests
+####
+
+class MicroBatcher(object):
+    '''
+    The MicroBatcher class groups concurrent predictions into a single
+        forward pass of the model.
+    A batch is run as soon as max_batch requests are waiting, or
+        max_wait_ms after the first one arrived. Batches are padded to
+        max_batch (like in score_stream), so the model always sees the
+        same input shape and a TFLite interpreter is never resized.
+
+    Args:
+        model: tf.keras model, see load_scoring_model.
+        max_batch: int; largest number of TCEs per forward pass.
+            Default = 32.
+        max_wait_ms: float; longest time a request waits for others to
+            join its batch. Default = 5.
+    '''
+
+    def __init__(self, model, max_batch=32, max_wait_ms=5):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.batch_sizes = collections.deque(maxlen=10000)
+        self._queue = queue.Queue()
+
+        ## Only used by the batching thread
+        self._flux_batch = np.zeros((max_batch, kdp.FLUX_LEN, 1), np.float32)
+
+        ## One forward pass to build the graph (or size the TFLite input)
+        ## before the first request
+        model.predict_on_batch(self._flux_batch)
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def predict(self, flux):
+        '''
+        Returns the planet probability of one processed flux vector.
+            Blocks until the batch holding it has been run.
+        '''
+
+        request = {'flux': flux, 'done': threading.Event()}
+        self._queue.put(request)
+        request['done'].wait()
+
+        if 'error' in request:
+            raise request['error']
+        return request['probability']
+
+    def _next_batch(self):
+        ## Waiting for the first request, then for more until the batch
+        ## is full or the first request has waited long enough
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    if 'probability' not in request:
+                        request.setdefault('error', e)
+            finally:
+                ## Whatever happened, no request is left waiting
+                self.batch_sizes.append(len(batch))
+                for request in batch:
+                    request['done'].set()
+
+    def _run_batch(self, batch):
+        ## A malformed flux only fails its own request
+        flux_batch = self._flux_batch
+        scored = []
+        for request in batch:
+            try:
+                kdp.write_flux_row(flux_batch[:, :, 0], len(scored),
+                                   request['flux'])
+            except Exception as e:
+                request['error'] = e
+                continue
+            scored.append(request)
+        if not scored:
+            return
+        flux_batch[len(scored):] = 0
+
+        probabilities = np.asarray(
+            self.model.predict_on_batch(flux_batch)).reshape(-1)
+        for j, request in enumerate(scored):
+            request['probability'] = float(probabilities[j])
+
+
+################
+## Scoring service
+####
+
+class ScoringService(object):
+    '''
+    The ScoringService class keeps everything needed to score a kepid
+        warm: the TCE metadata, the loaded model, a pool of processes
+        running get_flux_vector, and the on-disk FluxCache of processed
+        light curves.
+
+    Args:
+        csv_file: csv of the TCEs that can be scored (see read_tce_csv).
+        model_file: str; location of the HDF5 or .tflite model.
+            Default = 'model.h5'
+        n_workers: int; number of processes processing light curves.
+            Default = 2.
+        cache: FluxCache of processed light curves.
+            Default = None (a FluxCache in 'flux_cache').
+        max_batch: int; see MicroBatcher. Default = 32.
+        max_wait_ms: float; see MicroBatcher. Default = 5.
+        **flux_kwargs: passed on to get_flux_vector (e.g. manifest,
+            fold_backend, reader).
+    '''
+
+    def __init__(self, csv_file, model_file='model.h5', n_workers=2,
+                 cache=None, max_batch=32, max_wait_ms=5, **flux_kwargs):
+        if cache is None:
+            cache = FluxCache()
+        flux_kwargs['cache'] = cache
+
+        self.tce_data = read_tce_csv(csv_file)
+        self.index = kdp.get_metadata_index(self.tce_data)
+        self.batcher = MicroBatcher(load_scoring_model(model_file),
+                                    max_batch, max_wait_ms)
+
+        ## Light curves are processed in other processes, so requests
+        ## being processed do not hold up the model
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=kdp._init_worker,
+            initargs=(self.tce_data, flux_kwargs))
+
+        self.latencies = collections.deque(maxlen=10000)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def score(self, kepid):
+        '''
+        The score method returns the planet probability of a kepid.
+
+        Args:
+            kepid: Object of interest.
+
+        Returns:
+            result: dict with the kepid, its probability and the time
+                it took in ms.
+        '''
+
+        start = time.perf_counter()
+        try:
+            if kepid not in self.index:
+                raise KeyError('kepid {} is not in the TCE csv'.format(kepid))
+
+            _, flux, _, error, _ = self.executor.submit(
+                kdp.process_tce, 0, kepid).result()
+            if flux is None:
+                raise RuntimeError(error)
+
+            probability = self.batcher.predict(flux)
+        except Exception:
+            with self._lock:
+                self.requests += 1
+                self.errors += 1
+            raise
+
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(latency)
+
+        return {'kepid': kepid, 'probability': probability,
+                'latency_ms': latency * 1000}
+
+    def stats(self):
+        '''
+        Returns the request counts and latency percentiles so far.
+        '''
+
+        with self._lock:
+            latencies = list(self.latencies)
+            stats = {'requests': self.requests, 'errors': self.errors}
+
+        stats['latency'] = summarize_latencies(latencies)
+        batch_sizes = list(self.batcher.batch_sizes)
+        stats['mean_batch_size'] = (float(np.mean(batch_sizes))
+                                    if batch_sizes else None)
+        return stats
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    '''
+    Answers GET /score?kepid=<kepid> and GET /stats with JSON.
+    '''
+
+    ## Set by serve
+    service = None
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/stats':
+            self._send_json(200, self.service.stats())
+        elif url.path == '/score':
+            try:
+                kepid = int(query['kepid'][0])
+            except (KeyError, ValueError):
+                self._send_json(400, {'error': 'expected /score?kepid=<int>'})
+                return
+            try:
+                self._send_json(200, self.service.score(kepid))
+            except KeyError as e:
+                self._send_json(404, {'kepid': kepid, 'error': str(e)})
+            except Exception as e:
+                self._send_json(500, {'kepid': kepid, 'error': str(e)})
+        else:
+            self._send_json(404, {'error': 'unknown path ' + url.path})
+
+    def log_message(self, format, *args):
+        ## Keeping the console quiet; /stats has the numbers
+        pass
+
+
+################
+## Main method for the scoring service
+####
+
+def serve(csv_file, model_file='model.h5', host='127.0.0.1', port=8080,
+          **service_kwargs):
+    '''
+    The serve function runs the scoring service over HTTP until it is
+        interrupted.
+        Ex. curl 'http://127.0.0.1:8080/score?kepid=6022556'
+            curl 'http://127.0.0.1:8080/stats'
+
+    Args:
+        csv_file: csv of the TCEs that can be scored.
+        model_file: str; location of the HDF5 or .tflite model.
+            Default = 'model.h5'
+        host: str; address to listen on. Default = '127.0.0.1'
+        port: int; port to listen on. Default = 8080.
+        **service_kwargs: passed on to ScoringService.
+    '''
+
+    print('Loading model and TCEs...')
+    service = ScoringService(csv_file, model_file, **service_kwargs)
+    ScoringHandler.service = service
+
+    server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.daemon_threads = True
+    print('Scoring service listening on http://{}:{}'.format(host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        print(json.dumps(service.stats()))
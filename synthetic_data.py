@@ -0,0 +1,224 @@
+################
+## Packages to be used
+####
+
+## astropy is only imported when files are written
+import pandas as pd
+import numpy as np
+import os
+
+################
+## Methods to be used for generating synthetic Kepler data
+####
+
+## Kepler long cadence, in days
+LONG_CADENCE = 0.0204335
+
+## Approximate start (BKJD) and length (days) of quarters Q1-Q17
+QUARTER_STARTS = [131.5, 169.5, 260.2, 352.4, 443.5, 539.5, 630.2, 720.0,
+                  815.5, 906.8, 1001.0, 1097.0, 1182.0, 1275.0, 1373.0,
+                  1472.0, 1559.0]
+QUARTER_LENGTHS = [33.5, 89.0, 89.3, 89.0, 93.0, 88.0, 89.0, 67.0, 92.5,
+                   94.0, 93.5, 84.0, 92.0, 97.0, 98.0, 86.0, 32.0]
+
+## Quality flags set on some cadences (Desat, ManualExclude, ApertureCosmic)
+DESAT = 32
+MANUAL_EXCLUDE = 256
+APERTURE_COSMIC = 128
+
+
+def transit_model(time, period, t0, duration, depth):
+    '''
+    The transit_model function returns a trapezoid-shaped transit
+        signal (1 out of transit, 1 - depth at mid-transit).
+
+    Args:
+        time: np.array; times in days (BKJD).
+        period: float; orbital period in days.
+        t0: float; time of a mid-transit.
+        duration: float; full transit duration in days.
+        depth: float; fractional transit depth.
+
+    Returns:
+        signal: np.array; multiplicative transit signal.
+    '''
+
+    ## Distance to the closest mid-transit, in days
+    phase = (time - t0 + 0.5 * period) % period - 0.5 * period
+    x = np.abs(phase) / (0.5 * duration)
+
+    ## Flat bottom for the inner 60%, linear ingress/egress after that
+    shape = np.clip((1 - x) / 0.4, 0, 1)
+    return 1 - depth * shape
+
+
+def make_quarter(rng, quarter, period, t0, label):
+    '''
+    The make_quarter function generates one quarter of PDCSAP_FLUX for a
+        star: stellar variability, white noise, an injected transit
+        (PC), an eclipsing binary (AFP) or nothing (NTP), a data
+        downlink gap, NaN runs and quality flagged cadences.
+
+    Args:
+        rng: np.random.RandomState
+        quarter: int; Kepler quarter (1-17).
+        period: float; period of the TCE in days.
+        t0: float; time of a mid-transit (BKJD).
+        label: str; 'PC', 'AFP' or 'NTP'.
+
+    Returns:
+        columns: dict of the fits table columns.
+    '''
+
+    start = QUARTER_STARTS[quarter-1]
+    n = int(QUARTER_LENGTHS[quarter-1] / LONG_CADENCE)
+    cadenceno = np.arange(n) + int(start / LONG_CADENCE)
+    time = start + np.arange(n) * LONG_CADENCE
+
+    ## Stellar variability and a slow instrumental trend
+    level = rng.uniform(2e3, 2e5)
+    variability = (rng.uniform(0, 2e-3) *
+                   np.sin(2 * np.pi * time / rng.uniform(2, 30) +
+                          rng.uniform(0, 2 * np.pi)))
+    trend = rng.uniform(-5e-4, 5e-4) * (time - start) / (time[-1] - start)
+    noise_level = rng.uniform(5e-5, 5e-4)
+    signal = 1 + variability + trend + rng.normal(0, noise_level, n)
+
+    ## Injected signal
+    duration = min(rng.uniform(0.08, 0.5), 0.1 * period)
+    if label == 'PC':
+        signal *= transit_model(time, period, t0, duration,
+                                rng.uniform(2e-4, 1e-2))
+    elif label == 'AFP':
+        ## Primary and secondary eclipses of an eclipsing binary
+        signal *= transit_model(time, period, t0, duration,
+                                rng.uniform(1e-2, 1e-1))
+        signal *= transit_model(time, period, t0 + 0.5 * period, duration,
+                                rng.uniform(1e-3, 2e-2))
+
+    flux = (level * signal).astype(np.float32)
+    flux_err = np.full(n, level * noise_level, dtype=np.float32)
+    quality = np.zeros(n, dtype=np.int32)
+
+    ## Data downlink gap in the middle of the quarter
+    gap_start = rng.randint(n // 3, 2 * n // 3)
+    gap = slice(gap_start, gap_start + rng.randint(20, 60))
+    flux[gap] = np.nan
+    flux_err[gap] = np.nan
+    quality[gap] |= MANUAL_EXCLUDE
+
+    ## Short NaN runs and quality flagged cadences
+    for _ in range(rng.randint(0, 5)):
+        nan_start = rng.randint(0, n - 10)
+        flux[nan_start:nan_start + rng.randint(1, 10)] = np.nan
+    flagged = rng.choice(n, size=n // 200, replace=False)
+    quality[flagged] |= rng.choice([DESAT, APERTURE_COSMIC], size=len(flagged))
+
+    return {
+        'TIME': time,
+        'CADENCENO': cadenceno.astype(np.int32),
+        'SAP_FLUX': flux * np.float32(1.02),
+        'SAP_FLUX_ERR': flux_err,
+        'PDCSAP_FLUX': flux,
+        'PDCSAP_FLUX_ERR': flux_err,
+        'SAP_QUALITY': quality,
+    }
+
+
+def write_quarter(path, kepid, quarter, columns):
+    '''
+    The write_quarter function writes one quarter as a Kepler light
+        curve fits file that lk.search.open recognizes.
+
+    Args:
+        path: str; location of the fits file.
+        kepid: Object of interest.
+        quarter: int; Kepler quarter.
+        columns: dict of the fits table columns, see make_quarter.
+    '''
+
+    from astropy.io import fits
+
+    primary = fits.PrimaryHDU()
+    header = primary.header
+    header['TELESCOP'] = 'Kepler'
+    header['INSTRUME'] = 'Kepler Photometer'
+    header['CREATOR'] = 'FluxExporter2PipelineModule'
+    header['ORIGIN'] = 'NASA/Ames'
+    header['OBJECT'] = 'KIC {}'.format(int(kepid))
+    header['KEPLERID'] = int(kepid)
+    header['CHANNEL'] = 1
+    header['QUARTER'] = quarter
+    header['MISSION'] = 'Kepler'
+    header['OBSMODE'] = 'long cadence'
+    header['RA_OBJ'] = 290.0
+    header['DEC_OBJ'] = 44.5
+
+    formats = {'TIME': 'D', 'CADENCENO': 'J', 'SAP_QUALITY': 'J'}
+    table = fits.BinTableHDU.from_columns(
+        [fits.Column(name=name, format=formats.get(name, 'E'), array=array)
+         for name, array in columns.items()])
+    table.header['EXTNAME'] = 'LIGHTCURVE'
+
+    fits.HDUList([primary, table]).writeto(path, overwrite=True)
+
+
+def generate_synthetic_dataset(out_dir='synthetic', n_kepids=100,
+                               quarters=(12, 17), seed=0,
+                               label_fractions=(0.4, 0.3, 0.3)):
+    '''
+    The generate_synthetic_dataset function writes synthetic fits
+        quarters under out_dir/data/<prefix>/<kepid>/ (the same layout
+        as the MAST download) and a matching TCE csv.
+
+    Args:
+        out_dir: str; directory to write to. Default = 'synthetic'
+        n_kepids: int; number of TCEs/kepids. Default = 100.
+        quarters: (min, max) number of quarters per kepid.
+            Default = (12, 17).
+        seed: int; seed of the random generator. Default = 0.
+        label_fractions: fractions of PC, AFP and NTP.
+            Default = (0.4, 0.3, 0.3).
+
+    Returns:
+        csv_file: str; location of the TCE csv (out_dir/synthetic_tces.csv).
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    kepids = np.sort(rng.choice(np.arange(1000000, 13000000), n_kepids,
+                                replace=False))
+    labels = rng.choice(['PC', 'AFP', 'NTP'], size=n_kepids,
+                        p=label_fractions)
+
+    tces = []
+    for kepid, label in zip(kepids, labels):
+        period = float(np.exp(rng.uniform(np.log(0.7), np.log(100.))))
+        t0 = QUARTER_STARTS[0] + rng.uniform(0, period)
+
+        ## Writing a random (consecutive) run of quarters
+        n_quarters = rng.randint(quarters[0], quarters[1] + 1)
+        first = rng.randint(1, 17 - n_quarters + 2)
+
+        kepid_str = str(kepid).zfill(9)
+        kepid_dir = os.path.join(out_dir, 'data', kepid_str[0:4], kepid_str)
+        if os.path.isdir(kepid_dir) == False:
+            os.makedirs(kepid_dir)
+
+        for quarter in range(first, first + n_quarters):
+            path = os.path.join(kepid_dir, 'kplr{}-{}_llc.fits'.format(
+                kepid_str, 2009000000000 + quarter * 10000000))
+            write_quarter(path, kepid, quarter,
+                          make_quarter(rng, quarter, period, t0, label))
+
+        tces.append({'kepid': int(kepid),
+                     'av_training_set': label,
+                     'tce_plnt_num': 1,
+                     'tce_period': period,
+                     'tce_time0bk': t0})
+
+    csv_file = os.path.join(out_dir, 'synthetic_tces.csv')
+    pd.DataFrame(tces).to_csv(csv_file, index=False)
+    print('Wrote {} synthetic kepids to {}'.format(n_kepids, out_dir))
+
+    return csv_file
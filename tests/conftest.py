@@ -0,0 +1,75 @@
+################
+## Running the tests from the root of the repository
+####
+
+## The pipeline modules live in the root of the repository, next to
+## this directory, and are imported from there
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+import kepler_data_processing as kdp
+
+################
+## Processing without lightkurve
+####
+
+class FakeFluxVector(object):
+    '''
+    Stand-in for get_flux_vector: the flux of a kepid is the number of
+        fits files it is processed from, and the kepids processed (in
+        this process) are kept in processed. lengths[kepid] gives a
+        kepid a flux of another length.
+    '''
+
+    def __init__(self):
+        self.processed = []
+        self.lengths = {}
+
+    def __call__(self, kepid, tce_data, data_dir='data', manifest=None,
+                 plnt_num=None, views=None, **kwargs):
+        paths = kdp.get_kepid_files(kepid, manifest, data_dir)
+        if len(paths) == 0:
+            raise kdp.NoFitsFilesError('No fits files found')
+        self.processed.append(kepid)
+        n_bins = kdp.FLUX_LEN if views is None else kdp.views_length(views)
+        return np.full(self.lengths.get(kepid, n_bins), float(len(paths)))
+
+
+@pytest.fixture
+def fake_flux_vector(monkeypatch):
+    flux_vector = FakeFluxVector()
+    monkeypatch.setattr(kdp, 'get_flux_vector', flux_vector)
+    return flux_vector
+
+
+@pytest.fixture
+def write_fits(tmp_path):
+    '''
+    Returns a function writing a Kepler-like light curve fits file (a
+        LIGHTCURVE table with TIME, PDCSAP_FLUX, PDCSAP_FLUX_ERR and
+        SAP_QUALITY) under tmp_path.
+    '''
+
+    fits = pytest.importorskip('astropy.io.fits')
+
+    def write(name, time, flux, quality=None):
+        if quality is None:
+            quality = np.zeros(len(time), dtype=np.int32)
+        columns = [
+            fits.Column(name='TIME', format='D', array=time),
+            fits.Column(name='PDCSAP_FLUX', format='E', array=flux),
+            fits.Column(name='PDCSAP_FLUX_ERR', format='E',
+                        array=np.full(len(time), 1e-4)),
+            fits.Column(name='SAP_QUALITY', format='J', array=quality)]
+        table = fits.BinTableHDU.from_columns(columns)
+        table.header['EXTNAME'] = 'LIGHTCURVE'
+        path = str(tmp_path / name)
+        fits.HDUList([fits.PrimaryHDU(), table]).writeto(path)
+        return path
+
+    return write
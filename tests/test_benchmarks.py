@@ -0,0 +1,43 @@
+################
+## Packages to be used
+####
+
+import tracemalloc
+
+import benchmarks
+
+################
+## Tests
+####
+
+def test_timed_runs_are_not_traced():
+    tracing = []
+    def function():
+        tracing.append(tracemalloc.is_tracing())
+        return bytearray(10 * 1024 * 1024)
+
+    seconds, peak, result = benchmarks._time_and_peak(function, 3)
+
+    assert tracing == [False, False, False, True]
+    assert not tracemalloc.is_tracing()
+    assert seconds > 0 and len(result) == 10 * 1024 * 1024
+    assert peak >= 10 * 1024 * 1024
+
+
+def test_failing_stage_does_not_stop_the_suite():
+    def missing():
+        import a_package_that_is_not_installed
+    def broken():
+        raise AttributeError("module 'tensorflow' has no attribute "
+                             "'enable_eager_execution'")
+
+    results = {}
+    benchmarks._run_stage(results, 'missing', missing)
+    benchmarks._run_stage(results, 'broken', broken)
+    benchmarks._run_stage(results, 'fine', lambda: {'rows': 3})
+
+    assert 'skipped' in results['missing']
+    assert results['broken'] == {
+        'error': "AttributeError: module 'tensorflow' has no attribute "
+                 "'enable_eager_execution'"}
+    assert results['fine']['rows'] == 3 and 'seconds' in results['fine']
@@ -0,0 +1,149 @@
+################
+## Packages to be used
+####
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import kepler_data_processing as kdp
+from processing_journal import read_journal, COMPLETED, FAILED, SKIPPED
+
+################
+## A small csv and its fits files
+####
+
+TCES = pd.DataFrame({'kepid': [11, 22, 33, 44],
+                     'av_training_set': ['PC', 'AFP', 'NTP', 'PC'],
+                     'tce_plnt_num': [1, 1, 1, 1],
+                     'tce_period': [3.5, 9.1, 12.7, 5.2],
+                     'tce_time0bk': [130.0, 133.3, 131.9, 132.4]})
+
+QUARTERS = ['2009131105131', '2009166043257']
+
+
+def make_data(tmp_path, kepids=(11, 22, 33)):
+    ## (Empty) fits files in the layout of data/; kepid 44 has none
+    data_dir = tmp_path / 'data'
+    for kepid in kepids:
+        kepid = str(kepid).zfill(9)
+        kepid_dir = data_dir / kepid[:4] / kepid
+        kepid_dir.mkdir(parents=True)
+        for quarter in QUARTERS:
+            (kepid_dir / 'kplr{}-{}_llc.fits'.format(kepid, quarter)
+             ).write_bytes(b'quarter')
+
+    csv_file = str(tmp_path / 'tces.csv')
+    TCES.to_csv(csv_file, index=False)
+    out_dir = str(tmp_path / 'store')
+    os.makedirs(out_dir)
+    return csv_file, out_dir, str(data_dir)
+
+
+def by_kepid(out_dir, values):
+    kepids = np.load(os.path.join(out_dir, 'flux_kepids.npy')).tolist()
+    return dict(zip(kepids, np.asarray(values).tolist()))
+
+
+def journal_statuses(out_dir):
+    journal = read_journal(os.path.join(out_dir, 'processing_journal.jsonl'))
+    return dict((entry['kepid'], (entry['status'], entry['error']))
+                for entry in journal.values())
+
+################
+## Tests
+####
+
+def test_workers_match_serial(tmp_path, fake_flux_vector):
+    csv_file, out_dir, data_dir = make_data(tmp_path)
+    fake_flux_vector.lengths[33] = 5
+    tce_data = kdp.open_files(csv_file)
+    flux_kwargs = {'data_dir': data_dir}
+
+    serial = list(kdp.iter_processed_tces(tce_data, flux_kwargs=flux_kwargs))
+    parallel = list(kdp.iter_processed_tces(
+        tce_data, n_workers=2, max_in_flight=3, flux_kwargs=flux_kwargs))
+
+    ## In the order of tce_data, whichever worker finishes first
+    assert [i for i, _, _, _ in parallel] == list(range(len(tce_data)))
+    for (_, flux, status, error), (_, p_flux, p_status, p_error) in zip(
+            serial, parallel):
+        assert (status, error) == (p_status, p_error)
+        np.testing.assert_array_equal(flux, p_flux)
+
+    ## One bad kepid does not stop the others
+    statuses = dict((tce_data['kepid'][i], status)
+                    for i, _, status, _ in parallel)
+    assert statuses == {11: COMPLETED, 22: COMPLETED, 33: FAILED,
+                        44: SKIPPED}
+
+
+def test_wrong_length_flux_is_not_stored(tmp_path, fake_flux_vector):
+    csv_file, out_dir, data_dir = make_data(tmp_path)
+    fake_flux_vector.lengths[22] = kdp.FLUX_LEN - 1
+
+    flux_data, flux_labels, _ = kdp.main_data_processing(
+        csv_file, out_dir=out_dir, data_dir=data_dir)
+
+    assert by_kepid(out_dir, flux_labels) == {11: 1, 22: -1, 33: 0, 44: -1}
+    flux = by_kepid(out_dir, np.asarray(flux_data)[:, 0])
+    assert flux[11] == 2. and flux[33] == 2.
+    assert np.isnan(flux[22])
+
+    statuses = journal_statuses(out_dir)
+    assert statuses[11] == (COMPLETED, None)
+    assert statuses[22][0] == FAILED
+    assert 'length {}'.format(kdp.FLUX_LEN - 1) in statuses[22][1]
+    assert statuses[44][0] == SKIPPED
+
+
+def test_write_flux_row_refuses_other_lengths():
+    flux_data = np.zeros((2, kdp.FLUX_LEN), np.float32)
+    kdp.write_flux_row(flux_data, 1, np.ones(kdp.FLUX_LEN))
+    assert (flux_data[1] == 1).all()
+
+    for flux in [np.ones(kdp.FLUX_LEN + 1), np.ones((1, kdp.FLUX_LEN))]:
+        with pytest.raises(ValueError):
+            kdp.write_flux_row(flux_data, 0, flux)
+    assert (flux_data[0] == 0).all()
+
+
+def test_resume_skips_completed_rows(tmp_path, fake_flux_vector):
+    csv_file, out_dir, data_dir = make_data(tmp_path)
+    fake_flux_vector.lengths[22] = 5
+
+    kdp.main_data_processing(csv_file, out_dir=out_dir, data_dir=data_dir)
+    assert sorted(fake_flux_vector.processed) == [11, 22, 33]
+
+    ## A crash while kepid 11 was written: its label is gone and it has
+    ## no journal entry
+    row = np.load(os.path.join(out_dir, 'flux_kepids.npy')).tolist().index(11)
+    labels = np.load(os.path.join(out_dir, 'flux_labels.npy'),
+                     mmap_mode='r+')
+    labels[row] = -1
+    labels.flush()
+    del labels
+    journal_file = os.path.join(out_dir, 'processing_journal.jsonl')
+    with open(journal_file) as f:
+        lines = [line for line in f if '"kepid": 11,' not in line]
+    with open(journal_file, 'w') as f:
+        f.writelines(lines)
+
+    ## Only the crashed row is processed again, failures are kept
+    del fake_flux_vector.processed[:]
+    del fake_flux_vector.lengths[22]
+    kdp.main_data_processing(csv_file, out_dir=out_dir, data_dir=data_dir,
+                             resume=True)
+    assert fake_flux_vector.processed == [11]
+    assert journal_statuses(out_dir)[22][0] == FAILED
+
+    ## Until they are retried
+    del fake_flux_vector.processed[:]
+    _, flux_labels, _ = kdp.main_data_processing(
+        csv_file, out_dir=out_dir, data_dir=data_dir, resume=True,
+        retry_failed=True)
+    assert sorted(fake_flux_vector.processed) == [22]
+    assert by_kepid(out_dir, flux_labels) == {11: 1, 22: 0, 33: 0, 44: -1}
+    assert journal_statuses(out_dir)[22] == (COMPLETED, None)
@@ -0,0 +1,73 @@
+################
+## Packages to be used
+####
+
+import os
+
+from fits_manifest import FitsManifest, build_manifest
+
+################
+## A data/ tree as downloaded from MAST
+####
+
+def write_quarter(data_dir, kepid, quarter):
+    kepid_dir = data_dir / str(kepid).zfill(9)[:4] / str(kepid).zfill(9)
+    kepid_dir.mkdir(parents=True, exist_ok=True)
+    path = kepid_dir / 'kplr{}-{}_llc.fits'.format(str(kepid).zfill(9),
+                                                    quarter)
+    path.write_bytes(b'quarter')
+    return kepid_dir, str(path)
+
+################
+## Tests
+####
+
+def test_lookup(tmp_path):
+    data_dir = tmp_path / 'data'
+    _, first = write_quarter(data_dir, 11, '2009131105131')
+    _, second = write_quarter(data_dir, 11, '2009166043257')
+    _, other = write_quarter(data_dir, 757450, '2009131105131')
+
+    manifest = build_manifest(str(data_dir), str(tmp_path / 'manifest.sqlite'))
+
+    assert manifest.kepids() == [11, 757450]
+    assert manifest.lookup(11) == [first, second]
+    assert manifest.lookup('757450') == [other]
+    assert manifest.lookup(22) is None
+
+
+def test_refresh_picks_up_new_files(tmp_path):
+    data_dir = tmp_path / 'data'
+    kepid_dir, first = write_quarter(data_dir, 11, '2009131105131')
+    write_quarter(data_dir, 22, '2009131105131')
+    manifest = FitsManifest(str(tmp_path / 'manifest.sqlite'), str(data_dir))
+    assert manifest.refresh() == {'added': 2, 'updated': 0, 'removed': 0}
+    assert manifest.refresh() == {'added': 0, 'updated': 0, 'removed': 0}
+
+    ## A new quarter bumps the mtime of its kepid directory (set
+    ## explicitly, as it may not tick between two writes)
+    _, second = write_quarter(data_dir, 11, '2009166043257')
+    mtime_ns = os.stat(str(kepid_dir)).st_mtime_ns + 10**9
+    os.utime(str(kepid_dir), ns=(mtime_ns, mtime_ns))
+
+    assert manifest.refresh() == {'added': 0, 'updated': 1, 'removed': 0}
+    assert manifest.lookup(11) == [first, second]
+
+    ## The manifest persists across instances
+    manifest.close()
+    assert FitsManifest(str(tmp_path / 'manifest.sqlite'),
+                        str(data_dir)).lookup(11) == [first, second]
+
+
+def test_refresh_drops_removed_kepids(tmp_path):
+    data_dir = tmp_path / 'data'
+    kepid_dir, path = write_quarter(data_dir, 11, '2009131105131')
+    write_quarter(data_dir, 22, '2009131105131')
+    manifest = build_manifest(str(data_dir), str(tmp_path / 'manifest.sqlite'))
+
+    os.remove(path)
+    os.rmdir(str(kepid_dir))
+
+    assert manifest.refresh() == {'added': 0, 'updated': 0, 'removed': 1}
+    assert manifest.kepids() == [22]
+    assert manifest.lookup(11) is None
@@ -0,0 +1,52 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+import pytest
+
+pytest.importorskip('astropy')
+from fits_reader import read_pdcsap, DEFAULT_BITMASK
+
+################
+## Tests
+####
+
+def test_reads_the_columns(write_fits):
+    time = 131.5 + np.arange(500) * 0.0204335
+    flux = np.linspace(1e4, 1.1e4, 500).astype(np.float32)
+    flux[100:110] = np.nan
+    path = write_fits('kplr000000011-2009131105131_llc.fits', time, flux)
+
+    data = read_pdcsap(path)
+
+    np.testing.assert_array_equal(data.time, time)
+    np.testing.assert_array_equal(data.flux, flux)
+    np.testing.assert_array_equal(data.flux_err, np.float32(1e-4))
+    assert (data.quality == 0).all()
+
+    ## Big-endian views into the file, unless native is asked for
+    assert not data.flux.dtype.isnative
+    native = read_pdcsap(path, native=True)
+    assert native.flux.dtype.isnative and native.time.dtype.isnative
+    np.testing.assert_array_equal(native.flux, flux)
+
+
+def test_removes_flagged_cadences(write_fits):
+    time = 131.5 + np.arange(500) * 0.0204335
+    flux = np.ones(500, dtype=np.float32)
+    quality = np.zeros(500, dtype=np.int32)
+    quality[10] = 32        ## Desat: removed
+    quality[20] = 256       ## ManualExclude: removed
+    quality[30] = 128       ## ApertureCosmic: kept, like lightkurve
+    quality[40] = 32 | 128
+    path = write_fits('kplr000000011-2009131105131_llc.fits', time, flux,
+                      quality)
+
+    data = read_pdcsap(path)
+    keep = (quality & DEFAULT_BITMASK) == 0
+    assert keep.sum() == 497
+    np.testing.assert_array_equal(data.time, time[keep])
+    np.testing.assert_array_equal(data.quality, quality[keep])
+
+    assert len(read_pdcsap(path, quality_bitmask=None).time) == 500
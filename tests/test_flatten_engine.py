@@ -0,0 +1,132 @@
+################
+## Packages to be used
+####
+
+import warnings
+import numpy as np
+import pytest
+
+signal = pytest.importorskip('scipy.signal')
+from scipy.interpolate import interp1d
+
+from flatten_engine import (flatten_light_curves, flatten_quarters,
+                            savgol_weights)
+
+################
+## Reference flattening
+####
+
+## LightCurve.flatten of lightkurve 1.x, one quarter at a time
+def reference_flatten(time, flux, flux_err, window_length=101, polyorder=2,
+                      break_tolerance=5, niters=3, sigma=3):
+    mask = np.isfinite(flux)
+    mask &= np.nan_to_num(np.abs(flux - np.nanmedian(flux))) <= (
+        np.nanstd(flux) * sigma)
+    for _ in range(niters):
+        dt = time[mask][1:] - time[mask][:-1]
+        cut = np.where(dt > break_tolerance * np.nanmedian(dt))[0] + 1
+        low = np.append([0], cut)
+        high = np.append(cut, len(time[mask]))
+
+        trend_signal = np.zeros(len(time[mask]))
+        for l, h in zip(low, high):
+            if window_length > (h - l) or (h - l) < break_tolerance:
+                trend_signal[l:h] = np.nanmedian(flux[mask][l:h])
+            else:
+                trend_signal[l:h] = signal.savgol_filter(
+                    x=flux[mask][l:h], window_length=window_length,
+                    polyorder=polyorder)
+
+        residual = flux[mask] - trend_signal
+        keep = np.nan_to_num(np.abs(residual)) < np.nanstd(residual) * sigma
+        trend_signal = interp1d(time[mask][keep], trend_signal[keep],
+                                fill_value='extrapolate')(time)
+        mask[mask] &= keep
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return flux / trend_signal, flux_err / trend_signal
+
+
+## Kepler-like quarters: a slow trend, noise, runs of NaNs, a gap that
+## splits the quarter, a last segment shorter than window_length and a
+## few outliers
+def synthetic_quarters(n_quarters=4, seed=0, dtype=np.float64):
+    rng = np.random.RandomState(seed)
+    quarters = []
+    start = 130.
+    for q in range(n_quarters):
+        n = 3000 + 500 * q
+        time = start + np.arange(n) * 0.0204336
+        time[n // 2:] += 2.5
+        time[-60:] += 4.
+        start = time[-1] + 1.
+
+        flux = (1e4 * (1 + 2e-3 * np.sin(time / (3. + q)) +
+                       1e-3 * (time - time[0]) / (time[-1] - time[0])) +
+                rng.normal(0, 5., n))
+        flux[rng.randint(0, n, 10)] += rng.choice([-1, 1], 10) * 300.
+        flux[400:460] = np.nan
+        flux[rng.rand(n) < 0.01] = np.nan
+        flux_err = np.full(n, 5.)
+        quarters.append((time, flux.astype(dtype), flux_err.astype(dtype)))
+    return quarters
+
+################
+## Tests
+####
+
+def test_savgol_weights_match_savgol_filter():
+    flux = np.random.RandomState(1).normal(size=500)
+    center, left, right = savgol_weights(101, 2)
+
+    expected = signal.savgol_filter(flux, 101, 2)
+    np.testing.assert_allclose(np.convolve(flux, center, 'same')[50:-50],
+                               expected[50:-50], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(left.dot(flux[:101]), expected[:50],
+                               rtol=0, atol=1e-12)
+    np.testing.assert_allclose(right.dot(flux[-101:]), expected[-50:],
+                               rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('dtype, rtol', [(np.float64, 1e-10),
+                                         (np.float32, 1e-5)])
+def test_matches_per_quarter_flatten(dtype, rtol):
+    quarters = synthetic_quarters(dtype=dtype)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        flattened = flatten_light_curves(quarters)
+        for (time, flux, flux_err), (out_time, out_flux, out_err) in zip(
+                quarters, flattened):
+            ref_flux, ref_err = reference_flatten(time, flux, flux_err)
+
+            np.testing.assert_array_equal(out_time, time)
+            np.testing.assert_array_equal(np.isnan(out_flux),
+                                          np.isnan(ref_flux))
+            np.testing.assert_allclose(out_flux, ref_flux, rtol=rtol)
+            np.testing.assert_allclose(out_err, ref_err, rtol=rtol)
+
+
+def test_quarters_are_independent():
+    ## Flattening quarters together or one at a time gives the same trend
+    quarters = synthetic_quarters(n_quarters=3, seed=2)
+    time = np.concatenate([q[0] for q in quarters])
+    flux = np.concatenate([q[1] for q in quarters])
+    lengths = [len(q[0]) for q in quarters]
+
+    trend = flatten_quarters(time, flux, lengths)
+    bounds = np.cumsum([0] + lengths)
+    for (q_time, q_flux, _), start, stop in zip(quarters, bounds[:-1],
+                                               bounds[1:]):
+        np.testing.assert_allclose(
+            trend[start:stop], flatten_quarters(q_time, q_flux,
+                                                [len(q_time)]),
+            rtol=1e-12)
+
+
+def test_too_few_points():
+    time = np.arange(10.)
+    flux = np.full(10, np.nan)
+    flux[3] = 1.
+    with pytest.raises(ValueError):
+        flatten_quarters(time, flux, [10])
@@ -0,0 +1,81 @@
+################
+## Packages to be used
+####
+
+import os
+import numpy as np
+
+from flux_cache import FluxCache
+
+################
+## Cached entries of two kepids
+####
+
+def make_fits(tmp_path, kepid, quarter='2009131105131', content=b'q'):
+    path = tmp_path / 'kplr{}-{}_llc.fits'.format(str(kepid).zfill(9),
+                                                  quarter)
+    path.write_bytes(content)
+    return str(path)
+
+################
+## Tests
+####
+
+def test_key_depends_on_every_parameter(tmp_path):
+    cache = FluxCache(str(tmp_path / 'cache'))
+    paths = [make_fits(tmp_path, 11)]
+
+    key = cache.make_key(11, paths, 101, 'calculated', 3.5, 130.0)
+    assert key.startswith('000000011-')
+    assert key == cache.make_key(11, paths, 101, 'calculated', 3.5, 130.0)
+
+    assert key != cache.make_key(11, paths, 51, 'calculated', 3.5, 130.0)
+    assert key != cache.make_key(11, paths, 101, 20., 3.5, 130.0)
+    assert key != cache.make_key(11, paths, 101, 'calculated', 3.6, 130.0)
+    assert key != cache.make_key(11, paths, 101, 'calculated', 3.5, 130.1)
+    assert key != cache.make_key(
+        11, paths + [make_fits(tmp_path, 11, '2009166043257')],
+        101, 'calculated', 3.5, 130.0)
+
+    ## A rewritten fits file (other size) gives another key
+    make_fits(tmp_path, 11, content=b'quarter')
+    assert key != cache.make_key(11, paths, 101, 'calculated', 3.5, 130.0)
+
+
+def test_get_put_and_invalidate(tmp_path):
+    cache = FluxCache(str(tmp_path / 'cache'))
+    paths = [make_fits(tmp_path, 11)]
+    key = cache.make_key(11, paths, 101, 'calculated', 3.5, 130.0)
+
+    assert cache.get(key) is None
+    flux = np.linspace(0.99, 1.01, 2001)
+    cache.put(key, flux)
+    np.testing.assert_array_equal(cache.get(key), flux)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    other = cache.make_key(22, [make_fits(tmp_path, 22)], 101,
+                           'calculated', 3.5, 130.0)
+    cache.put(other, flux)
+    assert cache.invalidate(11) == 1
+    assert cache.get(key) is None
+    assert cache.get(other) is not None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    flux = np.ones(2001)
+    entry_bytes = len(flux) * 8 + 128
+    cache = FluxCache(str(tmp_path / 'cache'), max_bytes=2 * entry_bytes)
+    keys = ['{:09d}-key'.format(kepid) for kepid in [11, 22, 33]]
+
+    cache.put(keys[0], flux)
+    cache.put(keys[1], flux)
+
+    ## kepid 11 was written first, but used last
+    os.utime(cache._path(keys[0]), (1000, 1000))
+    os.utime(cache._path(keys[1]), (2000, 2000))
+    assert cache.get(keys[0]) is not None
+
+    cache.put(keys[2], flux)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
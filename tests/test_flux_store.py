@@ -0,0 +1,78 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('h5py')
+from flux_store import FluxStore, write_store
+
+################
+## A flux store with a multi-planet kepid
+####
+
+def write_flux_dir(flux_dir):
+    ## As written by main_data_processing: kepid 10 has three TCEs, in
+    ## no particular order, and row 3 was not processed
+    tce_data = pd.DataFrame({'kepid': [10, 20, 10, 30, 10],
+                             'av_training_set': ['PC', 'AFP', 'PC', 'NTP',
+                                                 'AFP'],
+                             'tce_plnt_num': [2, 1, 1, 1, 3],
+                             'tce_period': [41.0, 9.1, 3.5, 2.2, 80.0],
+                             'tce_time0bk': [151.2, 133.3, 130.0, 131.0,
+                                             170.0]})
+    flux_data = np.arange(5, dtype=np.float32)[:, None] * np.ones(2001)
+    flux_data[3] = np.nan
+    tce_data.to_csv(str(flux_dir / 'flux_tce_order.csv'), index=False)
+    np.save(str(flux_dir / 'flux_data.npy'), flux_data.astype(np.float32))
+    np.save(str(flux_dir / 'flux_labels.npy'),
+            np.array([1, 0, 1, -1, 0], dtype=np.int8))
+    return tce_data, flux_data
+
+################
+## Tests
+####
+
+def test_every_tce_is_indexed(tmp_path):
+    tce_data, flux_data = write_flux_dir(tmp_path)
+    store_file = write_store(str(tmp_path))
+
+    with FluxStore(store_file) as store:
+        assert store.rows(10) == [2, 0, 4]
+        assert store.row(10) == 2
+        assert store.row(10, plnt_num=3) == 4
+        np.testing.assert_array_equal(store.get(10, plnt_num=2),
+                                      flux_data[0])
+        np.testing.assert_array_equal(store.get(20), flux_data[1])
+        with pytest.raises(KeyError):
+            store.row(10, plnt_num=4)
+        with pytest.raises(KeyError):
+            store.row(40)
+
+        np.testing.assert_array_equal(store.read_rows([4, 0, 4]),
+                                      flux_data[[4, 0, 4]])
+        pd.testing.assert_frame_equal(
+            store.tce_data()[list(tce_data)], tce_data, check_dtype=False)
+
+
+def test_processing_params(tmp_path, fake_flux_vector):
+    import kepler_data_processing as kdp
+
+    kepid_dir = tmp_path / 'data' / '0000' / '000000011'
+    kepid_dir.mkdir(parents=True)
+    (kepid_dir / 'kplr000000011-2009131105131_llc.fits').write_bytes(b'q')
+    csv_file = str(tmp_path / 'tces.csv')
+    pd.DataFrame({'kepid': [11], 'av_training_set': ['PC'],
+                  'tce_plnt_num': [1], 'tce_period': [3.5],
+                  'tce_time0bk': [130.0]}).to_csv(csv_file, index=False)
+    store_file = str(tmp_path / 'flux_store.h5')
+
+    kdp.main_data_processing(csv_file, out_dir=str(tmp_path),
+                             data_dir=str(tmp_path / 'data'),
+                             store_file=store_file, window_length=51)
+
+    with FluxStore(store_file) as store:
+        assert store.params['window_length'] == 51
+        assert store.get(11)[0] == 1.
@@ -0,0 +1,103 @@
+################
+## Packages to be used
+####
+
+import warnings
+import numpy as np
+import pytest
+
+import kepler_data_processing as kdp
+
+################
+## Reference fold/bin/normalize
+####
+
+## What lightkurve's fold(...).bin(...).normalize() computes: fold, sort
+## by phase, split into bins of (almost) equal count, NaN-mean every bin
+## and divide by the median
+def reference_fold_bin_normalize(time, flux, period, t0, binsize):
+    phase = (t0 % period) / period
+    fold_time = ((time - phase * period) / period) % 1
+    fold_time[fold_time > 0.5] -= 1
+
+    order = np.argsort(fold_time)
+    n_bins = int(len(flux) // binsize)
+    time_bins = np.array_split(fold_time[order], n_bins)
+    flux_bins = np.array_split(flux[order], n_bins)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        binned_phase = np.array([np.mean(b) for b in time_bins])
+        binned_flux = np.array([np.nanmean(b) for b in flux_bins])
+    return binned_phase, binned_flux / np.nanmedian(binned_flux)
+
+
+## Kepler-like light curve: ~3 years of long cadences with a transit,
+## gaps and NaNs (single points, runs, and a whole phase range). The
+## cadence (29.4 min) does not divide the period, so no two points
+## fall on the same phase and the sort order is unique.
+def synthetic_light_curve(n_points=60000, period=3.71734, t0=131.3, seed=0):
+    rng = np.random.RandomState(seed)
+    time = 130. + np.arange(n_points) * 0.0204336
+    time = np.delete(time, np.s_[20000:21500])
+    flux = 1. + rng.normal(0, 1e-4, len(time))
+
+    phase = ((time - t0) / period + 0.5) % 1 - 0.5
+    flux[np.abs(phase) < 0.01] -= 5e-3
+
+    flux[rng.rand(len(time)) < 0.02] = np.nan
+    flux[5000:5300] = np.nan
+    flux[(phase > 0.2) & (phase < 0.2005)] = np.nan
+    return time, flux, period, t0
+
+################
+## Tests
+####
+
+@pytest.mark.parametrize('n_points', [60000, 12345, 4003])
+def test_matches_reference(n_points):
+    time, flux, period, t0 = synthetic_light_curve(n_points)
+    binsize = kdp.calculate_binsize(len(flux))
+
+    phase, binned = kdp.fold_bin_normalize(time, flux, period, t0, binsize)
+    ref_phase, ref_binned = reference_fold_bin_normalize(
+        time, flux, period, t0, binsize)
+
+    assert binned.shape == ref_binned.shape == (kdp.FLUX_LEN,)
+    np.testing.assert_array_equal(np.isnan(binned), np.isnan(ref_binned))
+    np.testing.assert_allclose(binned, ref_binned, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(phase, ref_phase, rtol=0, atol=1e-12)
+
+
+def test_explicit_binsize():
+    time, flux, period, t0 = synthetic_light_curve(20000, seed=1)
+
+    phase, binned = kdp.fold_bin_normalize(time, flux, period, t0, 7.5)
+    ref_phase, ref_binned = reference_fold_bin_normalize(
+        time, flux, period, t0, 7.5)
+
+    assert len(binned) == len(ref_binned) == int(len(flux) // 7.5)
+    np.testing.assert_allclose(binned, ref_binned, rtol=0, atol=1e-12)
+
+
+def test_float32_output():
+    time, flux, period, t0 = synthetic_light_curve()
+    binsize = kdp.calculate_binsize(len(flux))
+
+    phase, binned = kdp.fold_bin_normalize(time, flux, period, t0, binsize,
+                                           dtype='float32')
+    _, ref_binned = reference_fold_bin_normalize(time, flux, period, t0,
+                                                 binsize)
+
+    assert binned.dtype == np.float32 and phase.dtype == np.float32
+    np.testing.assert_allclose(binned, ref_binned, rtol=1e-6)
+
+
+def test_transit_at_zero_phase():
+    time, flux, period, t0 = synthetic_light_curve()
+    binsize = kdp.calculate_binsize(len(flux))
+
+    phase, binned = kdp.fold_bin_normalize(time, flux, period, t0, binsize)
+
+    assert abs(phase[np.nanargmin(binned)]) < 0.01
+    assert abs(np.nanmedian(binned) - 1) < 1e-12
@@ -0,0 +1,76 @@
+################
+## Packages to be used
+####
+
+import collections
+import numpy as np
+
+import kepler_data_processing as kdp
+
+################
+## A light curve with a box transit
+####
+
+PERIOD = 3.71734
+T0 = 131.3
+DURATION = 0.1
+
+
+def box_transit(n_points=2001 * 20, depth=5e-3, seed=0):
+    rng = np.random.RandomState(seed)
+    time = 130. + np.arange(n_points) * 0.0204336
+    flux = 1. + rng.normal(0, 1e-5, n_points)
+    phase_days = ((time - T0) / PERIOD + 0.5) % 1 * PERIOD - PERIOD / 2
+    flux[np.abs(phase_days) < DURATION / 2] -= depth
+    flux[rng.rand(n_points) < 0.02] = np.nan
+    return time, flux
+
+################
+## Tests
+####
+
+def test_global_view_is_fold_bin_normalize():
+    time, flux = box_transit()
+
+    binned = kdp.fold_views(time, flux, PERIOD, T0, DURATION)
+    _, expected = kdp.fold_bin_normalize(time, flux, PERIOD, T0,
+                                         len(flux) / 2001.)
+
+    assert len(expected) == 2001
+    np.testing.assert_array_equal(binned['global'], expected)
+
+
+def test_local_view_length_and_centering():
+    time, flux = box_transit()
+
+    local = kdp.fold_views(time, flux, PERIOD, T0, DURATION)['local']
+
+    ## 201 bins over +-4 durations: the transit covers the middle 25
+    assert len(local) == 201
+    assert 88 <= np.argmin(local) <= 112
+    np.testing.assert_allclose(local[90:111], 1 - 5e-3, atol=5e-4)
+    np.testing.assert_allclose(local[:80], 1., atol=5e-4)
+    np.testing.assert_allclose(local[-80:], 1., atol=5e-4)
+
+    ## A transit off t0 is off center by the same phase
+    shifted = kdp.fold_views(time, flux, PERIOD, T0 + DURATION,
+                             DURATION)['local']
+    assert 88 - 25 <= np.argmin(shifted) <= 112 - 25
+
+
+def test_views_round_trip():
+    views = collections.OrderedDict([('global', (2001, None)),
+                                     ('local', (61, 2.)),
+                                     ('wide', (31, 10.))])
+    time, flux = box_transit()
+
+    binned = kdp.fold_views(time, flux, PERIOD, T0, DURATION, views,
+                            dtype='float32')
+    assert [len(view) for view in binned.values()] == [2001, 61, 31]
+    assert all(view.dtype == np.float32 for view in binned.values())
+    assert not any(np.isnan(view).any() for view in binned.values())
+
+    vector = np.concatenate(list(binned.values()))
+    assert len(vector) == kdp.views_length(views)
+    for name, view in kdp.split_views(vector, views).items():
+        np.testing.assert_array_equal(view, binned[name])
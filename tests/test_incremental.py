@@ -0,0 +1,88 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+import pandas as pd
+
+from incremental import update_flux_store
+
+################
+## Fits files outside of data/
+####
+
+TCES = pd.DataFrame({'kepid': [11, 22],
+                     'av_training_set': ['PC', 'AFP'],
+                     'tce_plnt_num': [1, 1],
+                     'tce_period': [3.5, 9.1],
+                     'tce_time0bk': [130.0, 133.3]})
+
+
+def add_quarter(data_dir, kepid, quarter):
+    ## An (empty) fits file in the layout of data/
+    kepid = str(kepid).zfill(9)
+    kepid_dir = data_dir / kepid[:4] / kepid
+    kepid_dir.mkdir(parents=True, exist_ok=True)
+    (kepid_dir / 'kplr{}-{}_llc.fits'.format(kepid, quarter)).write_bytes(
+        b'quarter')
+
+################
+## Tests
+####
+
+def test_processes_from_data_dir(tmp_path, monkeypatch, fake_flux_vector):
+    ## No data/ in the working directory
+    monkeypatch.chdir(tmp_path)
+    processed = fake_flux_vector.processed
+
+    data_dir = tmp_path / 'fits'
+    add_quarter(data_dir, 11, '2009131105131')
+    add_quarter(data_dir, 22, '2009131105131')
+    csv_file = str(tmp_path / 'tces.csv')
+    TCES.to_csv(csv_file, index=False)
+    out_dir = str(tmp_path / 'store')
+
+    flux_data, flux_labels, _, changes = update_flux_store(
+        csv_file, out_dir=out_dir, data_dir=str(data_dir))
+    assert changes['added'] == 2
+    assert sorted(processed) == [11, 22]
+    assert (np.asarray(flux_labels) >= 0).all()
+    assert (np.asarray(flux_data) == 1).all()
+
+    ## A new quarter of kepid 11: only it is processed again, from the
+    ## same directory its fingerprint was made from
+    add_quarter(data_dir, 11, '2009166043257')
+    del processed[:]
+    flux_data, flux_labels, _, changes = update_flux_store(
+        csv_file, out_dir=out_dir, data_dir=str(data_dir))
+    assert (changes['kept'], changes['changed']) == (1, 1)
+    assert processed == [11]
+
+    kepids = np.load(str(tmp_path / 'store' / 'flux_kepids.npy'))
+    flux = dict(zip(kepids.tolist(), np.asarray(flux_data)[:, 0].tolist()))
+    assert flux == {11: 2., 22: 1.}
+
+
+def test_retries_tces_that_did_not_complete(tmp_path, fake_flux_vector):
+    ## Kepid 22 fails (e.g. a network error) without its csv row or
+    ## fits files changing
+    data_dir = tmp_path / 'data'
+    add_quarter(data_dir, 11, '2009131105131')
+    add_quarter(data_dir, 22, '2009131105131')
+    csv_file = str(tmp_path / 'tces.csv')
+    TCES.to_csv(csv_file, index=False)
+    out_dir = str(tmp_path / 'store')
+    fake_flux_vector.lengths[22] = 10
+
+    _, flux_labels, _, changes = update_flux_store(
+        csv_file, out_dir=out_dir, data_dir=str(data_dir))
+    assert sorted(np.asarray(flux_labels).tolist()) == [-1, 1]
+
+    ## The next update tries it again, and only it
+    del fake_flux_vector.lengths[22]
+    del fake_flux_vector.processed[:]
+    _, flux_labels, _, changes = update_flux_store(
+        csv_file, out_dir=out_dir, data_dir=str(data_dir))
+    assert (changes['kept'], changes['retried']) == (1, 1)
+    assert fake_flux_vector.processed == [22]
+    assert sorted(np.asarray(flux_labels).tolist()) == [0, 1]
@@ -0,0 +1,85 @@
+################
+## Packages to be used
+####
+
+import csv
+import json
+
+import pytest
+
+from instrumentation import (stage, count, recording, RunStats, profiling,
+                             StageRecord)
+
+################
+## Tests
+####
+
+def test_stages_only_recorded_while_recording():
+    ## Nothing to record to: no-ops
+    with stage('flatten'):
+        pass
+    count('cache_hits')
+
+    with recording(11) as outer:
+        with stage('fits_open'):
+            pass
+        with recording(22) as inner:
+            with stage('flatten'):
+                pass
+            with stage('flatten'):
+                pass
+            count('cache_hits', 2)
+        count('cache_misses')
+
+    ## The inner recording gets what ran inside it, the outer the rest
+    assert set(outer.stages) == {'fits_open'}
+    assert outer.counts == {'cache_misses': 1}
+    assert inner.stages['flatten'][1] == 2
+    assert inner.counts == {'cache_hits': 2}
+    assert outer.seconds >= inner.seconds >= inner.stages['flatten'][0]
+
+
+def test_run_stats(tmp_path):
+    stats = RunStats()
+    for name, status, seconds in [(11, 'completed', 1.5),
+                                  (22, 'completed', 0.5),
+                                  (33, 'failed', 2.)]:
+        record = StageRecord(name)
+        record.add_time('flatten', seconds)
+        record.add_time('bin', 0.25)
+        record.add_count('cache_misses')
+        record.seconds = seconds + 0.25
+        stats.merge(record, status)
+
+    summary = stats.summary()
+    assert summary['units'] == 3
+    assert summary['statuses'] == {'completed': 2, 'failed': 1}
+    assert summary['counts'] == {'cache_misses': 3}
+    assert summary['stages']['flatten']['seconds'] == 4.
+    assert summary['stages']['flatten']['calls'] == 3
+    assert summary['stages']['bin']['share'] == pytest.approx(0.75 / 4.75)
+
+    stats.write_json(str(tmp_path / 'stats.json'))
+    with open(str(tmp_path / 'stats.json')) as f:
+        assert json.load(f)['stages']['bin']['calls'] == 3
+    stats.write_csv(str(tmp_path / 'stats.csv'))
+    with open(str(tmp_path / 'stats.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [(row['name'], row['status'], float(row['flatten']))
+            for row in rows] == [('11', 'completed', 1.5),
+                                 ('22', 'completed', 0.5),
+                                 ('33', 'failed', 2.)]
+
+
+def test_profiling(tmp_path):
+    with profiling('tracemalloc', str(tmp_path / 'memory.txt')):
+        data = [bytearray(1000) for _ in range(100)]
+    with open(str(tmp_path / 'memory.txt')) as f:
+        assert f.readline().startswith('Peak traced memory')
+
+    with profiling(None, str(tmp_path / 'none.txt')):
+        pass
+    assert not (tmp_path / 'none.txt').exists()
+
+    with pytest.raises(ValueError):
+        profiling('perf', str(tmp_path / 'perf.txt'))
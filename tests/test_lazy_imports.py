@@ -0,0 +1,36 @@
+################
+## Packages to be used
+####
+
+import subprocess
+import sys
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Only imported by the functions that use them
+HEAVY = ('lightkurve', 'astropy', 'matplotlib', 'tensorflow', 'keras')
+
+################
+## Tests
+####
+
+@pytest.mark.parametrize('module', ['kepler_data_processing',
+                                    'tfrecords_creation', 'cnn_model',
+                                    'score_tces', 'cli'])
+def test_no_heavy_imports(module):
+    ## A fresh interpreter, as other tests may have imported them
+    code = ('import sys, {}; print(" ".join(sorted(set(name.split(".")[0] '
+            'for name in sys.modules))))'.format(module))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+
+    imported = set(output.decode().split())
+    assert imported.isdisjoint(HEAVY), sorted(imported.intersection(HEAVY))
+
+
+def test_cli_help():
+    output = subprocess.check_output(
+        [sys.executable, os.path.join(ROOT, 'cli.py'), '--help'], cwd=ROOT)
+    assert b'process' in output and b'tfrecords' in output
@@ -0,0 +1,73 @@
+################
+## Packages to be used
+####
+
+import pandas as pd
+import pytest
+
+import kepler_data_processing as kdp
+
+################
+## Kepid 10 has two TCEs, its second planet first
+####
+
+def make_tce_data():
+    return pd.DataFrame({'kepid': [10, 20, 10, 30],
+                         'av_training_set': ['AFP', 'PC', 'PC', 'NTP'],
+                         'tce_plnt_num': [2, 1, 1, 1],
+                         'tce_period': [41.0, 9.1, 3.5, 2.2],
+                         'tce_time0bk': [151.2, 133.3, 130.0, 131.0]})
+
+################
+## Tests
+####
+
+def test_matches_the_scan():
+    tce_data = make_tce_data()
+    kdp.attach_metadata_index(tce_data, 'last_row')
+
+    for kepid in [10, 20, 30]:
+        assert (kdp.get_metadata(kepid, tce_data) ==
+                tuple(kdp._get_metadata_scan(kepid, tce_data)))
+
+
+@pytest.mark.parametrize('multi_planet, expected', [
+    ('lowest_plnt_num', (3.5, 130.0)),
+    ('first_row', (41.0, 151.2)),
+    ('last_row', (3.5, 130.0)),
+])
+def test_multi_planet_policy(multi_planet, expected):
+    tce_data = make_tce_data()
+    kdp.attach_metadata_index(tce_data, multi_planet)
+
+    assert kdp.get_metadata(10, tce_data) == expected
+    assert kdp.get_metadata(20, tce_data) == (9.1, 133.3)
+
+
+def test_policy_errors():
+    with pytest.raises(ValueError):
+        kdp.build_metadata_index(make_tce_data(), 'error')
+    with pytest.raises(ValueError):
+        kdp.build_metadata_index(make_tce_data(), 'random')
+
+
+def test_built_when_missing_and_unknown_kepids():
+    ## A DataFrame not read by open_files gets its index on first use
+    tce_data = make_tce_data()
+    assert kdp.get_metadata(30, tce_data) == (2.2, 131.0)
+    assert isinstance(kdp.get_metadata_index(tce_data), kdp.MetadataIndex)
+
+    with pytest.raises(KeyError):
+        kdp.get_metadata(40, tce_data)
+
+
+def test_open_files(tmp_path):
+    csv_file = str(tmp_path / 'tces.csv')
+    tce_info = make_tce_data()
+    tce_info.loc[len(tce_info)] = [50, 'UNK', 1, 1.0, 130.5]
+    tce_info.to_csv(csv_file, index=False)
+
+    tce_data = kdp.open_files(csv_file)
+
+    assert sorted(tce_data['kepid']) == [10, 10, 20, 30]
+    assert kdp.get_metadata(10, tce_data) == (3.5, 130.0)
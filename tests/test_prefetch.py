@@ -0,0 +1,79 @@
+################
+## Packages to be used
+####
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import kepler_data_processing as kdp
+from prefetch import Prefetcher, LocalSource, FetchError, kepid_subdir
+from processing_journal import read_journal, COMPLETED, FAILED
+
+################
+## A mirror missing one quarter of a kepid
+####
+
+TCES = pd.DataFrame({'kepid': [11, 22, 33],
+                     'av_training_set': ['PC', 'AFP', 'NTP'],
+                     'tce_plnt_num': [1, 1, 1],
+                     'tce_period': [3.5, 9.1, 12.7],
+                     'tce_time0bk': [130.0, 133.3, 131.9]})
+
+QUARTERS = ['2009131105131', '2009166043257', '2009259160929']
+
+
+class BrokenSource(LocalSource):
+    ## Fetching one file of kepid 22 fails for good
+    def fetch(self, kepid, name, out_file):
+        if kepid == 22 and QUARTERS[1] in name:
+            raise FetchError('{} is corrupt on the mirror'.format(name))
+        LocalSource.fetch(self, kepid, name, out_file)
+
+
+def make_mirror(root):
+    for kepid in TCES['kepid']:
+        kepid_dir = root / kepid_subdir(kepid)
+        kepid_dir.mkdir(parents=True)
+        for quarter in QUARTERS:
+            name = 'kplr{}-{}_llc.fits'.format(str(kepid).zfill(9), quarter)
+            (kepid_dir / name).write_bytes(b'quarter')
+
+################
+## Tests
+####
+
+def test_failed_fetch_is_journaled(tmp_path, fake_flux_vector):
+    processed = fake_flux_vector.processed
+    make_mirror(tmp_path / 'mirror')
+    csv_file = str(tmp_path / 'tces.csv')
+    TCES.to_csv(csv_file, index=False)
+    out_dir = str(tmp_path / 'store')
+    os.makedirs(out_dir)
+
+    stage_dir = str(tmp_path / 'stage')
+    with Prefetcher(BrokenSource(str(tmp_path / 'mirror')), stage_dir,
+                    max_concurrency=2, retries=0, lookahead=1) as prefetcher:
+        flux_data, flux_labels, _ = kdp.main_data_processing(
+            csv_file, out_dir=out_dir, prefetcher=prefetcher)
+        assert list(prefetcher.failures) == [22]
+
+    ## Kepid 22 is not processed from the quarters that were staged
+    assert sorted(processed) == [11, 33]
+    kepids = np.load(os.path.join(out_dir, 'flux_kepids.npy')).tolist()
+    labels = dict(zip(kepids, np.asarray(flux_labels).tolist()))
+    flux = dict(zip(kepids, np.asarray(flux_data)[:, 0].tolist()))
+    assert labels == {11: 1, 22: -1, 33: 0}
+    assert (flux[11], flux[33]) == (3., 3.)
+
+    journal = read_journal(os.path.join(out_dir, 'processing_journal.jsonl'))
+    statuses = dict((entry['kepid'], entry['status'])
+                    for entry in journal.values())
+    assert statuses == {11: COMPLETED, 22: FAILED, 33: COMPLETED}
+    error = journal[kepids.index(22)]['error']
+    assert error.startswith('fetch failed: FetchError')
+    assert 'corrupt' in error
+
+    ## No partial transfers are left behind
+    assert os.listdir(os.path.join(stage_dir, '.partial')) == []
@@ -0,0 +1,58 @@
+################
+## Packages to be used
+####
+
+import csv
+
+from processing_journal import (ProcessingJournal, read_journal, COMPLETED,
+                                FAILED, SKIPPED)
+
+################
+## Tests
+####
+
+def test_latest_entry_wins_and_torn_lines_are_ignored(tmp_path):
+    journal_file = str(tmp_path / 'processing_journal.jsonl')
+    with ProcessingJournal(journal_file) as journal:
+        journal.record(0, 11, COMPLETED)
+        journal.record(1, 22, FAILED, 'OSError: timed out')
+        journal.record(2, 33, SKIPPED, 'No fits files found')
+
+    ## A retry of row 1, then a crash halfway through a line
+    with ProcessingJournal(journal_file, resume=True) as journal:
+        assert journal.rows_with_status(FAILED, SKIPPED) == [1, 2]
+        journal.record(1, 22, COMPLETED)
+    with open(journal_file, 'a') as f:
+        f.write('{"row": 3, "kepid": 4')
+
+    entries = read_journal(journal_file)
+    assert sorted(entries) == [0, 1, 2]
+    assert entries[1]['status'] == COMPLETED
+
+    journal = ProcessingJournal(journal_file, resume=True)
+    assert journal.counts() == {COMPLETED: 2, FAILED: 0, SKIPPED: 1}
+    journal.close()
+
+
+def test_not_resuming_empties_the_journal(tmp_path):
+    journal_file = str(tmp_path / 'processing_journal.jsonl')
+    with ProcessingJournal(journal_file) as journal:
+        journal.record(0, 11, FAILED, 'ValueError: bad')
+    with ProcessingJournal(journal_file) as journal:
+        assert journal.counts()[FAILED] == 0
+    assert read_journal(journal_file) == {}
+
+
+def test_report(tmp_path):
+    with ProcessingJournal(str(tmp_path / 'journal.jsonl')) as journal:
+        journal.record(0, 11, COMPLETED)
+        journal.record(1, 22, FAILED, 'ValueError: bad')
+        journal.record(2, 33, SKIPPED, 'No fits files found')
+        report_file = str(tmp_path / 'processing_failures.csv')
+        assert journal.write_report(report_file) == 2
+
+    with open(report_file) as f:
+        rows = list(csv.reader(f))
+    assert rows == [['row', 'kepid', 'status', 'error'],
+                    ['1', '22', FAILED, 'ValueError: bad'],
+                    ['2', '33', SKIPPED, 'No fits files found']]
@@ -0,0 +1,58 @@
+################
+## Packages to be used
+####
+
+import io
+import json
+
+import pytest
+
+from progress import ProgressReporter
+from instrumentation import RunStats, StageRecord
+
+################
+## Tests
+####
+
+def test_reports_are_rate_limited():
+    stream = io.StringIO()
+    progress = ProgressReporter(1000, interval=3600, stream=stream)
+    for _ in range(500):
+        progress.update()
+    assert stream.getvalue() == ''
+
+    progress.close()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith('Processing: 500/1000 TCEs (50.0%)')
+    assert 'ETA' in lines[0]
+
+
+def test_json_reports():
+    stream = io.StringIO()
+    stats = RunStats()
+    record = StageRecord(11)
+    record.add_count('cache_hits', 3)
+    record.add_count('cache_misses')
+    stats.merge(record, 'failed')
+
+    progress = ProgressReporter(10, name='Train Data', interval=3600,
+                                log_format='json', stream=stream,
+                                stats=stats)
+    progress.update(4, status='completed')
+    progress.report(now=progress.start + 2.)
+    progress.close()
+
+    first, *_, last = [json.loads(line)
+                       for line in stream.getvalue().splitlines()]
+    assert first['event'] == 'progress' and last['event'] == 'finished'
+    assert first['name'] == 'Train Data'
+    assert (first['done'], first['total']) == (4, 10)
+    assert first['rate'] == 2. and first['eta_seconds'] == 3.
+    assert first['statuses'] == {'completed': 4, 'failed': 1}
+    assert first['cache_hit_rate'] == 0.75
+
+
+def test_unknown_log_format():
+    with pytest.raises(ValueError):
+        ProgressReporter(10, log_format='xml')
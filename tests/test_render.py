@@ -0,0 +1,47 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+import pandas as pd
+
+import render
+
+################
+## Tests
+####
+
+## Rows of the flux store: kepid 10 has two TCEs
+TCE_DATA = pd.DataFrame({'kepid': [10, 20, 10, 30],
+                         'tce_plnt_num': [2, 1, 1, 1]})
+KEPID_LABELS = np.array([['10', 'AFP'], ['20', 'PC'], ['10', 'PC'],
+                         ['30', 'NTP']])
+
+
+def test_scores_joined_on_every_tce(tmp_path):
+    scores_file = str(tmp_path / 'scores.csv')
+    pd.DataFrame({'kepid': [10, 10, 20],
+                  'tce_plnt_num': [1, 2, 1],
+                  'probability': [0.9, 0.1, 0.5],
+                  'error': ['', '', '']}).to_csv(scores_file, index=False)
+
+    scores = render.read_scores(scores_file, TCE_DATA)
+
+    np.testing.assert_array_equal(scores, [0.1, 0.5, 0.9, np.nan])
+    rows = render.select_rows(KEPID_LABELS, scores=scores, min_score=0.3,
+                              sort_by_score=True)
+    assert rows.tolist() == [2, 1]
+
+
+def test_scores_without_plnt_num(tmp_path):
+    ## Scored from a .npy flux array: only kepids with one TCE match
+    scores_file = str(tmp_path / 'scores.csv')
+    pd.DataFrame({'kepid': [10, 20, 30],
+                  'tce_plnt_num': [np.nan, np.nan, np.nan],
+                  'probability': [0.9, 0.5, np.nan],
+                  'error': ['', '', 'not processed']}).to_csv(
+        scores_file, index=False)
+
+    scores = render.read_scores(scores_file, TCE_DATA)
+
+    np.testing.assert_array_equal(scores, [np.nan, 0.5, np.nan, np.nan])
@@ -0,0 +1,114 @@
+################
+## Packages to be used
+####
+
+import types
+import numpy as np
+import pandas as pd
+
+import kepler_data_processing as kdp
+import score_tces
+from flux_cache import FluxCache
+
+################
+## A kepid with two TCEs
+####
+
+## kepid 10 has two planets, kepid 20 one
+TCES = pd.DataFrame({'kepid': [10, 20, 10],
+                     'tce_plnt_num': [1, 1, 2],
+                     'tce_period': [3.5, 9.1, 41.0],
+                     'tce_time0bk': [130.0, 133.3, 151.2],
+                     'tce_duration': [2.1, 4.0, 7.5]})
+
+
+def stitched_light_curve():
+    ## Light curve with the transits of both planets of kepid 10
+    time = 130. + np.arange(50000) * 0.0204336
+    flux = 1. + np.random.RandomState(0).normal(0, 1e-4, len(time))
+    for period, t0, depth in [(3.5, 130.0, 1e-3), (41.0, 151.2, 5e-3)]:
+        phase = ((time - t0) / period + 0.5) % 1 - 0.5
+        flux[np.abs(phase * period) < 0.1] -= depth
+    return types.SimpleNamespace(time=time, flux=flux)
+
+
+def expected_views(plnt_num):
+    tce = TCES[(TCES.kepid == 10) & (TCES.tce_plnt_num == plnt_num)].iloc[0]
+    lc = stitched_light_curve()
+    return np.concatenate(list(kdp.fold_views(
+        lc.time, lc.flux, tce.tce_period, tce.tce_time0bk,
+        tce.tce_duration / 24).values()))
+
+
+def patch_fits_files(monkeypatch, tmp_path):
+    ## One (empty) fits file per kepid, stitched into the light curve
+    fits_file = tmp_path / 'kplr000000010-2009131105131_llc.fits'
+    fits_file.write_bytes(b'')
+    monkeypatch.setattr(kdp, 'get_kepid_files',
+                        lambda kepid, *args, **kwargs: [str(fits_file)])
+    monkeypatch.setattr(kdp, 'stitch_kepid',
+                        lambda *args, **kwargs: stitched_light_curve())
+
+################
+## Tests
+####
+
+def test_metadata_of_every_tce(tmp_path):
+    csv_file = tmp_path / 'tces.csv'
+    TCES.to_csv(csv_file, index=False)
+    tce_data = score_tces.read_tce_csv(str(csv_file))
+
+    assert len(tce_data) == 3
+    assert kdp.get_metadata(10, tce_data, 1) == (3.5, 130.0)
+    assert kdp.get_metadata(10, tce_data, 2) == (41.0, 151.2)
+    assert kdp.get_duration(10, tce_data, 2) == 7.5 / 24
+    ## Without a plnt_num, the multi_planet policy still applies
+    assert kdp.get_metadata(10, tce_data) == (3.5, 130.0)
+
+
+def test_every_tce_folded_at_its_own_period(tmp_path, monkeypatch):
+    patch_fits_files(monkeypatch, tmp_path)
+    csv_file = tmp_path / 'tces.csv'
+    TCES.to_csv(csv_file, index=False)
+
+    ## The second pass is read from the cache, keyed by the TCE
+    cache = FluxCache(str(tmp_path / 'cache'))
+    for _ in range(2):
+        scored = list(score_tces.iter_csv_fluxes(
+            str(csv_file), flux_kwargs={'views': kdp.VIEWS, 'cache': cache}))
+
+        assert [(kepid, plnt_num) for kepid, plnt_num, _, _ in scored] == \
+            [(10, 1), (20, 1), (10, 2)]
+        assert all(error is None for _, _, _, error in scored)
+        np.testing.assert_array_equal(scored[0][2], expected_views(1))
+        np.testing.assert_array_equal(scored[2][2], expected_views(2))
+        assert not np.array_equal(scored[0][2], scored[2][2])
+
+
+class MeanModel(object):
+    ## Stand-in for the Keras model: the mean flux of every TCE
+    def predict_on_batch(self, batch):
+        return batch.mean(axis=(1, 2))[:, np.newaxis]
+
+
+def test_unprocessed_rows_are_not_scored(tmp_path):
+    ## The flux store of main_data_processing; row 1 was not processed
+    flux_data = np.full((3, kdp.FLUX_LEN), 0.5, dtype=np.float32)
+    flux_data[1] = np.nan
+    np.save(str(tmp_path / 'flux_data.npy'), flux_data)
+    np.save(str(tmp_path / 'flux_kepids.npy'), np.array([10, 20, 30]))
+    np.save(str(tmp_path / 'flux_labels.npy'), np.array([1, -1, 0]))
+
+    out_file = str(tmp_path / 'scores.csv')
+    stats = score_tces.score_stream(
+        MeanModel(), score_tces.iter_array_fluxes(
+            str(tmp_path / 'flux_data.npy'),
+            str(tmp_path / 'flux_kepids.npy')),
+        out_file, batch_size=2)
+
+    scores = pd.read_csv(out_file).set_index('kepid')
+    assert stats['scored'] == 2 and stats['failed'] == 1
+    assert sorted(scores.index) == [10, 20, 30]
+    assert scores.loc[[10, 30], 'probability'].tolist() == [0.5, 0.5]
+    assert np.isnan(scores.loc[20, 'probability'])
+    assert scores.loc[20, 'error'] == 'not processed'
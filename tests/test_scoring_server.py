@@ -0,0 +1,94 @@
+################
+## Packages to be used
+####
+
+import threading
+import pytest
+import numpy as np
+
+import kepler_data_processing as kdp
+from scoring_server import MicroBatcher
+
+################
+## A model that records the shape of every batch
+####
+
+class ShapeModel(object):
+    ## The probability is the mean of the first 10 bins of the flux
+    def __init__(self):
+        self.shapes = []
+
+    def predict_on_batch(self, batch):
+        self.shapes.append(batch.shape)
+        return batch[:, :10, 0].mean(axis=1).reshape(-1, 1)
+
+################
+## Tests
+####
+
+def test_batches_padded_to_max_batch():
+    model = ShapeModel()
+    batcher = MicroBatcher(model, max_batch=4, max_wait_ms=20)
+
+    ## 7 concurrent requests and a late one: batches of varying sizes
+    results = {}
+    def predict(n):
+        results[n] = batcher.predict(np.full(kdp.FLUX_LEN, n / 10.))
+    threads = [threading.Thread(target=predict, args=(n,)) for n in range(7)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    predict(7)
+
+    np.testing.assert_allclose([results[n] for n in range(8)],
+                               np.arange(8) / 10., rtol=1e-6)
+    assert sum(batcher.batch_sizes) == 8
+    assert batcher.batch_sizes[-1] == 1
+    assert set(model.shapes) == set([(4, kdp.FLUX_LEN, 1)])
+
+
+def run_concurrently(batcher, fluxes):
+    ## Returns the probability (or the error) of every flux
+    results = {}
+    def predict(n):
+        try:
+            results[n] = batcher.predict(fluxes[n])
+        except Exception as e:
+            results[n] = e
+    threads = [threading.Thread(target=predict, args=(n,))
+               for n in range(len(fluxes))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    return results
+
+
+def test_malformed_flux_only_fails_its_request():
+    batcher = MicroBatcher(ShapeModel(), max_batch=8, max_wait_ms=50)
+    fluxes = [np.full(kdp.FLUX_LEN, n / 10.) for n in range(5)]
+    fluxes[2] = np.ones(kdp.FLUX_LEN - 3)
+
+    results = run_concurrently(batcher, fluxes)
+
+    assert isinstance(results[2], ValueError)
+    assert 'length {}'.format(kdp.FLUX_LEN - 3) in str(results[2])
+    np.testing.assert_allclose([results[n] for n in [0, 1, 3, 4]],
+                               [0., .1, .3, .4], rtol=1e-6)
+
+    ## The batching thread is still running
+    assert batcher.predict(np.full(kdp.FLUX_LEN, .5)) == pytest.approx(.5)
+
+
+def test_model_error_fails_the_batch_only():
+    model = ShapeModel()
+    batcher = MicroBatcher(model, max_batch=8, max_wait_ms=50)
+    model.predict_on_batch = None
+
+    results = run_concurrently(batcher, [np.zeros(kdp.FLUX_LEN)] * 3)
+    assert all(isinstance(result, TypeError) for result in results.values())
+
+    del model.predict_on_batch
+    assert batcher.predict(np.full(kdp.FLUX_LEN, .2)) == pytest.approx(.2)
@@ -0,0 +1,60 @@
+################
+## Packages to be used
+####
+
+import types
+import numpy as np
+import pytest
+
+lk = pytest.importorskip('lightkurve')
+import kepler_data_processing as kdp
+from fits_reader import read_pdcsap
+
+################
+## Quarters with flagged cadences
+####
+
+def write_quarters(write_fits, n_quarters=3, n_cadences=400):
+    rng = np.random.RandomState(0)
+    paths, kept = [], []
+    for q in range(n_quarters):
+        time = 131.5 + q * 90 + np.arange(n_cadences) * 0.0204335
+        flux = (1e4 + rng.normal(0, 1, n_cadences)).astype(np.float32)
+        quality = np.zeros(n_cadences, dtype=np.int32)
+        quality[rng.choice(n_cadences, 5 + q, replace=False)] = 32
+        paths.append(write_fits('kplr000000011-q{}_llc.fits'.format(q),
+                                time, flux, quality))
+        kept.append((time[quality == 0], flux[quality == 0]))
+    return paths, kept
+
+
+## Opens a quarter without flattening it, so the stitched flux can be
+## compared with the flux in the files
+def open_unflattened(path, window_length=101, reader='lightkurve'):
+    data = read_pdcsap(path)
+    return types.SimpleNamespace(time=data.time, flux=data.flux,
+                                 flux_err=data.flux_err)
+
+################
+## Tests
+####
+
+def test_stitches_quarters_in_order(write_fits, monkeypatch):
+    paths, kept = write_quarters(write_fits)
+    monkeypatch.setattr(kdp, 'open_quarter', open_unflattened)
+
+    assert [kdp.get_fits_row_count(path) for path in paths] == [400] * 3
+
+    lc = kdp.stitch_kepid(paths)
+
+    ## Only the unflagged cadences, every quarter after the previous one
+    assert len(lc.flux) == sum(len(time) for time, _ in kept) == 1182
+    np.testing.assert_array_equal(
+        np.asarray(lc.time), np.concatenate([time for time, _ in kept]))
+    np.testing.assert_allclose(
+        np.asarray(lc.flux), np.concatenate([flux for _, flux in kept]))
+
+
+def test_no_fits_files():
+    with pytest.raises(kdp.NoFitsFilesError):
+        kdp.stitch_kepid([])
@@ -0,0 +1,62 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic_data as sd
+import kepler_data_processing as kdp
+
+################
+## Tests
+####
+
+@pytest.mark.parametrize('label', ['PC', 'AFP', 'NTP'])
+def test_injected_signal(label):
+    period, t0 = 3.5, 132.0
+    columns = sd.make_quarter(np.random.RandomState(0), 2, period, t0, label)
+
+    time, flux = columns['TIME'], columns['PDCSAP_FLUX']
+    assert len(time) == int(sd.QUARTER_LENGTHS[1] / sd.LONG_CADENCE)
+    assert time[0] == sd.QUARTER_STARTS[1]
+
+    ## Only PCs and AFPs dip at mid-transit
+    phase = (time - t0 + 0.5 * period) % period - 0.5 * period
+    depth = 1 - (np.nanmedian(flux[np.abs(phase) < 0.02]) /
+                 np.nanmedian(flux[np.abs(phase) > 0.3]))
+    if label == 'NTP':
+        assert abs(depth) < 2e-3
+    else:
+        assert depth > 1e-4
+
+    ## A downlink gap, plus some flagged cadences
+    quality = columns['SAP_QUALITY']
+    assert np.isnan(flux[quality & sd.MANUAL_EXCLUDE > 0]).all()
+    assert (quality & (sd.DESAT | sd.APERTURE_COSMIC) > 0).any()
+
+
+def test_dataset_layout(tmp_path):
+    pytest.importorskip('astropy')
+    from fits_reader import read_pdcsap
+
+    csv_file = sd.generate_synthetic_dataset(str(tmp_path), n_kepids=3,
+                                             quarters=(1, 2), seed=1)
+
+    tces = pd.read_csv(csv_file)
+    assert len(tces) == 3
+    assert set(tces['av_training_set']) <= {'PC', 'AFP', 'NTP'}
+
+    ## Laid out like the MAST download, and readable as Kepler quarters
+    for kepid in tces['kepid']:
+        paths = kdp.get_kepid_files(kepid, data_dir=str(tmp_path / 'data'))
+        assert 1 <= len(paths) <= 2
+        data = read_pdcsap(paths[0])
+        assert len(data.time) > 0
+        assert ((data.quality & (sd.DESAT | sd.MANUAL_EXCLUDE)) == 0).all()
+
+    ## The same seed gives the same dataset
+    again = sd.generate_synthetic_dataset(str(tmp_path / 'again'),
+                                          n_kepids=3, quarters=(1, 2), seed=1)
+    pd.testing.assert_frame_equal(pd.read_csv(again), tces)
@@ -0,0 +1,154 @@
+################
+## Packages to be used
+####
+
+import numpy as np
+import pytest
+
+import tfrecords_creation as tfc
+
+################
+## TensorFlow 1.x, when installed
+####
+
+@pytest.fixture
+def tf():
+    pytest.importorskip('tensorflow')
+    try:
+        return tfc.import_tensorflow()
+    except AttributeError:
+        pytest.skip('needs TensorFlow 1.x (tf.enable_eager_execution)')
+
+
+def read_records(tf, path, compression=None):
+    options = None
+    if compression is not None:
+        options = tf.python_io.TFRecordOptions(compression)
+    return [tf.train.Example.FromString(record) for record in
+            tf.python_io.tf_record_iterator(path, options=options)]
+
+
+def make_flux(n_rows=10, flux_len=5):
+    data = np.arange(n_rows * flux_len, dtype=np.float64).reshape(
+        n_rows, flux_len) / 7.
+    labels = np.arange(n_rows) % 2
+    return data, labels
+
+################
+## Tests
+####
+
+def test_shard_filenames():
+    assert tfc.shard_filenames('tfrecords/train.tfrecords', 1) == [
+        'tfrecords/train.tfrecords']
+    assert tfc.shard_filenames('tfrecords/train.tfrecords', 3) == [
+        'tfrecords/train-00000-of-00003.tfrecords',
+        'tfrecords/train-00001-of-00003.tfrecords',
+        'tfrecords/train-00002-of-00003.tfrecords']
+
+
+def test_sharded_compressed_records(tmp_path, tf):
+    data, labels = make_flux()
+    labels[4] = -1
+
+    info = tfc.create_data_record(str(tmp_path / 'train.tfrecords'), data,
+                                  labels, num_shards=3, compression='GZIP',
+                                  flux_dtype='float16')
+
+    ## Unprocessed rows are not written
+    assert info['total_records'] == sum(info['records']) == 9
+    assert info['flux_dtype'] == 'float16' and info['flux_len'] == 5
+
+    examples = []
+    for filename in info['files']:
+        examples += read_records(tf, str(tmp_path / filename), 'GZIP')
+    written = [np.frombuffer(e.features.feature['flux_data'].bytes_list
+                             .value[0], dtype=np.float16) for e in examples]
+    np.testing.assert_array_equal(
+        written, np.delete(data, 4, axis=0).astype(np.float16))
+    assert [e.features.feature['label'].int64_list.value[0]
+            for e in examples] == np.delete(labels, 4).tolist()
+
+
+def test_load_dataset(tmp_path, tf):
+    data, labels = make_flux(flux_len=6)
+    info = tfc.create_data_record(str(tmp_path / 'train.tfrecords'), data,
+                                  labels, flux_dtype='float32')
+    tfc.write_manifest(str(tmp_path), {'train': info})
+
+    batches = list(tfc.load_dataset(str(tmp_path), 'train', batch_size=4,
+                                    shuffle_buffer=0))
+
+    assert [tuple(flux.shape) for flux, _ in batches] == [
+        (4, 6, 1), (4, 6, 1), (2, 6, 1)]
+    flux = np.concatenate([np.asarray(flux) for flux, _ in batches])
+    label = np.concatenate([np.asarray(label) for _, label in batches])
+    np.testing.assert_allclose(flux[:, :, 0], data, rtol=1e-6)
+    np.testing.assert_array_equal(label, labels)
+
+
+def test_splits_stable_when_tces_added():
+    kepids = np.arange(10000, 12000)
+    splits = tfc.assign_splits(kepids, seed=3)
+
+    ## About 80/10/10, and the same kepids keep their split whatever 
+    ## other kepids are added (or in which order)
+    counts = dict((split, np.sum(splits == split)) for split in tfc.SPLITS)
+    assert abs(counts['train'] / 2000. - 0.8) < 0.05
+    assert abs(counts['val'] / 2000. - 0.1) < 0.05
+
+    more = np.concatenate([np.arange(50000, 50500), kepids[::-1]])
+    np.testing.assert_array_equal(
+        tfc.assign_splits(more, seed=3)[500:], splits[::-1])
+
+    ## Another seed, other splits
+    assert (tfc.assign_splits(kepids, seed=4) != splits).any()
+
+
+def test_stratified_splits():
+    kepids = np.arange(1000)
+    labels = (kepids % 5 == 0).astype(int)
+
+    splits = tfc.assign_splits(kepids, labels=labels)
+
+    for label in (0, 1):
+        members = splits[labels == label]
+        assert np.sum(members == 'train') == 0.8 * len(members)
+        assert np.sum(members == 'val') == 0.1 * len(members)
+
+
+def test_split_indices():
+    kepids = np.repeat(np.arange(100, 400), 2)
+    labels = np.arange(600) % 2
+    labels[::7] = -1
+
+    rows = tfc.split_indices(kepids, labels, seed=1)
+
+    ## Every processed row is in exactly one split, and both TCEs of a
+    ## kepid are in the same split
+    every = np.concatenate([rows[split] for split in tfc.SPLITS])
+    np.testing.assert_array_equal(np.sort(every), np.flatnonzero(labels >= 0))
+    kepid_splits = set((kepids[row], split) for split in tfc.SPLITS
+                       for row in rows[split])
+    assert len(kepid_splits) == len(set(kepids[every]))
+
+    again = tfc.split_indices(kepids, labels, seed=1)
+    for split in tfc.SPLITS:
+        np.testing.assert_array_equal(rows[split], again[split])
+
+
+def test_row_view():
+    data, _ = make_flux()
+    rows = np.array([7, 2, 2, 9])
+
+    view = tfc.RowView(data, rows)
+
+    assert len(view) == 4
+    np.testing.assert_array_equal(view[1], data[2])
+    np.testing.assert_array_equal(np.asarray(view[2:]), data[[2, 9]])
+    np.testing.assert_array_equal(np.asarray(view, dtype=np.float32),
+                                  data[rows].astype(np.float32))
+
+    ## The rows are always copied
+    with pytest.raises(ValueError):
+        np.array(view, copy=False)
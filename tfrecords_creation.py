@@ -2,16 +2,39 @@
 ## Packages to be used
 ####
 
-from tensorflow import keras
 from random import shuffle
-import tensorflow as tf
+from instrumentation import stage, count, recording, RunStats
+from progress import ProgressReporter
 import numpy as np
+import concurrent.futures
+import multiprocessing
+import collections
+import hashlib
+import json
 import glob
 import time
-import sys
 import os
 
-tf.enable_eager_execution()
+## tensorflow takes seconds to import, so it is only imported (and eager
+## execution enabled) the first time it is needed, see import_tensorflow
+_tf = None
+
+
+def import_tensorflow():
+    '''
+    The import_tensorflow function imports tensorflow and enables eager
+        execution, once per process.
+    
+    Returns:
+        tf: the tensorflow module
+    '''
+    
+    global _tf
+    if _tf is None:
+        import tensorflow as tf
+        tf.enable_eager_execution()
+        _tf = tf
+    return _tf
 
 ################
 ## Methods to be used for tfrecords creation
@@ -19,70 +42,362 @@ tf.enable_eager_execution()
 
 ## Wrappers for the feature
 def _int64_feature(value):
+    tf = import_tensorflow()
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 def _bytes_feature(value):
+    tf = import_tensorflow()
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
     
 
-def create_data_record(out_filename, data, labels, data_type='Train'):
+def serialize_example(tce, label, flux_dtype=None, kepid=None, views=None):
+    '''
+    The serialize_example function turns one TCE into a serialized
+        tf.train.Example holding its flux data and label.
+    
+    Args: 
+        tce: np.array; flux data of the TCE
+        label: int; label of the TCE
+        flux_dtype: dtype the flux is stored as (e.g. 'float32' or 
+            'float16'). Default = None (keep the dtype of tce).
+        kepid: if given, stored as an extra 'kepid' feature.
+            Default = None.
+        views: dict; name -> np.array of the other views of the TCE 
+            (see kepler_data_processing.fold_views), each stored as an 
+            extra '<name>_view' feature like flux_data. Default = None.
+    
+    Returns:
+        example: bytes; the serialized example
     '''
-    The create_data_record function takes in data and labels,
-        then converts them to tfrecords.
+    
+    tf = import_tensorflow()
+    
+    if flux_dtype is None:
+        flux_dtype = np.asarray(tce).dtype
+    tce = np.asarray(tce, dtype=flux_dtype)
+    
+    ## Create a feature
+    feature = {
+        'flux_data': _bytes_feature(np.ascontiguousarray(tce).tobytes()),
+        'label': _int64_feature(int(label))
+    }
+    if kepid is not None:
+        feature['kepid'] = _int64_feature(int(kepid))
+    for name, view in (views or {}).items():
+        feature[name+'_view'] = _bytes_feature(
+            np.ascontiguousarray(view, dtype=flux_dtype).tobytes())
+    # Create an example protocol buffer
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    
+    # Serialize to string
+    return example.SerializeToString()
+
+
+def shard_filenames(out_filename, num_shards):
+    '''
+    The shard_filenames function names the shards of one output file.
+    A single shard keeps out_filename itself.
+        Ex. 'tfrecords/train.tfrecords', 4 shards -> 
+            'tfrecords/train-00000-of-00004.tfrecords', ...
+    '''
+    
+    if num_shards == 1:
+        return [out_filename]
+    
+    base, ext = os.path.splitext(out_filename)
+    return ['{}-{:05d}-of-{:05d}{}'.format(base, i, num_shards, ext)
+            for i in range(num_shards)]
+
+
+def write_shard(out_filename, data, labels, compression=None, 
+                flux_dtype=None, progress=None, kepids=None, views=None):
+    '''
+    The write_shard function writes TCEs to a single tfrecords file.
+    Runs in the worker processes of create_data_record.
     
     Args: 
         out_filename: str; location and ouput file name.
-            Must end with the .tfrecords file type.
-            Ex. out_filename = 'tfrecords/train.tfrecords'
-        data: np.array; all flux data
-        labels: np.array; all data labels
-        data_type: str; used to name the output files.
-            Ex. data_type = 'Validation'
-            Default = 'Train'
-        
-    Writes Out:
-        The output .tfrecords file contains both flux data and labels.
-        Output file is placed according to out_filename.
+        data: np.array; flux data of the shard
+        labels: np.array; labels of the shard
+        compression: None, 'GZIP' or 'ZLIB'. Default = None.
+        flux_dtype: dtype the flux is stored as. Default = None.
+        progress: ProgressReporter updated for every TCE (serial runs 
+            only). Default = None (quiet).
+        kepids: np.array; kepids of the shard, stored with every TCE.
+            Default = None (not stored).
+        views: dict; name -> np.array of the other views of the shard,
+            see serialize_example. Default = None.
+    
+    Returns:
+        records: int; number of TCEs written.
+        record: StageRecord with the time spent serializing and writing.
     '''
     
-    ## Open the TFRecords file
-    writer = tf.python_io.TFRecordWriter(out_filename)  
+    tf = import_tensorflow()
     
-    print('\nCommencing DataRecord creation..')
+    with recording(os.path.basename(out_filename)) as record:
+        records = _write_shard_records(tf, out_filename, data, labels, 
+                                       compression, flux_dtype, progress,
+                                       kepids, views)
+    
+    return records, record
+
+
+def _write_shard_records(tf, out_filename, data, labels, compression, 
+                         flux_dtype, progress, kepids, views):
+    ## Open the TFRecords file
+    options = None
+    if compression is not None:
+        options = tf.python_io.TFRecordOptions(compression)
+    writer = tf.python_io.TFRecordWriter(out_filename, options=options)
     
+    records = 0
     for i in range(len(data)):
-        ## Print how many TCEs are saved every 10 TCEs
-        if (i % 10 == 0):
-            print('{} Data: {}/{}'.format(data_type, i, len(data)))
-            sys.stdout.flush()
-        
-        ## Print for last TCE
-        elif (i == len(data)-1):
-            print('{} Data: {}/{}'.format(data_type, i+1, len(data)))
-            sys.stdout.flush()
+        ## Reporting progress (rate limited)
+        if progress is not None:
+            progress.update()
         
         ## Load the TCE
-        tce = data[i]
+        with stage('read'):
+            tce = data[i]
         
         ## Load the label
         label = labels[i]
         
-        ## Quick check for empty TCEs
-        if tce is None:
+        ## Quick check for empty TCEs (and TCEs that failed to process)
+        if tce is None or int(label) < 0:
             continue
+        
+        # Write the serialized example on the file
+        with stage('serialize'):
+            example = serialize_example(
+                tce, label, flux_dtype, 
+                None if kepids is None else kepids[i],
+                None if views is None else 
+                dict((name, view[i]) for name, view in views.items()))
+        with stage('write'):
+            writer.write(example)
+        count('bytes_serialized', len(example))
+        records += 1
+    
+    with stage('write'):
+        writer.close()
+    
+    return records
+
 
-        ## Create a feature
-        feature = {
-            'flux_data': _bytes_feature(tce.tostring()),
-            'label': _int64_feature(label.astype(int))
-        }
-        # Create an example protocol buffer
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
+class RowView(object):
+    '''
+    The RowView class gives the rows of an array (e.g. the memory-mapped
+        flux store) in a given order, reading one row at a time instead
+        of copying them all. np.asarray(view) does copy them, which is 
+        only done when the rows are sent to another process.
+    Arrays other than np.arrays (e.g. the h5py datasets of a 
+        flux_store.FluxStore) are read block_rows rows at a time, as 
+        every read decompresses whole chunks.
+    
+    Args:
+        array: np.array, np.memmap or h5py.Dataset
+        rows: np.array of row indices
+        block_rows: int; rows read at once from other arrays.
+            Default = 256.
+    '''
+    
+    def __init__(self, array, rows, block_rows=256):
+        self.array = array
+        self.rows = np.asarray(rows)
+        self.block_rows = block_rows
+        self._block_start = None
+        self._block = None
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return RowView(self.array, self.rows[i], self.block_rows)
+        if isinstance(self.array, np.ndarray):
+            return self.array[self.rows[i]]
         
-        # Serialize to string and write on the file
-        writer.write(example.SerializeToString())
+        start = i - i % self.block_rows
+        if start != self._block_start:
+            self._block = np.asarray(self[start:start+self.block_rows])
+            self._block_start = start
+        return self._block[i - start]
+    
+    def __array__(self, dtype=None, copy=None):
+        ## The rows are always gathered into a new array, so there is 
+        ## no way around a copy (NumPy 2 passes copy=False for that)
+        if copy is False:
+            raise ValueError('a RowView cannot be converted to an array '
+                             'without copying its rows')
+        if isinstance(self.array, np.ndarray):
+            return np.asarray(self.array[self.rows], dtype=dtype)
         
-    writer.close()
-    sys.stdout.flush()
+        ## h5py only reads increasing rows
+        if len(self.rows) == 0:
+            return np.empty((0,) + tuple(self.array.shape[1:]), 
+                            dtype=dtype or self.array.dtype)
+        unique, inverse = np.unique(self.rows, return_inverse=True)
+        return np.asarray(self.array[unique], dtype=dtype)[inverse]
+
+
+def write_shards(shards, compression=None, flux_dtype=None, n_workers=1, 
+                 progress=None):
+    '''
+    The write_shards function writes several shards, in parallel if 
+        n_workers > 1.
+    
+    Args: 
+        shards: list of (out_filename, data, labels, kepids, views) 
+            tuples; kepids and views may be None.
+        compression: None, 'GZIP' or 'ZLIB'. Default = None.
+        flux_dtype: dtype the flux is stored as. Default = None.
+        n_workers: int; number of worker processes. Default = 1.
+        progress: ProgressReporter. Default = None.
+    
+    Returns:
+        results: list of (records, record) of every shard, see 
+            write_shard.
+    '''
+    
+    if n_workers <= 1:
+        return [write_shard(filename, data, labels, compression, 
+                            flux_dtype, progress, kepids, views)
+                for filename, data, labels, kepids, views in shards]
+    
+    ## Each worker writes whole shards; spawn avoids forking an
+    ## already initialized tensorflow
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=n_workers, 
+        mp_context=multiprocessing.get_context('spawn'))
+    with executor:
+        futures = [executor.submit(write_shard, filename, np.asarray(data),
+                                   np.asarray(labels), compression, 
+                                   flux_dtype, None, 
+                                   None if kepids is None 
+                                   else np.asarray(kepids),
+                                   None if views is None else
+                                   dict((name, np.asarray(view)) 
+                                        for name, view in views.items()))
+                   for filename, data, labels, kepids, views in shards]
+        results = []
+        for future, (_, data, _, _, _) in zip(futures, shards):
+            results.append(future.result())
+            if progress is not None:
+                progress.update(len(data))
+    
+    return results
+
+
+def create_data_record(out_filename, data, labels, data_type='Train',
+                       num_shards=1, compression=None, flux_dtype=None,
+                       n_workers=1, stats=None, progress_interval=10., 
+                       log_format='text', rows=None, kepids=None, 
+                       views=None):
+    '''
+    The create_data_record function takes in data and labels,
+        then converts them to tfrecords.
+    The output can be split into several shards, which are written in
+        parallel by n_workers processes.
+    
+    Args: 
+        out_filename: str; location and ouput file name.
+            Must end with the .tfrecords file type.
+            Ex. out_filename = 'tfrecords/train.tfrecords'
+        data: np.array; all flux data (or the flux of a 
+            flux_store.FluxStore, read a block of rows at a time)
+        labels: np.array; all data labels
+        data_type: str; used to name the output files.
+            Ex. data_type = 'Validation'
+            Default = 'Train'
+        num_shards: int; number of output files. Default = 1.
+        compression: None, 'GZIP' or 'ZLIB'. Default = None.
+        flux_dtype: dtype the flux is stored as (e.g. 'float32' or 
+            'float16'). Default = None (keep the dtype of data).
+        n_workers: int; number of worker processes. Default = 1.
+        stats: RunStats the time spent writing every shard is merged 
+            into. Default = None.
+        progress_interval: float; seconds between two progress reports.
+            Default = 10.
+        log_format: 'text' or 'json', see ProgressReporter. 
+            Default = 'text'.
+        rows: np.array; if given, only these rows of data are written, 
+            in this order (see split_indices). They are read from data 
+            one at a time, so data can be a memmap of the whole flux 
+            store. Default = None (all rows).
+        kepids: np.array; kepid of every row of data, stored with every
+            TCE. Default = None (not stored).
+        views: OrderedDict; name -> np.array (e.g. memmap) of the other 
+            views of every row of data (see 
+            kepler_data_processing.load_view_arrays), stored with every
+            TCE. Default = None (flux data only).
+        
+    Writes Out:
+        The output .tfrecords files contain both flux data and labels.
+        Output files are placed according to out_filename (see 
+            shard_filenames).
+    
+    Returns:
+        split_info: dict with the shard files, the number of records
+            in each and how the flux (and views) are stored.
+    '''
+    
+    print('\nCommencing DataRecord creation..')
+    
+    filenames = shard_filenames(out_filename, num_shards)
+    
+    if rows is None:
+        rows = np.arange(len(data))
+    shard_data = RowView(data, rows)
+    shard_labels = RowView(labels, rows)
+    shard_kepids = None if kepids is None else RowView(kepids, rows)
+    shard_views = None if views is None else [
+        (name, RowView(view, rows)) for name, view in views.items()]
+    
+    ## Contiguous (start, stop) rows of every shard
+    bounds = np.linspace(0, len(rows), num_shards+1).astype(int)
+    shards = list(zip(bounds[:-1], bounds[1:]))
+    
+    progress = ProgressReporter(len(rows), '{} Data'.format(data_type), 
+                                interval=progress_interval, 
+                                log_format=log_format)
+    
+    results = write_shards(
+        [(filename, shard_data[start:stop], shard_labels[start:stop], 
+          None if shard_kepids is None else shard_kepids[start:stop],
+          None if shard_views is None else collections.OrderedDict(
+              (name, view[start:stop]) for name, view in shard_views))
+         for filename, (start, stop) in zip(filenames, shards)],
+        compression, flux_dtype, n_workers, progress)
+    progress.close()
+    
+    shard_records = [records for records, _ in results]
+    if stats is not None:
+        for _, record in results:
+            stats.merge(record)
+    
+    if flux_dtype is None:
+        flux_dtype = np.asarray(data[:1]).dtype
+    
+    return {
+        'files': [os.path.basename(f) for f in filenames],
+        'records': shard_records,
+        'total_records': int(sum(shard_records)),
+        'compression': compression,
+        'flux_dtype': np.dtype(flux_dtype).name,
+        'flux_len': int(np.shape(data)[1]) if len(data) else None,
+        'views': view_lengths(views),
+    }
+    
+    
+def view_lengths(views):
+    '''
+    Returns the [name, length] of every view in views (name -> 
+        np.array of all rows), as stored in the manifest.
+    '''
+    
+    return [[name, int(np.shape(view)[1])] 
+            for name, view in (views or {}).items()]
     
     
 def split_data(data, labels, train_size=0.8, val_size=0.1):
@@ -152,12 +467,413 @@ def shuffle_data(data, labels, kepid_labels):
     return data, labels, kepid_labels
     
     
+def write_manifest(tf_dir, manifest):
+    '''
+    The write_manifest function saves the shard files and record counts
+        of every split to tf_dir/manifest.json.
+    '''
+    
+    with open(os.path.join(tf_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def read_manifest(tf_dir):
+    '''
+    The read_manifest function loads tf_dir/manifest.json.
+    '''
+    
+    with open(os.path.join(tf_dir, 'manifest.json')) as f:
+        return json.load(f)
+    
+    
+################
+## Methods to be used for stable (incremental) tfrecords
+####
+
+## Names of the splits, in the order they are written
+SPLITS = ('train', 'val', 'test')
+
+
+def kepid_fraction(kepids, seed=0, salt=''):
+    '''
+    The kepid_fraction function maps every kepid to a number in [0, 1)
+        using a seeded hash, so the same kepid always gets the same 
+        number for the same seed.
+    
+    Args: 
+        kepids: iterable of kepids.
+        seed: int; a different seed gives a different mapping. 
+            Default = 0.
+        salt: str; gives an independent mapping for the same seed 
+            (e.g. for shards). Default = ''.
+    
+    Returns:
+        fractions: np.array of floats in [0, 1)
+    '''
+    
+    return np.array([
+        int(hashlib.md5('{}:{}:{}'.format(seed, salt, int(kepid)).encode())
+            .hexdigest()[:13], 16) / 16.**13
+        for kepid in kepids])
+
+
+def assign_splits(kepids, train_size=0.8, val_size=0.1, seed=0, 
+                  labels=None):
+    '''
+    The assign_splits function puts every kepid in 'train', 'val' or 
+        'test' from a seeded hash of the kepid. The same kepids and seed
+        always give the same splits, without shuffling anything.
+    
+    Args: 
+        kepids: iterable of kepids.
+        train_size: Fraction of the kepids used for training.
+            Default = 0.8
+        val_size: Fraction of the kepids used for validation.
+            Default = 0.1
+        seed: int; seed of the hash. Default = 0.
+        labels: np.array; if given, the split is stratified: every 
+            label is split in exactly the given proportions (by ranking 
+            the hashes within the label). A kepid then keeps its split 
+            only as long as the TCEs of its label do not change; 
+            without labels it keeps it whatever TCEs are added or 
+            removed. Default = None.
+    
+    Returns:
+        splits: np.array of split names.
+    '''
+    
+    fractions = kepid_fraction(kepids, seed)
+    
+    if labels is not None:
+        labels = np.asarray(labels)
+        ranks = np.empty(len(fractions))
+        for label in np.unique(labels):
+            members = np.flatnonzero(labels == label)
+            members = members[np.argsort(fractions[members])]
+            ranks[members] = (np.arange(len(members)) + 0.5) / len(members)
+        fractions = ranks
+    
+    return np.where(fractions < train_size, 'train',
+                    np.where(fractions < train_size + val_size, 
+                             'val', 'test'))
+
+
+def assign_shards(kepids, num_shards, seed=0):
+    '''
+    Returns the shard (0 to num_shards-1) of every kepid, from a hash 
+        independent of the one used by assign_splits.
+    '''
+    
+    return (kepid_fraction(kepids, seed, 'shard') * num_shards).astype(int)
+
+
+def split_indices(kepids, labels, train_size=0.8, val_size=0.1, seed=0,
+                  stratify=False):
+    '''
+    The split_indices function returns the rows of every split, to be 
+        read straight from the (memory-mapped) flux store, instead of 
+        shuffling and copying the data (see shuffle_data/split_data).
+    Rows that were not processed (label < 0) are left out. Within a 
+        split, rows are ordered by the hash of their kepid, so the order
+        is random but reproducible.
+    
+    Args: 
+        kepids: np.array; kepid of every row.
+        labels: np.array; label of every row.
+        train_size: Fraction of the kepids used for training.
+            Default = 0.8
+        val_size: Fraction of the kepids used for validation.
+            Default = 0.1
+        seed: int; seed of the hash. Default = 0.
+        stratify: bool; split every label in the same proportions, see
+            assign_splits. Default = False.
+    
+    Returns:
+        rows: dict; split name -> np.array of row indices.
+    '''
+    
+    labels = np.asarray(labels).astype(int)
+    valid = np.flatnonzero(labels >= 0)
+    kepids = np.asarray(kepids)[valid]
+    
+    splits = assign_splits(kepids, train_size, val_size, seed, 
+                           labels[valid] if stratify else None)
+    order = np.argsort(kepid_fraction(kepids, seed, 'order'), kind='stable')
+    
+    return dict((split, valid[order[splits[order] == split]])
+                for split in SPLITS)
+
+
+def _shard_digest(fingerprints):
+    ## Identifies the contents of a shard, whatever the row order
+    sha1 = hashlib.sha1()
+    for fingerprint in sorted(fingerprints):
+        sha1.update(fingerprint.encode())
+    return sha1.hexdigest()
+
+
+def update_tfrecords(flux_dir='.', tf_dir='tfrecords', num_shards=1, 
+                     compression=None, flux_dtype=None, n_workers=1,
+                     train_size=0.8, val_size=0.1, seed=0, 
+                     log_format='text'):
+    '''
+    The update_tfrecords function brings the tfrecords in tf_dir up to 
+        date with the flux store in flux_dir (see main_data_processing 
+        and incremental.update_flux_store).
+    Splits and shards are assigned from a hash of the kepid, so adding,
+        changing or removing TCEs only changes the shards holding them.
+        Only those shards are rewritten; the others are kept as they 
+        are. The first run (or a run with other settings) writes all 
+        of them.
+    
+    Args: 
+        flux_dir: str; directory holding the flux store. Default = '.'
+        tf_dir: str; directory of the tfrecords. Default = 'tfrecords'
+        num_shards: int; number of files per split. Default = 1.
+        compression: None, 'GZIP' or 'ZLIB'. Default = None.
+        flux_dtype: dtype the flux is stored as. Default = None.
+        n_workers: int; number of worker processes. Default = 1.
+        train_size: Fraction of the kepids used for training.
+            Default = 0.8
+        val_size: Fraction of the kepids used for validation.
+            Default = 0.1
+        seed: int; seed of the hash, see assign_splits. Default = 0.
+        log_format: 'text' or 'json', see ProgressReporter. 
+            Default = 'text'.
+    
+    Writes Out:
+        The rewritten shards and tf_dir/manifest.json, which also holds
+            a digest of the TCEs in every shard. The other views of the 
+            flux store (see kepler_data_processing.open_view_store) are
+            written with every TCE.
+    
+    Returns:
+        manifest: dict; the content of manifest.json.
+    '''
+    
+    from incremental import read_flux_store_state
+    from kepler_data_processing import load_view_arrays
+    
+    start = time.time()
+    if os.path.isdir(tf_dir) == False:
+        os.makedirs(tf_dir)
+    
+    ## Processed TCEs (label >= 0) and what every row was made from
+    tce_data, fingerprints = read_flux_store_state(flux_dir)
+    data = np.load(os.path.join(flux_dir, 'flux_data.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(flux_dir, 'flux_labels.npy'))
+    views = load_view_arrays(flux_dir)
+    kepids = tce_data['kepid'].values
+    valid = labels >= 0
+    
+    splits = assign_splits(kepids, train_size, val_size, seed)
+    shards = assign_shards(kepids, num_shards, seed)
+    
+    if flux_dtype is None:
+        flux_dtype = data.dtype
+    layout = {'type': 'kepid_hash', 'num_shards': num_shards,
+              'train_size': train_size, 'val_size': val_size,
+              'seed': seed, 'compression': compression,
+              'flux_dtype': np.dtype(flux_dtype).name,
+              'views': view_lengths(views)}
+    
+    ## Previous shards can only be kept if they were written the same way
+    previous = {}
+    if os.path.isfile(os.path.join(tf_dir, 'manifest.json')):
+        previous = read_manifest(tf_dir)
+    old_manifest = previous if previous.get('layout') == layout else {}
+    
+    manifest = {'layout': layout}
+    tasks = []
+    for split in SPLITS:
+        filenames = shard_filenames(
+            os.path.join(tf_dir, split+'.tfrecords'), num_shards)
+        old_digests = old_manifest.get(split, {}).get('digests', [])
+        
+        split_info = {'files': [os.path.basename(f) for f in filenames],
+                      'records': [], 'digests': [],
+                      'compression': compression,
+                      'flux_dtype': layout['flux_dtype'],
+                      'flux_len': int(data.shape[1]),
+                      'views': layout['views']}
+        for shard, filename in enumerate(filenames):
+            rows = np.flatnonzero(valid & (splits == split) & 
+                                  (shards == shard))
+            digest = _shard_digest(fingerprints[row] for row in rows)
+            split_info['records'].append(len(rows))
+            split_info['digests'].append(digest)
+            
+            ## Rewriting the shard only if its TCEs changed
+            if (shard < len(old_digests) and old_digests[shard] == digest
+                    and os.path.isfile(filename)):
+                continue
+            tasks.append((filename, RowView(data, rows), labels[rows], 
+                          kepids[rows], collections.OrderedDict(
+                              (name, RowView(view, rows)) 
+                              for name, view in views.items())))
+        
+        split_info['total_records'] = int(sum(split_info['records']))
+        manifest[split] = split_info
+    
+    total_shards = len(SPLITS) * num_shards
+    print('Rewriting {} of {} shards..'.format(len(tasks), total_shards))
+    progress = ProgressReporter(sum(len(task[1]) for task in tasks), 
+                                'Shards', log_format=log_format)
+    write_shards(tasks, compression, flux_dtype, n_workers, progress)
+    progress.close()
+    
+    ## Removing the files of an older layout
+    for split in SPLITS:
+        for filename in previous.get(split, {}).get('files', []):
+            if filename not in manifest[split]['files']:
+                os.remove(os.path.join(tf_dir, filename))
+    
+    write_manifest(tf_dir, manifest)
+    print('Updated tfrecords in {} seconds'.format(
+        round(time.time()-start, 4)))
+    
+    return manifest
+    
+    
+################
+## Methods to be used for reading tfrecords back
+####
+
+def parse_examples(serialized, flux_dtype='float64', flux_len=2001, 
+                   views=None):
+    '''
+    The parse_examples function turns a batch of serialized examples 
+        back into flux data and labels, ready for cnn_model.
+    
+    Args: 
+        serialized: tf.Tensor; batch of serialized tf.train.Examples
+        flux_dtype: dtype the flux was stored as. Default = 'float64'.
+        flux_len: int; length of every flux vector. Default = 2001.
+        views: list of [name, length] of the other views to parse too 
+            (see view_lengths). Default = None (flux data only).
+    
+    Returns:
+        flux: tf.Tensor; float32 flux data of shape (batch, flux_len, 1)
+            With views, a tuple of the flux data and of every view 
+            (batch, length, 1), in the order of views.
+        label: tf.Tensor; float32 labels of shape (batch,)
+    '''
+    
+    tf = import_tensorflow()
+    
+    spec = {
+        'flux_data': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+    }
+    for name, _ in views or []:
+        spec[name+'_view'] = tf.io.FixedLenFeature([], tf.string)
+    features = tf.io.parse_example(serialized, spec)
+    
+    def decode(key, length):
+        flux = tf.io.decode_raw(features[key], tf.as_dtype(flux_dtype))
+        return tf.reshape(tf.cast(flux, tf.float32), [-1, length, 1])
+    
+    flux = decode('flux_data', flux_len)
+    label = tf.cast(features['label'], tf.float32)
+    
+    if views:
+        flux = (flux,) + tuple(decode(name+'_view', length) 
+                               for name, length in views)
+    
+    return flux, label
+
+
+def load_dataset(tf_dir, split='train', batch_size=8, shuffle_buffer=10000,
+                 cache=False, repeat=False, num_parallel_calls=None,
+                 views=None):
+    '''
+    The load_dataset function builds a tf.data input pipeline over the
+        tfrecords written by main_tfrecords_creation.
+    Shards are read and interleaved in parallel, examples are shuffled 
+        and parsed a whole batch at a time, and batches are prefetched
+        so that the model never waits on the input.
+    
+    Args: 
+        tf_dir: str; directory holding the tfrecords and manifest.json
+        split: str; 'train', 'val' or 'test'. Default = 'train'.
+        batch_size: int; number of TCEs per batch. Default = 8.
+        shuffle_buffer: int; size of the shuffle buffer. 
+            0 disables shuffling (e.g. for evaluation). Default = 10000.
+        cache: bool or str; cache the records after the first epoch, in
+            memory (True) or in the given file. Default = False.
+        repeat: bool; repeat the dataset forever. Default = False.
+        num_parallel_calls: int; number of parallel reads and parses.
+            Default = None (let tf.data tune it).
+        views: list of the names of the other views to read with the 
+            flux data (see parse_examples), or True for all views of 
+            the split. Default = None (flux data only).
+    
+    Returns:
+        dataset: tf.data.Dataset of (flux, label) batches
+    '''
+    
+    tf = import_tensorflow()
+    
+    if num_parallel_calls is None:
+        num_parallel_calls = tf.data.experimental.AUTOTUNE
+    
+    ## Shards and storage settings of the split
+    split_info = read_manifest(tf_dir)[split]
+    filenames = [os.path.join(tf_dir, f) for f in split_info['files']]
+    compression = split_info['compression'] or ''
+    stored_views = split_info.get('views') or []
+    if views is True:
+        views = stored_views
+    elif views:
+        lengths = dict(stored_views)
+        missing = [name for name in views if name not in lengths]
+        if missing:
+            raise ValueError('The {} split has no {} view'.format(
+                split, ', '.join(missing)))
+        views = [[name, lengths[name]] for name in views]
+    
+    ## Reading the shards in parallel, in a different order every epoch
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(len(filenames))
+    dataset = dataset.interleave(
+        lambda filename: tf.data.TFRecordDataset(
+            filename, compression_type=compression),
+        cycle_length=len(filenames), 
+        num_parallel_calls=num_parallel_calls)
+    
+    ## Caching the serialized records, so that every epoch after the
+    ## first skips the disk (and decompression)
+    if cache is True:
+        dataset = dataset.cache()
+    elif cache:
+        dataset = dataset.cache(cache)
+    
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer)
+    if repeat:
+        dataset = dataset.repeat()
+    
+    ## Parsing whole batches at once, then prefetching
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        lambda serialized: parse_examples(
+            serialized, split_info['flux_dtype'], split_info['flux_len'],
+            views),
+        num_parallel_calls=num_parallel_calls)
+    
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    
+    
 ################
 ## Main method for tfrecords creation
 ####
     
     
-def main_tfrecords_creation(data, labels, kepid_labels, tf_dir='tfrecords'):
+def main_tfrecords_creation(data, labels, kepid_labels, tf_dir='tfrecords',
+                            num_shards=1, compression=None, flux_dtype=None,
+                            n_workers=1, log_format='text', seed=0, 
+                            stratify=False, views=None):
     '''
     The main_tfrecords_creation function will prepare the flux data and labels for the ML model.
     It does so by creating tfrecods files, which are optomized for tensorflow.
@@ -167,12 +883,28 @@ def main_tfrecords_creation(data, labels, kepid_labels, tf_dir='tfrecords'):
         labels: np.array; all labels
         kepid_labels: np.array; all kepids and labels
         tf_dir: str; directory to store the generated tfrecords
+        num_shards: int; number of files per split. Default = 1.
+        compression: None, 'GZIP' or 'ZLIB'. Default = None.
+        flux_dtype: dtype the flux is stored as (e.g. 'float32' or 
+            'float16'). Default = None (keep the dtype of data).
+        n_workers: int; number of worker processes. Default = 1.
+        log_format: 'text' or 'json' progress reports, see 
+            ProgressReporter. Default = 'text'.
+        seed: int; seed of the hash splitting the kepids, see 
+            split_indices. Default = 0.
+        stratify: bool; split every label in the same proportions.
+            Default = False.
+        views: OrderedDict; name -> np.array of the other views, stored
+            with every TCE (see create_data_record). Default = None.
         
     Writes Out:
         The output .tfrecords files contains both flux data and labels.
         Output files are placed according to data type (eg. training, validation, testing).
         Output files are genereated using the create_data_record function.
-        Output files are placed in tf_dir.
+        Output files are placed in tf_dir, along with manifest.json 
+            listing the shards and record counts of every split, and 
+            tfrecords_stats.json/.csv with the time spent serializing 
+            and writing every shard.
         
     '''
     
@@ -188,18 +920,31 @@ def main_tfrecords_creation(data, labels, kepid_labels, tf_dir='tfrecords'):
     ## Start counting towards time of completion
     start = time.time()
     
-    ## Shuffling data
-    print('\nShuffling data..')
-    data, labels, kepid_labels = shuffle_data(data, labels, kepid_labels)
-    
-    ## Spliting data
-    print('Splitting data..')
-    train_data,train_labels,val_data,val_labels,test_data,test_labels = split_data(data, labels)
+    ## Splitting data from a hash of the kepids (no shuffling or copying;
+    ## the rows are read from data as they are written)
+    print('\nSplitting data..')
+    kepids = kepid_labels[:, 0].astype(np.int64)
+    rows = split_indices(kepids, labels, seed=seed, stratify=stratify)
         
     ## Creating the train, validation, and test tfrecords
-    create_data_record(tf_dir+'/'+'train.tfrecords', train_data, train_labels, 'Training')
-    create_data_record(tf_dir+'/'+'val.tfrecords', val_data, val_labels, 'Validation')
-    create_data_record(tf_dir+'/'+'test.tfrecords', test_data, test_labels, 'Testing')
+    stats = RunStats()
+    options = {'num_shards': num_shards, 'compression': compression,
+               'flux_dtype': flux_dtype, 'n_workers': n_workers,
+               'stats': stats, 'log_format': log_format, 'kepids': kepids,
+               'views': views}
+    manifest = {
+        'train': create_data_record(tf_dir+'/'+'train.tfrecords', data, labels, 'Training', rows=rows['train'], **options),
+        'val': create_data_record(tf_dir+'/'+'val.tfrecords', data, labels, 'Validation', rows=rows['val'], **options),
+        'test': create_data_record(tf_dir+'/'+'test.tfrecords', data, labels, 'Testing', rows=rows['test'], **options),
+    }
+    
+    ## Saving the manifest used when reading the tfrecords back
+    write_manifest(tf_dir, manifest)
+    
+    ## Writing out the time spent in every stage
+    stats.write_json(os.path.join(tf_dir, 'tfrecords_stats.json'))
+    stats.write_csv(os.path.join(tf_dir, 'tfrecords_stats.csv'))
+    stats.print_summary()
     
     ## Display time of completion
     end = time.time()